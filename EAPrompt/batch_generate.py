@@ -0,0 +1,85 @@
+"""
+===============================================================================
+Offline Batch Response Generation for EAPrompt Evaluation
+===============================================================================
+
+This script is the offline counterpart of `responses_generate.py`. Instead of
+calling the model online, it exports the queries of a prompt type as a batch
+request file, and ingests the result file returned by the OpenAI Batch API or
+a local vLLM offline runner (see `batch_jobs.py` for the file formats).
+
+------------------------------------------------------------------------------
+Workflow Overview
+------------------------------------------------------------------------------
+1. **Two-step prompts** (ERROR + COUNT):
+       python EAPrompt/batch_generate.py export --stage error
+       # run the request file, e.g. `vllm run-batch -i <requests> -o <results> --model ...`
+       python EAPrompt/batch_generate.py ingest --stage error --results <results>
+       python EAPrompt/batch_generate.py export --stage count
+       python EAPrompt/batch_generate.py ingest --stage count --results <results>
+
+2. **SINGLESTEP prompts**: a single `export` / `ingest` round with
+   `--stage singlestep`.
+
+3. **Output**
+   - Responses are written to the same folder and format as
+     `responses_generate.py`, and can be scored the same way.
+   - Request files are written to `<batch_folder>/<stage>_requests.jsonl`
+     unless `--requests` is given.
+   - Only segments that do not have the stage's response yet are exported, so
+     failed requests are retried by running `export` again.
+
+------------------------------------------------------------------------------
+Notes
+------------------------------------------------------------------------------
+- `model_name` is used to look up the `OpenAIConfig` for the request bodies
+  (model, temperature, max_tokens); the endpoint is not contacted.
+- `truncate`, `truncate_keywords` and `truncate_start` work as in
+  `responses_generate.py`; responses are truncated when they are ingested, so
+  that COUNT requests are exported from the same ERROR responses as online.
+
+===============================================================================
+"""
+
+import argparse
+import os
+
+from batch_jobs import export_requests, ingest_results
+from constants.model_configs import MODEL_CONFIGS
+from truncation import truncation_for_stage
+
+#### Parameters
+
+lang_pair = 'ende'
+prompt_type = f"ERROR_{lang_pair.upper()}_ITEMIZED_REF"
+model_name = "/model/name/in/config"
+file_format = "json" # output format, "json" (published layout) or "jsonl"
+truncate = False # cut the rambling tail of ingested responses, as in `responses_generate.py`
+truncate_keywords = [] # e.g. ["\n\n\n", "Note:"], ERROR step only
+truncate_start = 0 # characters kept before looking for `truncate_keywords`
+queries_folder = f"./results/queries/{lang_pair}/{prompt_type}/" # release version
+responses_folder = f"./results/responses/{lang_pair}/{model_name}/{prompt_type}"
+batch_folder = os.path.join(responses_folder, ".batch")
+
+#### Batch Export / Ingestion
+
+parser = argparse.ArgumentParser()
+parser.add_argument("action", choices=["export", "ingest"])
+parser.add_argument("--stage", choices=["error", "count", "singlestep"],
+                    default="singlestep" if "SINGLESTEP" in prompt_type else "error")
+parser.add_argument("--requests", default=None, help="request file to write (export)")
+parser.add_argument("--results", default=None, help="result file to read (ingest)")
+args = parser.parse_args()
+
+if (args.stage == "singlestep") != ("SINGLESTEP" in prompt_type):
+    parser.error(f"stage {args.stage} does not apply to {prompt_type}")
+
+if args.action == "export":
+    request_path = args.requests or os.path.join(batch_folder, f"{args.stage}_requests.jsonl")
+    export_requests(queries_folder, responses_folder, request_path, MODEL_CONFIGS[model_name], args.stage, file_format)
+else:
+    if args.results is None:
+        parser.error("ingest requires --results")
+    stage_prompt_type = "COUNT" if args.stage == "count" else prompt_type
+    truncation = truncation_for_stage(stage_prompt_type, truncate_keywords, truncate_start) if truncate else None
+    ingest_results(queries_folder, responses_folder, args.results, args.stage, file_format, truncation)
@@ -0,0 +1,206 @@
+"""
+===============================================================================
+Offline Batch Jobs: Request Export and Result Ingestion
+===============================================================================
+
+This module implements the file-based backend used by `batch_generate.py`.
+Instead of calling the model online, all queries are written to a JSONL
+request file, which can be submitted to the OpenAI Batch API or run with a
+local vLLM offline runner (`vllm run-batch`), and the returned JSONL result
+file is ingested back into the response records.
+
+------------------------------------------------------------------------------
+File Formats
+------------------------------------------------------------------------------
+1. **Request file** (one line per request):
+       {"custom_id": "<system>|<segment index>|<stage>",
+        "method": "POST", "url": "/v1/chat/completions",
+        "body": {"model": ..., "messages": [...], "temperature": ..., "max_tokens": ...}}
+
+2. **Result file** (one line per request, in any order):
+       {"custom_id": "...",
+        "response": {"status_code": 200, "body": {<chat completion>}},
+        "error": null}
+
+Custom IDs are stable: they only depend on the system name, the segment
+index in its file and the stage (`error`, `count` or `singlestep`).
+
+------------------------------------------------------------------------------
+Stages
+------------------------------------------------------------------------------
+- `error` / `singlestep`: built from the query records.
+- `count`: built from the ingested `error_response` fields, so that the COUNT
+  step runs as a second batch job.
+
+Records that already have the stage's response field are not exported again,
+so failed or missing requests can be re-exported and re-submitted.
+
+------------------------------------------------------------------------------
+Ingestion
+------------------------------------------------------------------------------
+- Every custom ID of the result file is checked against the query folder
+  (known system, segment index within its file) before any response file is
+  written, so a bad result file leaves the responses untouched.
+- With a `truncation` rule (see `truncation.py`), responses are truncated as
+  they are ingested, as in `responses_generate.py`, so that COUNT requests
+  are built from the same ERROR responses as online.
+
+===============================================================================
+"""
+
+import os
+
+from constants.model_configs import OpenAIConfig
+from eaprompt import EAPrompt
+from query_store import TEMPLATE_FILE, get_query, load_template, save_template
+from utils import RecordWriter, iter_jsonl, iter_records
+
+STAGE_FIELDS = {
+    "error": "error_response",
+    "count": "count_response",
+    "singlestep": "singlestep_response",
+}
+
+def make_custom_id(system: str, idx: int, stage: str) -> str:
+    return f"{system}|{idx}|{stage}"
+
+def parse_custom_id(custom_id: str) -> tuple[str, int, str]:
+    system, idx, stage = custom_id.rsplit("|", 2)
+    return system, int(idx), stage
+
+def build_request(custom_id: str, cfg: OpenAIConfig, messages: list[dict[str, str]]) -> dict:
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": cfg.model_name,
+            "messages": messages,
+            "temperature": cfg.temperature,
+            "max_tokens": cfg.max_tokens,
+        },
+    }
+
+def list_systems(queries_folder: str) -> list[tuple[str, str]]:
+    """(system name, query file name) of every query file, in a stable order."""
+    return [
+        (os.path.splitext(file_name)[0], file_name)
+        for file_name in sorted(os.listdir(queries_folder))
+        if file_name != TEMPLATE_FILE
+    ]
+
+def _response_path(responses_folder: str, system: str, file_format: str) -> str:
+    return os.path.join(responses_folder, f"{system}.{file_format}")
+
+def _iter_base_records(queries_folder: str, responses_folder: str, system: str, file_name: str, file_format: str):
+    """Records ingested so far for a system, or its query records before the first ingestion."""
+    response_path = _response_path(responses_folder, system, file_format)
+    if os.path.exists(response_path):
+        return iter_records(response_path)
+    return iter_records(os.path.join(queries_folder, file_name))
+
+def export_requests(
+    queries_folder: str,
+    responses_folder: str,
+    request_path: str,
+    cfg: OpenAIConfig,
+    stage: str,
+    file_format: str = "jsonl") -> int:
+
+    """
+    Write the requests of one stage for every system of a query folder.
+    Returns the number of exported requests.
+    """
+
+    field = STAGE_FIELDS[stage]
+    template = load_template(queries_folder)
+    count_prompt = EAPrompt(prompt_type="COUNT")
+
+    os.makedirs(os.path.dirname(os.path.abspath(request_path)), exist_ok=True)
+    with RecordWriter(request_path, jsonl=True) as writer:
+        for system, file_name in list_systems(queries_folder):
+            for idx, record in enumerate(_iter_base_records(queries_folder, responses_folder, system, file_name, file_format)):
+                if field in record:
+                    continue
+                if stage == "count":
+                    if "error_response" not in record:
+                        continue # its ERROR request has not been ingested yet
+                    messages = count_prompt.generate_query(record["error_response"])
+                else:
+                    messages = get_query(record, template)
+                writer.write(build_request(make_custom_id(system, idx, stage), cfg, messages))
+
+    print(f"Exported {writer.count} {stage} requests to {request_path}.")
+    return writer.count
+
+def iter_batch_results(result_path: str):
+    """Yield (custom_id, content, error) for each line of a batch result file; content is None on failure."""
+
+    for line in iter_jsonl(result_path):
+        response = line.get("response") or {}
+        body = response.get("body") or {}
+        if line.get("error") or response.get("status_code", 200) != 200 or not body.get("choices"):
+            yield line["custom_id"], None, line.get("error") or body.get("error") or response.get("status_code")
+        else:
+            yield line["custom_id"], body["choices"][0]["message"]["content"], None
+
+def ingest_results(
+    queries_folder: str,
+    responses_folder: str,
+    result_path: str,
+    stage: str,
+    file_format: str = "jsonl",
+    truncation=None) -> dict[str, int]:
+
+    """
+    Merge the responses of a batch result file into the response records of every system,
+    truncated with `truncation` if given. Failed and missing requests are counted and left
+    without the stage's field; raises ValueError, before writing anything, if a result does
+    not match a segment of the query folder.
+    """
+
+    field = STAGE_FIELDS[stage]
+    results, failed = {}, 0
+    for custom_id, content, error in iter_batch_results(result_path):
+        system, idx, result_stage = parse_custom_id(custom_id)
+        if result_stage != stage:
+            raise ValueError(f"Result {custom_id} does not belong to stage {stage}.")
+        if content is None:
+            failed += 1
+            print(f"{custom_id} failed: {error}")
+            continue
+        results.setdefault(system, {})[idx] = truncation.apply(content) if truncation is not None else content
+
+    systems = list_systems(queries_folder)
+    unknown = sorted(results.keys() - {system for system, _ in systems})
+    if unknown:
+        raise ValueError(f"Results for unknown systems: {unknown}")
+    for system, file_name in systems:
+        if system in results:
+            size = sum(1 for _ in iter_records(os.path.join(queries_folder, file_name)))
+            beyond = [idx for idx in results[system] if not 0 <= idx < size]
+            if beyond:
+                raise ValueError(f"{len(beyond)} results of {system} point beyond its query file ({size} records).")
+
+    os.makedirs(responses_folder, exist_ok=True)
+    template = load_template(queries_folder)
+    if template is not None:
+        save_template(template, responses_folder)
+
+    ingested, missing = 0, 0
+    for system, file_name in systems:
+        system_results = results.get(system, {})
+        output_path = _response_path(responses_folder, system, file_format)
+        with RecordWriter(output_path + ".tmp", jsonl=(file_format == "jsonl")) as writer:
+            for idx, record in enumerate(_iter_base_records(queries_folder, responses_folder, system, file_name, file_format)):
+                if idx in system_results:
+                    record[field] = system_results[idx]
+                    ingested += 1
+                elif field not in record:
+                    missing += 1
+                writer.write(record)
+        os.replace(output_path + ".tmp", output_path)
+
+    stats = {"ingested": ingested, "failed": failed, "missing": missing}
+    print(f"Ingested {stage} results from {result_path}: {stats}")
+    return stats
@@ -0,0 +1,74 @@
+"""
+===============================================================================
+Micro-benchmark: EAPrompt Query Construction
+===============================================================================
+
+Measures `EAPrompt.generate_queries_batch` on a large synthetic input set and
+compares it with the previous per-segment construction, which re-parsed the
+prompt type, looked up and stripped every context string, and built fresh
+few-shot message dicts for each segment.
+
+Usage (from the repository root):
+    python EAPrompt/benchmarks/bench_eaprompt.py
+
+===============================================================================
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from eaprompt import CONTEXT_VAR_MAP, PROMPT_TYPE_CONFIGS, EAPrompt
+from utils import parse_type
+
+# Parameters (edit if needed)
+num_inputs = 100_000
+prompt_type = "ERROR_ZHEN_ITEMIZED_REF"
+repeats = 3
+
+def legacy_generate_query(prompt_type: str, eval_input: dict[str, str]) -> list[dict[str, str]]:
+    """Per-segment construction without compilation (ERROR step), kept as the reference."""
+    
+    is_valid, prompt_info = parse_type(type_configs=PROMPT_TYPE_CONFIGS, prompt_type_str=prompt_type)
+    _lang, _demo, _is_ref = prompt_info["LANG"], prompt_info["DEMO"], prompt_info["IS_REF"]
+    
+    example_user_part1 = CONTEXT_VAR_MAP[f"EXAMPLE_{_lang}_{_is_ref}"].strip()
+    example_user_part2 = CONTEXT_VAR_MAP[f"INSTRUCTION_ERROR_{_is_ref}"].strip()
+    example_assistant = CONTEXT_VAR_MAP[f"EXAMPLE_ERROR_{_demo}_{_lang}"].strip()
+    user_part1 = CONTEXT_VAR_MAP[f"EVALUATION_INPUT_{_is_ref}"].format(**eval_input).strip()
+    user_part2 = CONTEXT_VAR_MAP[f"INSTRUCTION_ERROR_{_is_ref}"].strip()
+    
+    return [
+        {"role": "user", "content": example_user_part1 + "\n" + example_user_part2},
+        {"role": "assistant", "content": example_assistant},
+        {"role": "user", "content": user_part1 + "\n" + user_part2},
+    ]
+
+def best_of(fn, repeats: int) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+if __name__ == "__main__":
+    
+    eval_inputs = [{
+        "src": f"源文本 {i}",
+        "tgt": f"translation {i}",
+        "ref": f"reference {i}",
+    } for i in range(num_inputs)]
+    
+    EAP = EAPrompt(prompt_type=prompt_type)
+    assert EAP.generate_queries_batch(eval_inputs[:100]) == [legacy_generate_query(prompt_type, x) for x in eval_inputs[:100]]
+    
+    legacy = best_of(lambda: [legacy_generate_query(prompt_type, x) for x in eval_inputs], repeats)
+    compiled = best_of(lambda: EAP.generate_queries_batch(eval_inputs), repeats)
+    
+    print(f"{prompt_type}, {num_inputs} inputs (best of {repeats})")
+    print(f"  per-segment construction: {legacy:.3f}s ({num_inputs / legacy:,.0f} queries/s)")
+    print(f"  compiled prompt type:     {compiled:.3f}s ({num_inputs / compiled:,.0f} queries/s)")
+    print(f"  speedup: {legacy / compiled:.2f}x")
@@ -0,0 +1,260 @@
+"""
+===============================================================================
+End-to-end Benchmark: Queries -> Responses -> Scores
+===============================================================================
+
+Runs the whole EAPrompt pipeline on WMT22 data against local mock servers
+(`mock_server.py`), so that performance changes can be measured without
+calling a real model.
+
+------------------------------------------------------------------------------
+Stages (per scenario)
+------------------------------------------------------------------------------
+1. **queries**: `EAPrompt.generate_queries_batch` on the first `num_segments`
+   segments of `num_systems` systems, written as full (`inputs` + `query`)
+   `.jsonl` records.
+2. **responses**: the query files are read back and sent through
+   `InferenceEngine.infer_chain` (ERROR -> COUNT); responses are written as
+   `.jsonl` files.
+3. **scores**: `scoring.build_score_matrix` over the response files.
+
+For each stage the wall time and items/s are reported; for the responses
+stage also the requests/s, p50/p95/p99 latency, retries and errors from the
+engine's request metrics. Peak RSS (this process and its children) is
+reported per scenario.
+
+------------------------------------------------------------------------------
+Scenarios
+------------------------------------------------------------------------------
+`SCENARIOS` lists the mock server settings of each run (latency
+distribution, 429 / timeout injection, number of servers). Edit it to add
+cases.
+
+------------------------------------------------------------------------------
+Results
+------------------------------------------------------------------------------
+Results are saved as `results/<commit>.json` (current `git` commit, with a
+`-dirty` suffix for uncommitted changes), and the requests/s of previously
+saved commits are printed for comparison.
+
+Usage (from the repository root):
+    python EAPrompt/benchmarks/bench_pipeline.py
+
+===============================================================================
+"""
+
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from constants.model_configs import MODEL_CONFIGS, OpenAIConfig
+from eaprompt import EAPrompt
+from inference import InferenceEngine
+from scoring import build_score_matrix
+from utils import RecordWriter, iter_records, readlines_txt
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Parameters (edit if needed)
+data_folder = os.path.join(os.path.dirname(BENCH_DIR), "wmt22")
+lang_pair = "zhen"
+prompt_type = "ERROR_ZHEN_ITEMIZED_REF"
+num_systems = 4
+num_segments = 500 # per system
+max_concurrency = 64
+first_port = 18101
+results_folder = os.path.join(BENCH_DIR, "results")
+
+SCENARIOS = [
+    {"name": "baseline", "servers": 1, "latency": "lognormal", "latency_median": 0.05},
+    {"name": "two_servers", "servers": 2, "latency": "lognormal", "latency_median": 0.05},
+    {"name": "rate_limited", "servers": 1, "latency": "lognormal", "latency_median": 0.05,
+     "rate_limit_rate": 0.05, "retry_after": 0.2},
+    {"name": "timeouts", "servers": 1, "latency": "lognormal", "latency_median": 0.05,
+     "timeout_rate": 0.005, "timeout_sleep": 5, "request_timeout": 1},
+]
+
+def peak_rss_mb() -> dict[str, float]:
+    """Peak resident set size so far, in MB (ru_maxrss is in KB on Linux)."""
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+def current_commit() -> str:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=BENCH_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if dirty else "")
+
+def start_mock_servers(scenario: dict) -> tuple[subprocess.Popen, list[str]]:
+    ports = [first_port + i for i in range(scenario.get("servers", 1))]
+    command = [sys.executable, os.path.join(BENCH_DIR, "mock_server.py"), "--ports", *map(str, ports)]
+    for option in ["latency", "latency_median", "latency_sigma", "rate_limit_rate",
+                   "retry_after", "timeout_rate", "timeout_sleep"]:
+        if option in scenario:
+            command += [f"--{option.replace('_', '-')}", str(scenario[option])]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+
+    urls = [f"http://127.0.0.1:{port}/v1" for port in ports]
+    deadline = time.monotonic() + 10
+    for url in urls:
+        while True:
+            try:
+                urllib.request.urlopen(url + "/models", timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    process.kill()
+                    raise RuntimeError(f"Mock server {url} did not start.")
+                time.sleep(0.1)
+    return process, urls
+
+def load_inputs() -> dict[str, list[dict[str, str]]]:
+    src_lang, tgt_lang = lang_pair[:2], lang_pair[2:]
+    srcs = readlines_txt(os.path.join(data_folder, f"wmt22.{lang_pair}.src.{src_lang}"))[:num_segments]
+    refs = readlines_txt(os.path.join(data_folder, f"wmt22.{lang_pair}.ref.{tgt_lang}"))[:num_segments]
+    sys_folder = os.path.join(data_folder, f"wmt22.{lang_pair}.sys.{tgt_lang}")
+    inputs = {}
+    for file_name in sorted(os.listdir(sys_folder))[:num_systems]:
+        tgts = readlines_txt(os.path.join(sys_folder, file_name))[:num_segments]
+        inputs[file_name.split(".")[2]] = [
+            {"src": src, "tgt": tgt.strip(), "ref": ref} for src, tgt, ref in zip(srcs, tgts, refs)
+        ]
+    return inputs
+
+def run_queries(inputs: dict, queries_folder: str) -> dict:
+    start = time.perf_counter()
+    EAP = EAPrompt(prompt_type=prompt_type)
+    total = 0
+    for system, eval_inputs in inputs.items():
+        queries = EAP.generate_queries_batch(eval_inputs)
+        with RecordWriter(os.path.join(queries_folder, f"{system}.jsonl")) as writer:
+            for eval_input, query in zip(eval_inputs, queries):
+                writer.write({"inputs": eval_input, "query": query})
+        total += len(eval_inputs)
+    elapsed = time.perf_counter() - start
+    return {"seconds": elapsed, "items": total, "items_per_second": total / elapsed}
+
+def run_responses(queries_folder: str, responses_folder: str) -> dict:
+    engine = InferenceEngine(model_name="mock-bench")
+    EAP = EAPrompt(prompt_type="COUNT")
+
+    start = time.perf_counter()
+    segments = 0
+    for file_name in sorted(os.listdir(queries_folder)):
+        records = list(iter_records(os.path.join(queries_folder, file_name)))
+        outputs = engine.infer_chain([record["query"] for record in records], followups=[EAP.generate_query])
+        with RecordWriter(os.path.join(responses_folder, file_name)) as writer:
+            for record, (error_response, count_response) in zip(records, outputs):
+                writer.write({**record, "error_response": error_response, "count_response": count_response})
+        segments += len(records)
+    elapsed = time.perf_counter() - start
+
+    summary = engine.metrics.summary()
+    return {
+        "seconds": elapsed,
+        "items": segments,
+        "items_per_second": segments / elapsed,
+        "requests": summary["requests"],
+        "requests_per_second": summary["requests"] / elapsed,
+        "latency": summary["latency"],
+        "queue_time": summary["queue_time"],
+        "retries": summary["retries"],
+        "errors": summary["errors"],
+    }
+
+def run_scores(responses_folder: str) -> dict:
+    start = time.perf_counter()
+    matrix = build_score_matrix(responses_folder)
+    elapsed = time.perf_counter() - start
+    return {"seconds": elapsed, "items": int(matrix.major.size), "items_per_second": matrix.major.size / elapsed,
+            "parse_rate": matrix.parse_rate()}
+
+def run_scenario(scenario: dict, inputs: dict) -> dict:
+    process, urls = start_mock_servers(scenario)
+    MODEL_CONFIGS["mock-bench"] = OpenAIConfig(
+        base_url=urls if len(urls) > 1 else urls[0],
+        api_key="mock",
+        model_name="mock",
+        max_concurrency=max_concurrency,
+        request_timeout=scenario.get("request_timeout", 10),
+        retry_sleep=0.1,
+        backoff_max=1,
+    )
+
+    work_dir = tempfile.mkdtemp(prefix="eaprompt_bench_")
+    queries_folder, responses_folder = os.path.join(work_dir, "queries"), os.path.join(work_dir, "responses")
+    os.makedirs(queries_folder)
+    os.makedirs(responses_folder)
+    try:
+        result = {
+            "scenario": scenario,
+            "queries": run_queries(inputs, queries_folder),
+            "responses": run_responses(queries_folder, responses_folder),
+            "scores": run_scores(responses_folder),
+        }
+    finally:
+        process.kill()
+        process.wait()
+        shutil.rmtree(work_dir)
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+def print_result(result: dict) -> None:
+    responses = result["responses"]
+    print(f"[{result['scenario']['name']}]")
+    for stage in ["queries", "responses", "scores"]:
+        print(f"  {stage:<10} {result[stage]['seconds']:8.2f}s  {result[stage]['items_per_second']:10,.1f} items/s")
+    print(f"  {responses['requests_per_second']:.1f} req/s, latency p50/p95/p99 "
+          f"{responses['latency']['p50']:.3f}/{responses['latency']['p95']:.3f}/{responses['latency']['p99']:.3f}s, "
+          f"{responses['retries']} retries {responses['errors']}")
+    print(f"  peak RSS {result['peak_rss_mb']['self']:.0f} MB (children {result['peak_rss_mb']['children']:.0f} MB)")
+
+def print_history() -> None:
+    """Requests/s of each scenario across saved commits."""
+
+    runs = []
+    for file_name in os.listdir(results_folder):
+        if file_name.endswith(".json"):
+            with open(os.path.join(results_folder, file_name), "r", encoding="utf-8") as f:
+                runs.append(json.load(f))
+    runs.sort(key=lambda run: run["timestamp"])
+
+    print("History (responses req/s):")
+    for run in runs:
+        rates = ", ".join(f"{result['scenario']['name']}={result['responses']['requests_per_second']:.1f}"
+                          for result in run["results"])
+        print(f"  {run['commit']:<16} {time.strftime('%Y-%m-%d %H:%M', time.localtime(run['timestamp']))}  {rates}")
+
+if __name__ == "__main__":
+
+    inputs = load_inputs()
+    print(f"{len(inputs)} systems x {num_segments} segments, {prompt_type}")
+
+    results = []
+    for scenario in SCENARIOS:
+        result = run_scenario(scenario, inputs)
+        print_result(result)
+        results.append(result)
+
+    os.makedirs(results_folder, exist_ok=True)
+    commit = current_commit()
+    output_path = os.path.join(results_folder, f"{commit}.json")
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump({"commit": commit, "timestamp": time.time(), "python": sys.version.split()[0],
+                   "num_systems": num_systems, "num_segments": num_segments, "results": results}, f, indent=4)
+    print(f"Saved to {output_path}.")
+    print_history()
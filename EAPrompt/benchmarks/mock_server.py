@@ -0,0 +1,249 @@
+"""
+===============================================================================
+Mock OpenAI-compatible Server for Benchmarks
+===============================================================================
+
+A local stand-in for an OpenAI / vLLM chat completion server, so that the
+throughput of `InferenceEngine` and the rest of the pipeline can be measured
+without calling a real model.
+
+------------------------------------------------------------------------------
+Behavior
+------------------------------------------------------------------------------
+1. **Endpoints**: `POST /v1/chat/completions` (with `n` and `stream`) and
+   `GET /v1/models`. Streamed responses are sent as server-sent events, one
+   word per chunk, `--token-latency` seconds apart.
+
+2. **Canned EAPrompt-shaped responses**, deterministic for a given query:
+   - ERROR queries: an itemized "Major errors: / Minor errors:" list, with
+     error counts derived from a hash of the query.
+   - COUNT queries: the "x, x" count of the itemized list being counted.
+   - SINGLESTEP queries: the itemized list followed by the "x, x" line.
+   With `n` > 1, each choice hashes the query with its index, so the sampled
+   counts differ (as at temperature > 0) and can be aggregated (see
+   `consistency.py`); choice 0 is the response of an `n` = 1 request.
+   The `usage` field is filled with about 4 characters per token.
+   `--ramble` appends that many filler lines after the answer, as models
+   often do (see `truncation.py`).
+
+3. **Latency**: `fixed`, `uniform` (between 0 and twice the median) or
+   `lognormal` (given median and sigma) delay per request.
+
+4. **Fault injection**:
+   - `--rate-limit-rate`: share of requests answered with HTTP 429 and a
+     `Retry-After` header.
+   - `--timeout-rate`: share of requests that hang for `--timeout-sleep`
+     seconds, so that the client times out.
+
+Usage:
+    python EAPrompt/benchmarks/mock_server.py --ports 18001 18002 --latency lognormal --latency-median 0.1
+
+One server thread is started per port, sharing the same settings.
+
+===============================================================================
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from constants.context import INSTRUCTION_COUNT
+from counting import count_itemized_errors, format_count
+
+SINGLESTEP_MARKER = "Then based on the error information"
+RAMBLE_LINE = "This error affects the fluency of the translation but the meaning is preserved."
+ERROR_TYPES = ["Mistranslation", "Grammar", "Omission", "Inappropriate for context", "Spelling"]
+
+def canned_errors(query_text: str, sample: int = 0) -> tuple[int, int, str]:
+    """Deterministic itemized error list for a query and sample index: (major, minor, text)."""
+
+    seed = query_text if sample == 0 else f"{query_text}\n#sample {sample}"
+    digest = int(hashlib.sha256(seed.encode("utf-8")).hexdigest(), 16)
+    major, minor = digest % 3, (digest // 3) % 4
+    words = [word for line in query_text.splitlines() if line.startswith("Translation:")
+             for word in line.split()[1:]] or ["translation"]
+
+    def _items(count, offset):
+        if count == 0:
+            return ["None"]
+        return [f"({i + 1}) “{words[(offset + i) % len(words)]}” – {ERROR_TYPES[(offset + i) % len(ERROR_TYPES)]}"
+                for i in range(count)]
+
+    lines = ["Major errors:", *_items(major, digest % 7), "Minor errors:", *_items(minor, digest % 11)]
+    return major, minor, "\n".join(lines)
+
+def canned_response(messages: list[dict[str, str]], sample: int = 0) -> str:
+    last = messages[-1]["content"].strip()
+    instruction = INSTRUCTION_COUNT.strip()
+    if last.endswith(instruction):
+        counts = count_itemized_errors(last[:-len(instruction)])
+        return format_count(*counts) if counts is not None else "0, 0"
+    major, minor, text = canned_errors(last, sample)
+    if SINGLESTEP_MARKER in last:
+        return text + "\n" + format_count(major, minor)
+    return text
+
+class MockSettings:
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.lock = threading.Lock()
+
+    def latency(self) -> float:
+        args = self.args
+        with self.lock:
+            if args.latency == "fixed":
+                return args.latency_median
+            if args.latency == "uniform":
+                return self.rng.uniform(0, 2 * args.latency_median)
+            return self.rng.lognormvariate(0, args.latency_sigma) * args.latency_median
+
+    def fault(self) -> str:
+        with self.lock:
+            draw = self.rng.random()
+        if draw < self.args.rate_limit_rate:
+            return "rate_limit"
+        if draw < self.args.rate_limit_rate + self.args.timeout_rate:
+            return "timeout"
+        return ""
+
+class MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024 # the default backlog of 5 drops connections under high concurrency
+
+def make_handler(settings: MockSettings):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args) -> None:
+            pass
+
+        def _send_json(self, status: int, payload: dict, headers: dict = None) -> None:
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass # the client gave up (e.g. injected timeout)
+
+        def _send_stream(self, request: dict, contents: list[str]) -> None:
+            """Send the content of each choice as server-sent events, one word per chunk; stops when the client closes."""
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+
+            def _event(index, delta, finish_reason=None):
+                payload = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()),
+                           "model": request.get("model", "mock"),
+                           "choices": [{"index": index, "delta": delta, "finish_reason": finish_reason}]}
+                self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+
+            try:
+                for index, content in enumerate(contents):
+                    _event(index, {"role": "assistant", "content": ""})
+                    for token in re.findall(r"\s*\S+", content):
+                        time.sleep(settings.args.token_latency)
+                        _event(index, {"content": token})
+                    _event(index, {}, "stop")
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass # the client stopped the stream early
+
+        def do_GET(self) -> None:
+            if self.path.rstrip("/").endswith("/models"):
+                self._send_json(200, {"object": "list", "data": [{"id": "mock", "object": "model"}]})
+            else:
+                self._send_json(404, {"error": {"message": "not found"}})
+
+        def do_POST(self) -> None:
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+            fault = settings.fault()
+            if fault == "rate_limit":
+                self._send_json(429, {"error": {"message": "rate limited", "type": "rate_limit_error"}},
+                                {"Retry-After": str(settings.args.retry_after)})
+                return
+            if fault == "timeout":
+                time.sleep(settings.args.timeout_sleep)
+
+            time.sleep(settings.latency())
+            contents = [canned_response(request["messages"], i) + f"\n{RAMBLE_LINE}" * settings.args.ramble
+                        for i in range(request.get("n") or 1)]
+            if request.get("stream"):
+                self._send_stream(request, contents)
+                return
+            prompt_tokens = sum(len(message["content"]) for message in request["messages"]) // 4
+            completion_tokens = sum(len(content) // 4 for content in contents)
+            choices = [{"index": i, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}
+                       for i, content in enumerate(contents)]
+            self._send_json(200, {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "mock"),
+                "choices": choices,
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            })
+
+    return Handler
+
+def start_servers(args: argparse.Namespace) -> list[MockHTTPServer]:
+    settings = MockSettings(args)
+    servers = []
+    for port in args.ports:
+        server = MockHTTPServer((args.host, port), make_handler(settings))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    return servers
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible server for benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--ports", type=int, nargs="+", default=[18001])
+    parser.add_argument("--latency", choices=["fixed", "uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--latency-median", type=float, default=0.1, help="seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="lognormal shape")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=0.5, help="seconds")
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-sleep", type=float, default=30.0, help="seconds")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument("--ramble", type=int, default=0, help="filler lines appended to each response")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+
+    args = parse_args()
+    servers = start_servers(args)
+    print(f"Mock server listening on {', '.join(f'{args.host}:{port}' for port in args.ports)}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
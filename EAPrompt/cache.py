@@ -0,0 +1,158 @@
+"""
+===============================================================================
+Persistent Response Cache for LLM Requests
+===============================================================================
+
+This module implements an on-disk, content-addressed cache placed in front of
+the LLM client used by `InferenceEngine`.
+
+------------------------------------------------------------------------------
+Key Features
+------------------------------------------------------------------------------
+1. **Content Addressing**
+   - `request_key(...)` hashes the request tuple (model, messages, temperature,
+     max_tokens) into a stable SHA-256 key, independent of dict ordering.
+
+2. **Storage**
+   - `ResponseCache` stores responses in a single SQLite file, so reruns after
+     a crash, or prompt variants sharing the COUNT step, become local lookups.
+
+3. **Eviction**
+   - Entries older than `max_age` seconds are dropped.
+   - When more than `max_entries` entries are stored, the least recently used
+     ones are dropped.
+
+4. **Read-only Mode**
+   - With `read_only=True` the database is opened read-only and never written,
+     which is intended for replaying published results.
+
+5. **Statistics**
+   - Hit/miss counters are exposed through `stats()`.
+
+===============================================================================
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Optional
+
+EVICT_EVERY = 1000 # run eviction once per this many writes
+
+def request_key(model: str, messages: list[dict[str, str]], temperature: float, max_tokens: int, **extra) -> str:
+    """Stable hash of one chat request. Extra request parameters (e.g. `n`) are included when given."""
+
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        **extra,
+    }
+    serialized = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+
+    def __init__(self,
+                 path: str,
+                 read_only: bool = False,
+                 max_entries: Optional[int] = None,
+                 max_age: Optional[float] = None) -> None:
+
+        self.path = path
+        self.read_only = read_only
+        self.max_entries = max_entries
+        self.max_age = max_age
+
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+
+        if read_only:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Read-only cache {path} does not exist.")
+            self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.conn = sqlite3.connect(path, timeout=30)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, "
+                "response TEXT NOT NULL, "
+                "created_at REAL NOT NULL, "
+                "accessed_at REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_accessed_at ON responses (accessed_at)")
+            self.conn.commit()
+            self.evict()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached response, or None on a miss (expired entries count as misses)."""
+
+        row = self.conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+
+        if row is None or (self.max_age is not None and time.time() - row[1] > self.max_age):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        if not self.read_only:
+            self.conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, response) -> None:
+        """Store a response (any JSON-serializable value). Ignored in read-only mode."""
+
+        if self.read_only:
+            return
+
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, response, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(response, ensure_ascii=False), now, now),
+        )
+        self.conn.commit()
+
+        self._writes += 1
+        if self._writes % EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self) -> int:
+        """Drop expired entries, then least recently used ones beyond `max_entries`. Returns the number removed."""
+
+        if self.read_only:
+            return 0
+
+        removed = 0
+        if self.max_age is not None:
+            removed += self.conn.execute(
+                "DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age,)
+            ).rowcount
+        if self.max_entries is not None:
+            removed += self.conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+        self.conn.commit()
+        return removed
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self),
+        }
+
+    def close(self) -> None:
+        self.conn.close()
@@ -0,0 +1,88 @@
+"""
+===============================================================================
+Crash-safe Segment Journal for Response Generation
+===============================================================================
+
+This module implements `SegmentJournal`, an append-only checkpoint used by
+`responses_generate.py` so that a crash (or hitting `max_retry`) only loses the
+requests that were in flight, instead of a whole MT system.
+
+------------------------------------------------------------------------------
+Journal Format
+------------------------------------------------------------------------------
+- One journal per system file, stored as JSON lines:
+      {"idx": 17, "fields": {"error_response": "..."}}
+- Lines are buffered and flushed and fsync-ed together, at most every
+  `sync_interval` seconds, at the end of each chunk (`sync()`) and on
+  `close()`. `append` is called from the callbacks of the inference event
+  loop, so syncing every line would stall all in-flight requests on each
+  disk flush; a hard crash loses at most the last `sync_interval` seconds of
+  responses, which are simply sent again.
+- Several lines may exist for the same segment (e.g. the ERROR and the COUNT
+  step); `load()` merges them in order, later fields overwriting earlier ones.
+- A truncated last line (crash during a write) is ignored on load.
+
+===============================================================================
+"""
+
+import json
+import os
+import time
+
+class SegmentJournal:
+
+    def __init__(self, path: str, sync_interval: float = 1.0) -> None:
+        self.path = path
+        self.sync_interval = sync_interval
+        self._file = None
+        self._synced = time.monotonic()
+
+    def load(self) -> dict[int, dict]:
+        """Return {segment index: merged fields} for every segment recorded so far."""
+
+        done = {}
+        if not os.path.exists(self.path):
+            return done
+
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError: # torn write at the end of the journal
+                    continue
+                done.setdefault(entry["idx"], {}).update(entry["fields"])
+        return done
+
+    def append(self, idx: int, fields: dict) -> None:
+        """Record the fields completed for segment `idx` (durable after the next sync)."""
+
+        if self._file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._file = open(self.path, 'a', encoding='utf-8')
+            if self._file.tell() > 0:
+                self._file.write("\n") # terminate a possibly torn last line
+
+        self._file.write(json.dumps({"idx": idx, "fields": fields}, ensure_ascii=False) + "\n")
+        if time.monotonic() - self._synced >= self.sync_interval:
+            self.sync()
+
+    def sync(self) -> None:
+        """Flush and fsync the lines appended so far."""
+
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._synced = time.monotonic()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def remove(self) -> None:
+        """Delete the journal once its content has been merged into the final output."""
+
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
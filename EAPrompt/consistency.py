@@ -0,0 +1,84 @@
+"""
+===============================================================================
+Self-consistency: Aggregating Several Sampled Responses per Segment
+===============================================================================
+
+At temperature > 0 the EAPrompt counts of a segment vary from one sample to
+the next. Instead of rerunning whole batches, `InferenceEngine` can ask for
+`samples` completions in a single request (the OpenAI `n` parameter), so that
+the long few-shot prefix is sent and processed once per segment and the
+extra samples only cost output tokens. This module turns such samples into
+one score per segment.
+
+------------------------------------------------------------------------------
+Aggregation
+------------------------------------------------------------------------------
+1. Each sample is parsed into (major, minor) counts as in
+   `scoring.response_counts`; unparsed samples are left out.
+2. The counts are aggregated with one of `AGGREGATIONS`:
+   - `"mean"`:   mean of the major and of the minor counts;
+   - `"median"`: median of the major and of the minor counts;
+   - `"vote"`:   the most frequent (major, minor) pair, ties going to the
+                 earliest sample.
+3. The population variance of the counts and of the segment scores
+   (-(5 * major + 1 * minor)) across parsed samples is kept, as a measure of
+   the agreement between samples.
+
+------------------------------------------------------------------------------
+Record Fields
+------------------------------------------------------------------------------
+`sample_fields(responses, aggregation)` builds the fields of a response
+record from the list of samples of each response field:
+- `<field>`: the first sample, so that readers expecting one response per
+  field keep working;
+- `<field>_samples`: all samples;
+- `sample_counts`: the [major, minor] counts of each sample (None if unparsed);
+- `counts`: the aggregated [major, minor] counts, used by `scoring.py`;
+- `count_variance` / `score_variance`: the variances described above.
+`counts` and the variances are None when no sample could be parsed.
+
+===============================================================================
+"""
+
+from collections import Counter
+from typing import Optional, Sequence
+
+import numpy as np
+
+from scoring import MAJOR_WEIGHT, MINOR_WEIGHT, response_counts
+
+AGGREGATIONS = ("mean", "median", "vote")
+
+def aggregate_counts(counts: Sequence[Optional[tuple[int, int]]], method: str = "mean") -> Optional[tuple[float, float]]:
+    """Aggregated (major, minor) of the sampled counts, ignoring unparsed (None) samples."""
+
+    if method not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation {method!r}, expected one of {AGGREGATIONS}.")
+    parsed = [tuple(count) for count in counts if count is not None]
+    if not parsed:
+        return None
+    if method == "vote":
+        return Counter(parsed).most_common(1)[0][0] # most_common keeps first-seen order on ties
+    values = np.array(parsed, dtype=np.float64)
+    aggregated = values.mean(axis=0) if method == "mean" else np.median(values, axis=0)
+    return float(aggregated[0]), float(aggregated[1])
+
+def sample_fields(responses: dict[str, list[str]], method: str = "mean") -> dict:
+    """Record fields of one segment from the samples of each of its response fields (see above)."""
+
+    fields = {}
+    for field, samples in responses.items():
+        fields[field] = samples[0]
+        fields[f"{field}_samples"] = samples
+
+    count_field = "singlestep_response" if "singlestep_response" in responses else "count_response"
+    counts = [response_counts({count_field: sample}) for sample in responses[count_field]]
+    aggregated = aggregate_counts(counts, method)
+
+    parsed = np.array([count for count in counts if count is not None], dtype=np.float64).reshape(-1, 2)
+    scores = -(MAJOR_WEIGHT * parsed[:, 0] + MINOR_WEIGHT * parsed[:, 1])
+    fields["sample_counts"] = [list(count) if count is not None else None for count in counts]
+    fields["counts"] = list(aggregated) if aggregated is not None else None
+    fields["count_variance"] = parsed.var(axis=0).tolist() if len(parsed) else None
+    fields["score_variance"] = float(scores.var()) if len(parsed) else None
+    return fields
@@ -7,14 +7,32 @@ This file defines model configuration settings for use in `inference.py`.
 
 Each model is represented as an instance of the `OpenAIConfig` dataclass, 
 which specifies the following key parameters:
-    - base_url:       The endpoint for the model API or local inference server
+    - base_url:       The endpoint for the model API or local inference server,
+                      or a list of endpoints serving the same model (load-balanced)
     - api_key:        Authentication key for API access
     - model_name:     Name or path of the model to be used
     - temperature:    Sampling temperature for generation (default: 0)
     - max_tokens:     Maximum number of tokens to generate per request
     - request_timeout: Timeout for API requests in seconds
     - max_retry:      Maximum number of retry attempts for failed requests
-    - retry_sleep:    Sleep time (in seconds) between retries
+    - retry_sleep:    Base sleep time (in seconds) of the jittered exponential backoff between retries
+    - backoff_max:    Upper bound (in seconds) of the backoff between retries
+    - max_concurrency: Maximum number of requests kept in flight at once
+    - adaptive_concurrency: Halve the in-flight limit on throttling and grow it back on success (AIMD)
+    - requests_per_minute: Request budget per minute (unlimited if None)
+    - tokens_per_minute: Token budget per minute, prompt and completion (unlimited if None)
+    - cache_path:     Path of the on-disk response cache (disabled if None)
+    - cache_read_only: Only read from the cache, e.g. for replaying published results
+    - cache_max_entries: Maximum number of cached responses (least recently used are evicted)
+    - cache_max_age:  Maximum age (in seconds) of cached responses
+    - prefix_grouping: Send requests sharing a few-shot prefix together, after a warm-up request
+                      (for vLLM servers with automatic prefix caching)
+    - eject_after:    Consecutive failures after which one of several endpoints is taken out of rotation
+    - eject_cooldown: Seconds before an ejected endpoint is health-checked and re-admitted
+    - trace_path:     JSONL file receiving one metrics record per request (disabled if None)
+    - prometheus_path: File receiving the metrics in Prometheus text format (disabled if None)
+    - prompt_cost_per_1k / completion_cost_per_1k: Price per 1000 tokens, for the cost summary
+    - stream:         Stream responses and stop them as soon as their truncation rule is met
 
 The `MODEL_CONFIGS` dictionary contains pre-defined configurations for multiple LLMs, including OpenAI and locally hosted models such as Llama 2 and Mixtral. 
 
@@ -23,10 +41,11 @@ These configurations can be imported and used directly by the inference script.
 """
 
 from dataclasses import dataclass
+from typing import Optional, Union
 
 @dataclass
 class OpenAIConfig:
-    base_url: str
+    base_url: Union[str, list[str]]
     api_key: str
     model_name: str
     temperature: float = 0
@@ -34,6 +53,23 @@ class OpenAIConfig:
     request_timeout: int = 10
     max_retry: int = 5
     retry_sleep: int = 5
+    backoff_max: float = 60
+    max_concurrency: int = 8
+    adaptive_concurrency: bool = True
+    requests_per_minute: Optional[float] = None
+    tokens_per_minute: Optional[float] = None
+    cache_path: Optional[str] = None
+    cache_read_only: bool = False
+    cache_max_entries: Optional[int] = None
+    cache_max_age: Optional[float] = None
+    prefix_grouping: bool = False
+    eject_after: int = 3
+    eject_cooldown: float = 30
+    trace_path: Optional[str] = None
+    prometheus_path: Optional[str] = None
+    prompt_cost_per_1k: float = 0.0
+    completion_cost_per_1k: float = 0.0
+    stream: bool = False
 
 
 MODEL_CONFIGS: dict[str, OpenAIConfig] = {
@@ -57,6 +93,8 @@ MODEL_CONFIGS: dict[str, OpenAIConfig] = {
         temperature=0,
         max_tokens=256,
         request_timeout=40, # more inference time because of larger model
+        max_concurrency=32, # local vLLM server batches concurrent requests
+        prefix_grouping=True, # requires `--enable-prefix-caching` on the vLLM server
     ),
     
     "Mixtral-8x7b-Instruct": OpenAIConfig(
@@ -66,5 +104,7 @@ MODEL_CONFIGS: dict[str, OpenAIConfig] = {
         temperature=0,
         max_tokens=256,
         request_timeout=40,
+        max_concurrency=32,
+        prefix_grouping=True,
     ),
 }
\ No newline at end of file
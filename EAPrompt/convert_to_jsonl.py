@@ -0,0 +1,48 @@
+"""
+===============================================================================
+Convert Query/Response Trees to Line-delimited JSON
+===============================================================================
+
+This script converts existing `.json` query or response trees (e.g. the
+published `results/queries` and `results/responses` archives) into the
+line-delimited `.jsonl` format, keeping the folder structure.
+
+Each output file holds one record per line, so downstream consumers can
+process one segment at a time (`utils.iter_records`) instead of loading a
+whole system file into memory.
+
+With `compact = True`, `src_folder` is expected to be a query tree
+(`queries/<lang_pair>/<prompt_type>/`): each prompt type folder is converted
+into the compact template-based form of `query_store.py`, and every record is
+checked to round-trip exactly to its original message list.
+
+------------------------------------------------------------------------------
+Notes
+------------------------------------------------------------------------------
+- Files are converted one at a time; only one `.json` file is held in memory.
+- `.jsonl` outputs are accepted directly by `responses_generate.py`.
+
+===============================================================================
+"""
+
+import os
+
+from eaprompt import EAPrompt
+from query_store import compact_query_tree
+from utils import convert_json_tree
+
+# Parameters (edit if needed)
+src_folder = "./results/queries/"
+dst_folder = "./results/queries_jsonl/"
+compact = False # store the few-shot prefix once per prompt type (query trees only)
+
+if compact:
+    for lang_pair in sorted(os.listdir(src_folder)):
+        for prompt_type in sorted(os.listdir(os.path.join(src_folder, lang_pair))):
+            compact_query_tree(
+                os.path.join(src_folder, lang_pair, prompt_type),
+                os.path.join(dst_folder, lang_pair, prompt_type),
+                EAPrompt(prompt_type=prompt_type).get_template(),
+            )
+else:
+    convert_json_tree(src_folder, dst_folder)
@@ -0,0 +1,137 @@
+"""
+===============================================================================
+Rule-based Error Counting for EAPrompt Responses
+===============================================================================
+
+This module reads the number of major and minor errors directly from model
+responses, as a cheaper alternative to sending `INSTRUCTION_COUNT` to the
+model as a second request.
+
+------------------------------------------------------------------------------
+Supported Responses
+------------------------------------------------------------------------------
+1. **Itemized error responses** (`EXAMPLE_ERROR_ITEMIZED_*` style):
+
+       Major errors:
+       (1) “Sie” – Mistranslation
+       Minor errors:
+       (1) “sagten” – Mistranslation
+       (2) “wurden” – Grammar
+
+   Items may be numbered as "(1)", "1." or "1)", or bulleted with "-", "*" or
+   "•". A section reading "None" (or similar) counts as zero errors.
+   `count_itemized_errors` returns None whenever the structure is ambiguous
+   (missing heading, numbering gaps, prose instead of items, ...), so that the
+   caller can fall back to the LLM.
+
+2. **Count responses** (`"x, x"`): `parse_count` tolerantly extracts the first
+   comma-separated pair of numbers, e.g. from "2, 5", "2,5." or "Answer: 2, 5".
+
+3. **SINGLESTEP responses**: `parse_singlestep_response` reads the trailing
+   "x, x" line that follows the error list.
+
+===============================================================================
+"""
+
+import re
+from typing import Optional
+
+COUNT_PATTERN = re.compile(r"(\d+)\s*,\s*(\d+)")
+TRAILING_COUNT_PATTERN = re.compile(r"^\W*(\d+)\s*,\s*(\d+)\W*$")
+HEADING_PATTERN = re.compile(r"^\W*(major|minor)\s+errors?\s*:?\**\s*(.*)$", re.IGNORECASE)
+NUMBERED_ITEM_PATTERN = re.compile(r"^\s*\(?(\d+)[\).:]\s*\S")
+BULLET_ITEM_PATTERN = re.compile(r"^\s*[-*•]\s*\S")
+NONE_PATTERN = re.compile(r"^\W*(none|n/?a|no\b.*errors?.*|nothing.*)\W*$", re.IGNORECASE)
+
+def format_count(major: int, minor: int) -> str:
+    """Format counts the way the model is asked to answer `INSTRUCTION_COUNT`."""
+    return f"{major}, {minor}"
+
+def parse_count(text: Optional[str]) -> Optional[tuple[int, int]]:
+    """Extract (major, minor) from a "x, x" count response. Returns None if no count is found."""
+
+    if not text:
+        return None
+    match = COUNT_PATTERN.search(text)
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+def parse_singlestep_response(text: Optional[str]) -> Optional[tuple[int, int]]:
+    """Extract (major, minor) from the trailing "x, x" line of a SINGLESTEP response."""
+
+    if not text:
+        return None
+    lines = [line for line in text.strip().splitlines() if line.strip()]
+    if not lines:
+        return None
+    match = TRAILING_COUNT_PATTERN.match(lines[-1])
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+def _count_section(inline: str, lines: list[str]) -> Optional[int]:
+    """Count the items of one "Major errors:" / "Minor errors:" section, or None if ambiguous."""
+
+    numbers, bullets = [], 0
+    leading_text = [inline] if inline.strip() else []
+    for line in lines:
+        if not line.strip():
+            continue
+        numbered = NUMBERED_ITEM_PATTERN.match(line)
+        if numbered:
+            numbers.append(int(numbered.group(1)))
+        elif BULLET_ITEM_PATTERN.match(line):
+            bullets += 1
+        elif not numbers and not bullets:
+            leading_text.append(line) # text before the first item
+
+    if numbers and bullets:
+        return None
+    if numbers:
+        return len(numbers) if numbers == list(range(1, len(numbers) + 1)) and not leading_text else None
+    if bullets:
+        return bullets if not leading_text else None
+    if len(leading_text) == 1 and NONE_PATTERN.match(leading_text[0]):
+        return 0
+    return None
+
+def count_itemized_errors(error_response: Optional[str]) -> Optional[tuple[int, int]]:
+    """
+    Count the items listed under the "Major errors:" and "Minor errors:" headings.
+    Returns (major, minor), or None when the response cannot be parsed confidently.
+    """
+
+    if not error_response:
+        return None
+
+    sections, current = {}, None
+    for line in error_response.strip().splitlines():
+        heading = HEADING_PATTERN.match(line)
+        if heading:
+            current = heading.group(1).lower()
+            if current in sections: # repeated heading
+                return None
+            sections[current] = (heading.group(2), [])
+        elif current is not None:
+            sections[current][1].append(line)
+
+    if set(sections) != {"major", "minor"}:
+        return None
+
+    # a SINGLESTEP response may end with the "x, x" line; it is not an error item
+    minor_inline, minor_lines = sections["minor"]
+    while minor_lines and (not minor_lines[-1].strip() or TRAILING_COUNT_PATTERN.match(minor_lines[-1])):
+        minor_lines = minor_lines[:-1]
+
+    major = _count_section(*sections["major"])
+    minor = _count_section(minor_inline, minor_lines)
+    if major is None or minor is None:
+        return None
+    return major, minor
+
+def extract_count(error_response: Optional[str]) -> Optional[str]:
+    """Return the "x, x" count for an itemized error response, or None if the LLM is needed."""
+
+    counts = count_itemized_errors(error_response)
+    return format_count(*counts) if counts is not None else None
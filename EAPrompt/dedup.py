@@ -0,0 +1,78 @@
+"""
+===============================================================================
+Cross-system Query Deduplication
+===============================================================================
+
+Many MT systems produce identical translations for short segments, so the
+same (src, tgt, ref) query appears in several system files of a prompt type.
+`QueryDeduplicator` makes `responses_generate.py` send one request per unique
+query and fan the responses out to every record that needs them.
+
+------------------------------------------------------------------------------
+Usage
+------------------------------------------------------------------------------
+1. `scan(queries)` is called once over every query of the prompt type (all
+   system files), counting the occurrences of each query hash.
+2. While generating, `lookup(key, fields)` returns the responses of a query
+   already answered for another record, and `store(key, fields)` keeps them
+   for later occurrences.
+3. `consume(key, shared)` is called each time an occurrence is served;
+   responses are released once all occurrences of a query have been served,
+   so only duplicated queries that are still pending are kept in memory.
+
+At temperature 0, the output is the same as without deduplication. At higher
+temperatures duplicates would share one sample, so `responses_generate.py`
+only deduplicates at temperature 0.
+
+===============================================================================
+"""
+
+import hashlib
+import json
+from collections import Counter
+from typing import Iterable, Optional
+
+def query_key(query: list[dict[str, str]]) -> str:
+    """Stable hash of a message list."""
+    serialized = json.dumps(query, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+class QueryDeduplicator:
+
+    def __init__(self) -> None:
+        self.remaining = Counter() # occurrences not served yet, per query hash
+        self.memo = {} # responses of duplicated queries, per query hash
+        self.total = 0
+        self.unique = 0
+        self.served = 0 # occurrences served from another record's responses
+
+    def scan(self, queries: Iterable[list[dict[str, str]]]) -> None:
+        for query in queries:
+            self.remaining[query_key(query)] += 1
+            self.total += 1
+        self.unique = len(self.remaining)
+
+    def lookup(self, key: str, fields: list[str]) -> Optional[dict]:
+        """Responses for `fields` if this query was already answered, else None."""
+        responses = self.memo.get(key)
+        if responses is None or any(field not in responses for field in fields):
+            return None
+        return {field: responses[field] for field in fields}
+
+    def store(self, key: str, fields: dict) -> None:
+        if self.remaining[key] > 1:
+            self.memo.setdefault(key, {}).update(fields)
+
+    def consume(self, key: str, shared: bool = False) -> None:
+        """Mark one occurrence as served; `shared` if it reused another record's responses."""
+        self.served += shared
+        self.remaining[key] -= 1
+        if self.remaining[key] <= 0:
+            self.memo.pop(key, None)
+            del self.remaining[key]
+
+    def report(self) -> str:
+        if not self.total:
+            return "Dedup: no queries."
+        return (f"Dedup: {self.total} queries, {self.unique} unique "
+                f"(dedup ratio {1 - self.unique / self.total:.1%}), {self.served} served from duplicates so far.")
@@ -21,17 +21,35 @@ Structure Overview
        - DEMO: demonstration type ("DETAILED" or "ITEMIZED")
        - IS_REF: whether reference translation is used ("SRC" or "REF")
 
-3. **EAPrompt Class**
+3. **compile_prompt_type(prompt_type)**
+   Validates a prompt type once (raising ValueError if it is invalid) and
+   prebuilds its constant parts (`CompiledPrompt`): the few-shot prefix
+   messages, the evaluation input template and the instruction. Results are
+   cached per prompt type, so per-segment work is limited to formatting
+   `EVALUATION_INPUT_*`.
+
+4. **EAPrompt Class**
    - `generate_query(eval_input)`:
        Generates a single formatted query for one evaluation sample.
    - `generate_queries_batch(eval_inputs)`:
        Generates multiple queries for batch evaluation.
+   - `iter_queries(eval_inputs)`:
+       Lazily generates queries from any iterable, one at a time.
+   - `get_template()`:
+       Exports the segment-independent parts of the prompt (few-shot prefix,
+       input template and instruction) for compact query storage.
    - Internal helpers `_set_prompt_error` and `_set_prompt_count`:
-       Build prompts for specific evaluation modes.
+       Build prompts for specific evaluation modes from the compiled prompt type.
 
 ===============================================================================
 """
 
+import hashlib
+import json
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Iterator
+
 import constants.context
 
 from utils import parse_type
@@ -45,10 +63,78 @@ PROMPT_TYPE_CONFIGS = {
     "IS_REF": ["SRC", "REF"], # reference-free (SRC) or reference-based (REF)
 }
 
+@dataclass(frozen=True)
+class CompiledPrompt:
+    """
+    The segment-independent parts of a prompt type, built once by `compile_prompt_type`:
+        - prefix: the few-shot (user, assistant) example messages, shared by every query
+        - input_template: the `EVALUATION_INPUT_*` template formatted with each segment
+        - instruction: the instruction appended after the formatted input
+    For "COUNT", prefix and input_template are empty and instruction is `INSTRUCTION_COUNT`.
+    """
+    prompt_type: str
+    prefix: tuple[dict[str, str], ...]
+    input_template: str
+    instruction: str
+    version: str
+
+@lru_cache(maxsize=None)
+def compile_prompt_type(prompt_type: str) -> CompiledPrompt:
+    """Validate a prompt type and prebuild its constant parts. Raises ValueError for invalid types."""
+    
+    if "COUNT" in prompt_type:
+        return CompiledPrompt(prompt_type, (), "", CONTEXT_VAR_MAP["INSTRUCTION_COUNT"], "")
+    
+    is_valid, prompt_info = parse_type(type_configs=PROMPT_TYPE_CONFIGS, prompt_type_str=prompt_type)
+    if is_valid is False:
+        raise ValueError(f"Prompt type {prompt_type} is not valid!")
+    
+    _step, _lang, _demo, _is_ref = prompt_info["STEP"], prompt_info["LANG"], prompt_info["DEMO"], prompt_info["IS_REF"]
+    
+    if _step == "ERROR":
+        
+        example_user_part1 = CONTEXT_VAR_MAP[f"EXAMPLE_{_lang}_{_is_ref}"].strip()
+        example_user_part2 = CONTEXT_VAR_MAP[f"INSTRUCTION_ERROR_{_is_ref}"].strip()
+        example_assistant = CONTEXT_VAR_MAP[f"EXAMPLE_ERROR_{_demo}_{_lang}"].strip()
+        instruction = CONTEXT_VAR_MAP[f"INSTRUCTION_ERROR_{_is_ref}"].strip()
+        
+    elif _step == "SINGLESTEP": # combine identifying and counting errors
+        
+        example_user_part1 = CONTEXT_VAR_MAP[f"EXAMPLE_{_lang}_{_is_ref}"].strip()
+        example_user_part2 = CONTEXT_VAR_MAP[f"INSTRUCTION_SINGLESTEP_{_is_ref}"].strip()
+        example_assistant_part1 = CONTEXT_VAR_MAP[f"EXAMPLE_ERROR_{_demo}_{_lang}"].strip()
+        example_assistant_part2 = CONTEXT_VAR_MAP[f"EXAMPLE_COUNT_{_lang}"].strip()
+        example_assistant = example_assistant_part1 + "\n" + example_assistant_part2
+        instruction = CONTEXT_VAR_MAP[f"INSTRUCTION_SINGLESTEP_{_is_ref}"].strip()
+        
+    prefix = (
+        {"role": "user", "content": example_user_part1 + "\n" + example_user_part2},
+        {"role": "assistant", "content": example_assistant},
+    )
+    input_template = CONTEXT_VAR_MAP[f"EVALUATION_INPUT_{_is_ref}"]
+    
+    content = {
+        "prompt_type": prompt_type,
+        "prefix": list(prefix),
+        "input_template": input_template,
+        "instruction": instruction,
+    }
+    version = hashlib.sha256(json.dumps(content, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+    
+    return CompiledPrompt(prompt_type, prefix, input_template, instruction, version)
+
 class EAPrompt:
     def __init__(self, prompt_type: str="ERROR_ZHEN_ITEMIZED_REF") -> None:    
         self.prompt_type = prompt_type
         
+    @property
+    def prompt_type(self) -> str:
+        return self._compiled.prompt_type
+    
+    @prompt_type.setter
+    def prompt_type(self, prompt_type: str) -> None:
+        self._compiled = compile_prompt_type(prompt_type) # fails fast on invalid prompt types
+        
     def set_prompt_type(self, prompt_type: str) -> None:
         self.prompt_type = prompt_type
         
@@ -60,12 +146,13 @@ class EAPrompt:
 
         Returns:
             query in Openai API format.
+            The few-shot example messages are shared between queries and must not be modified in place.
         """
         
-        if "COUNT" in self.prompt_type:
-            return self._set_prompt_count(eval_input)
+        if self._compiled.input_template:
+            return self._set_prompt_error(self._compiled, eval_input)
         else:
-            return self._set_prompt_error(self.prompt_type, eval_input)
+            return self._set_prompt_count(eval_input)
         
     def generate_queries_batch(self, eval_inputs) -> list[list[dict[str, str]]]:
         """
@@ -74,15 +161,42 @@ class EAPrompt:
         """
         return [self.generate_query(_eval_input) for _eval_input in eval_inputs]
     
-    def _set_prompt_error(self, prompt_type: str, eval_input: dict[str, str]) -> list[dict[str, str]]:
+    def iter_queries(self, eval_inputs) -> Iterator[list[dict[str, str]]]:
+        """
+        Lazily generate queries from any iterable of eval_inputs (e.g. a streaming file reader).
+        Yield messages one at a time, so nothing is materialized.
+        """
+        for _eval_input in eval_inputs:
+            yield self.generate_query(_eval_input)
+    
+    def get_template(self) -> dict:
+        """
+        Export the segment-independent parts of the current prompt type, so that query files
+        can store them once and only keep `inputs` per record (see `query_store.py`).
+        The template is identified by `version`, a hash of its content.
+        """
+        
+        if not self._compiled.input_template:
+            raise ValueError(f"Prompt type {self.prompt_type} has no query template!")
+        
+        return {
+            "prompt_type": self._compiled.prompt_type,
+            "prefix": list(self._compiled.prefix),
+            "input_template": self._compiled.input_template,
+            "instruction": self._compiled.instruction,
+            "version": self._compiled.version,
+        }
+    
+    @staticmethod
+    def _set_prompt_error(compiled: CompiledPrompt, eval_input: dict[str, str]) -> list[dict[str, str]]:
     
         """
-        Merge the prompt context according to the given prompt_type.
+        Merge the prompt context of a compiled prompt type with one evaluation input.
         "COUNT" is not included here; it is handled separately in the "set_prompt_count" function.
         
-        prompt_type: 
-            prompt_type should be in the following format: "{STEP}_{LANG}_{DEMO}_{IS_REF}". 
-            For example, "ERROR_ZHEN_ITEMIZED_REF".
+        compiled: 
+            the output of `compile_prompt_type` for a prompt type in the following format: 
+            "{STEP}_{LANG}_{DEMO}_{IS_REF}". For example, "ERROR_ZHEN_ITEMIZED_REF".
         
         eval_input: {
             "src": "xxx",
@@ -91,51 +205,17 @@ class EAPrompt:
         }
         """
         
-        if "COUNT" in prompt_type:
-            assert ValueError("Type 'COUNT' is not included in this function!")
-            return
-                
-        is_valid, prompt_info = parse_type(type_configs=PROMPT_TYPE_CONFIGS, prompt_type_str=prompt_type)
-        
-        if is_valid is False:
-            assert ValueError(f"Prompt type {prompt_type} is not valid!")
-            return
+        user_part1 = compiled.input_template.format(**eval_input).strip()
         
-        _step, _lang, _demo, _is_ref = prompt_info["STEP"], prompt_info["LANG"], prompt_info["DEMO"], prompt_info["IS_REF"]
-        
-        if _step == "ERROR":
-            
-            example_user_part1 = CONTEXT_VAR_MAP[f"EXAMPLE_{_lang}_{_is_ref}"].strip()
-            example_user_part2 = CONTEXT_VAR_MAP[f"INSTRUCTION_ERROR_{_is_ref}"].strip()
-            example_assistant = CONTEXT_VAR_MAP[f"EXAMPLE_ERROR_{_demo}_{_lang}"].strip()
-            user_part1 = CONTEXT_VAR_MAP[f"EVALUATION_INPUT_{_is_ref}"].format(**eval_input).strip()
-            user_part2 = CONTEXT_VAR_MAP[f"INSTRUCTION_ERROR_{_is_ref}"].strip()
-            
-            return [
-                {"role": "user", "content": example_user_part1 + "\n" + example_user_part2},
-                {"role": "assistant", "content": example_assistant},
-                {"role": "user", "content": user_part1 + "\n" + user_part2},
-            ]
-            
-        elif _step == "SINGLESTEP": # combine identifying and counting errors
-            
-            example_user_part1 = CONTEXT_VAR_MAP[f"EXAMPLE_{_lang}_{_is_ref}"].strip()
-            example_user_part2 = CONTEXT_VAR_MAP[f"INSTRUCTION_SINGLESTEP_{_is_ref}"].strip()
-            example_assistant_part1 = CONTEXT_VAR_MAP[f"EXAMPLE_ERROR_{_demo}_{_lang}"].strip()
-            example_assistant_part2 = CONTEXT_VAR_MAP[f"EXAMPLE_COUNT_{_lang}"].strip()
-            user_part1 = CONTEXT_VAR_MAP[f"EVALUATION_INPUT_{_is_ref}"].format(**eval_input).strip()
-            user_part2 = CONTEXT_VAR_MAP[f"INSTRUCTION_SINGLESTEP_{_is_ref}"].strip()
-            
-            return [
-                {"role": "user", "content": example_user_part1 + "\n" + example_user_part2},
-                {"role": "assistant", "content": example_assistant_part1 + "\n" + example_assistant_part2},
-                {"role": "user", "content": user_part1 + "\n" + user_part2},
-            ]
+        return [
+            *compiled.prefix,
+            {"role": "user", "content": user_part1 + "\n" + compiled.instruction},
+        ]
             
     def _set_prompt_count(self, error_text: str) -> list[dict[str, str]]:
     
         return [
-            {"role": "user", "content": f"{error_text}\n{CONTEXT_VAR_MAP['INSTRUCTION_COUNT']}"}
+            {"role": "user", "content": f"{error_text}\n{self._compiled.instruction}"}
         ]
 
 if __name__ == '__main__':
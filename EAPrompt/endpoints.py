@@ -0,0 +1,181 @@
+"""
+===============================================================================
+Multi-endpoint Load Balancing
+===============================================================================
+
+A model served by several replicas (e.g. one vLLM server per node) is
+configured with a list of URLs as `base_url` in its `OpenAIConfig`.
+`EndpointPool` spreads the requests of an `InferenceEngine` over them.
+
+------------------------------------------------------------------------------
+Behavior
+------------------------------------------------------------------------------
+1. **Routing**
+   - Each request goes to the admitted endpoint with the fewest outstanding
+     requests (ties go to the endpoint with the fewest completed requests).
+
+2. **Health Checks**
+   - When the pool is first opened, every endpoint is probed with
+     `GET /models`; endpoints that do not answer are ejected.
+   - An endpoint is also ejected after `eject_after` consecutive connection,
+     timeout or server errors. Rate limits do not eject an endpoint.
+   - Ejected endpoints are probed again after `eject_cooldown` seconds, and
+     put back in rotation once they answer.
+
+3. **Lifetime**
+   - The pool belongs to its `InferenceEngine` and keeps its ejections and
+     counters from one batch to the next. Its clients are bound to an event
+     loop: `open()` creates them for the running loop (the synchronous engine
+     API runs each batch in a new loop), and `aclose()` closes them.
+
+4. **Reporting**
+   - `report()` lists the requests, failures and throughput of each endpoint
+     since the pool was first opened.
+
+With a single endpoint, nothing is ever ejected: failures are only retried.
+
+===============================================================================
+"""
+
+import asyncio
+import time
+from typing import Optional
+
+from openai import AsyncOpenAI
+
+from constants.model_configs import OpenAIConfig
+
+HEALTH_CHECK_TIMEOUT = 5.0 # seconds
+EJECTING_ERRORS = {"connection", "timeout", "server"}
+
+def endpoint_urls(cfg: OpenAIConfig) -> list[str]:
+    return [cfg.base_url] if isinstance(cfg.base_url, str) else list(cfg.base_url)
+
+class Endpoint:
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self.client: Optional[AsyncOpenAI] = None # bound to the event loop of the pool
+        self.outstanding = 0
+        self.completed = 0
+        self.failed = 0
+        self.consecutive_failures = 0
+        self.ejected_until: Optional[float] = None # None while admitted
+
+class EndpointPool:
+
+    def __init__(self, cfg: OpenAIConfig) -> None:
+        self.cfg = cfg
+        self.endpoints = [Endpoint(url) for url in endpoint_urls(cfg)]
+        self.started: Optional[float] = None
+        self._probing = set()
+        self._loop = None
+
+    async def open(self) -> "EndpointPool":
+        """Create the clients for the running event loop if needed; health-check every endpoint the first time."""
+
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return self
+        for endpoint in self.endpoints:
+            endpoint.client = AsyncOpenAI(
+                api_key=self.cfg.api_key,
+                base_url=endpoint.url,
+                timeout=self.cfg.request_timeout,
+                max_retries=0, # retries are handled by the `RateLimiter`
+            )
+        self._loop = loop
+        self._probing.clear() # probes still running in a previous loop were dropped with it
+        if self.started is None:
+            self.started = time.monotonic()
+            if len(self.endpoints) > 1:
+                await asyncio.gather(*(self._probe(endpoint) for endpoint in self.endpoints))
+        return self
+
+    async def aclose(self) -> None:
+        """Close the clients; the health state is kept for the next `open()`."""
+
+        if self._loop is None:
+            return
+        if self._loop is asyncio.get_running_loop(): # clients of a finished loop can only be dropped
+            for endpoint in self.endpoints:
+                await endpoint.client.close()
+        for endpoint in self.endpoints:
+            endpoint.client = None
+        self._loop = None
+
+    async def _probe(self, endpoint: Endpoint) -> bool:
+        """Health-check one endpoint, admitting or ejecting it accordingly."""
+
+        self._probing.add(endpoint.url)
+        try:
+            await asyncio.wait_for(endpoint.client.models.list(), HEALTH_CHECK_TIMEOUT)
+            healthy = True
+        except Exception as e:
+            print(f"Health check failed for {endpoint.url}: {e}")
+            healthy = False
+        finally:
+            self._probing.discard(endpoint.url)
+
+        if healthy:
+            if endpoint.ejected_until is not None:
+                print(f"Endpoint {endpoint.url} is back in rotation.")
+            endpoint.ejected_until = None
+            endpoint.consecutive_failures = 0
+        else:
+            self._eject(endpoint)
+        return healthy
+
+    def _eject(self, endpoint: Endpoint) -> None:
+        if endpoint.ejected_until is None:
+            print(f"Endpoint {endpoint.url} ejected for {self.cfg.eject_cooldown}s.")
+        endpoint.ejected_until = time.monotonic() + self.cfg.eject_cooldown
+
+    async def acquire(self) -> Endpoint:
+        """Pick the admitted endpoint with the fewest outstanding requests, waiting if all are ejected."""
+
+        while True:
+            now = time.monotonic()
+            for endpoint in self.endpoints:
+                if (endpoint.ejected_until is not None and endpoint.ejected_until <= now
+                        and endpoint.url not in self._probing):
+                    asyncio.ensure_future(self._probe(endpoint))
+
+            admitted = [endpoint for endpoint in self.endpoints if endpoint.ejected_until is None]
+            if admitted:
+                endpoint = min(admitted, key=lambda endpoint: (endpoint.outstanding, endpoint.completed))
+                endpoint.outstanding += 1
+                return endpoint
+
+            next_probe = min(endpoint.ejected_until for endpoint in self.endpoints)
+            await asyncio.sleep(max(0.1, next_probe - now))
+
+    def release(self, endpoint: Endpoint, error_kind: Optional[str] = None) -> None:
+        """
+        Record the outcome of a request sent to `endpoint` (`error_kind` is None on success,
+        "cancelled" for a request abandoned without an answer).
+        """
+
+        endpoint.outstanding -= 1
+        if error_kind == "cancelled":
+            return
+        if error_kind is None:
+            endpoint.completed += 1
+            endpoint.consecutive_failures = 0
+            return
+
+        endpoint.failed += 1
+        if error_kind in EJECTING_ERRORS and len(self.endpoints) > 1:
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= self.cfg.eject_after:
+                self._eject(endpoint)
+
+    def report(self) -> str:
+        elapsed = max(time.monotonic() - (self.started or time.monotonic()), 1e-9)
+        lines = [
+            f"  {endpoint.url}: {endpoint.completed} requests, {endpoint.failed} failures, "
+            f"{endpoint.completed / elapsed:.2f} req/s"
+            + (" (ejected)" if endpoint.ejected_until is not None else "")
+            for endpoint in self.endpoints
+        ]
+        return "Endpoints:\n" + "\n".join(lines)
@@ -14,14 +14,67 @@ Key Features
    - Uses configuration objects defined in `constants.model_configs`
      via the `OpenAIConfig` dataclass.
    - Supports both OpenAI API endpoints and custom local inference servers.
+   - `base_url` may be a list of replicas of the same model: requests are routed
+     to the replica with the fewest outstanding requests, and failing replicas
+     are ejected and health-checked until they recover (see `endpoints.py`).
+     The pool is kept by the engine, so ejections carry over between batches;
+     `close()` (or `await aclose()`) releases its connections.
+     Per-endpoint throughput is reported after each batch.
 
 2. **Batch Inference**
    - `infer_batch(queries_list)`: accepts a list of conversations (each a list of 
      message dictionaries) and returns the model responses in order.
+   - `ainfer_batch(queries_list)`: the asyncio implementation behind `infer_batch`.
+     Requests are sent concurrently through `AsyncOpenAI`, with at most
+     `max_concurrency` requests in flight, and responses are returned in input order.
+   - `infer_chain(queries_list, followups)`: pipelined multi-stage inference
+     (e.g. ERROR -> COUNT), where each item's next request is submitted as soon
+     as its previous response arrives. All stages share one concurrency pool.
    - Automatically retries failed requests up to a user-defined limit (`max_retry`),
-     with configurable sleep intervals (`retry_sleep`).
+     with jittered exponential backoff starting from `retry_sleep`.
 
-3. **Robustness and Monitoring**
+3. **Response Cache**
+   - If `cache_path` is set in the model configuration, every request is first
+     looked up in a persistent `ResponseCache` (see `cache.py`), and only misses
+     are sent over the network.
+
+4. **Prefix-cache-friendly Scheduling**
+   - If `prefix_grouping` is set in the model configuration (vLLM servers with
+     automatic prefix caching), first-stage requests are grouped by their shared
+     few-shot prefix, and the first request of each group is sent alone before
+     the rest of its group (see `scheduling.py`). The expected shared-prefix
+     token ratio is reported. Responses are still returned in input order.
+
+5. **Metrics and Tracing**
+   - Every request is recorded by a `MetricsRecorder` (see `metrics.py`):
+     latency, queue time, retries, error classes, token usage and the caller's
+     tags (e.g. system and segment). A summary (p50/p95/p99 latency, throughput,
+     cost) is printed after each batch; a JSONL trace and a Prometheus text
+     export are written when `trace_path` / `prometheus_path` are configured.
+
+6. **Truncation and Streaming**
+   - A truncation rule per stage (see `truncation.py`) cuts the rambling tail of
+     responses. With `stream` set in the model configuration, responses are
+     streamed and the request is stopped as soon as the rule can tell where
+     the response ends, saving generation time and output tokens; the result
+     is identical to truncating the complete response.
+
+7. **Self-consistency**
+   - With `samples > 1`, the first-stage request of each item asks for
+     `samples` completions at once (the OpenAI `n` parameter), so the few-shot
+     prefix is sent and processed once; each sample then goes through the
+     later stages on its own (e.g. one COUNT request per sampled ERROR
+     response). Responses become lists of samples, to be aggregated with
+     `consistency.py`. Multi-sample requests are not streamed.
+
+8. **Rate Limiting**
+   - Requests go through a `RateLimiter` (see `ratelimit.py`): requests/min and
+     tokens/min token buckets, `Retry-After` support, and adaptive (AIMD)
+     concurrency that backs off on HTTP 429 and recovers on success. The
+     limiter belongs to the engine, so its state carries over between batches.
+   - Client errors (e.g. HTTP 400) are not retried.
+
+9. **Robustness and Monitoring**
    - Includes timeout handling per request.
    - Displays progress via `tqdm` progress bars.
    - Logs and gracefully handles transient connection or rate-limit errors.
@@ -29,10 +82,17 @@ Key Features
 ===============================================================================
 """
 
+import asyncio
 import time
 
-from openai import OpenAI
+from typing import Callable, Optional, Sequence, Union
+
 from tqdm import tqdm
+from cache import ResponseCache, request_key
+from endpoints import EndpointPool
+from metrics import MetricsRecorder, RequestRecord
+from ratelimit import RateLimiter, classify_error, estimate_tokens, retry_after
+from scheduling import plan_prefix_schedule
 from constants.model_configs import OpenAIConfig, MODEL_CONFIGS
 
 class InferenceEngine:
@@ -43,51 +103,369 @@ class InferenceEngine:
         self.model_name = model_name
         self.cfg: OpenAIConfig = MODEL_CONFIGS[self.model_name]
         
-        self.client = OpenAI(
-            api_key=self.cfg.api_key,
-            base_url=self.cfg.base_url,
-            timeout=self.cfg.request_timeout,
-        )
-            
-
-    def infer_batch(
+        self.cache = None
+        if self.cfg.cache_path is not None:
+            self.cache = ResponseCache(
+                self.cfg.cache_path,
+                read_only=self.cfg.cache_read_only,
+                max_entries=self.cfg.cache_max_entries,
+                max_age=self.cfg.cache_max_age,
+            )
+        
+        self.metrics = MetricsRecorder(self.cfg)
+        self.limiter = RateLimiter(self.cfg) # shared by all batches, see `ratelimit.py`
+        self.pool = EndpointPool(self.cfg) # opened by the first batch, see `endpoints.py`
+        
+    async def _ainfer_one(
         self,
-        queries_list: list[list[dict[str, str]]]):
+        query_message: list[dict[str, str]],
+        tags: Optional[dict] = None,
+        truncation=None,
+        n: int = 1) -> Union[str, list[str]]:
         
         """
-        Batch inference:
-        - messages_list: each element is either a conversation (list of messages) 
-        or a single user string
-        - Returns: the model response (string) for each conversation
+        Send one conversation through `self.limiter` and `self.pool`, retrying retryable failures.
+        The concurrency slot is released while sleeping between retries.
+        A `RequestRecord` carrying `tags` is passed to `self.metrics`.
+        The response is cut by `truncation` (see `truncation.py`), while streaming if `cfg.stream` is set.
+        With `n > 1`, `n` completions are requested at once and returned as a list.
         """
         
-        outputs = []
-
-        for query_message in tqdm(queries_list, desc="LLM Inference"):
-            retry_count = 0
-            while True:
+        record = RequestRecord(tags=tags or {}, submitted_at=time.time())
+        submitted = time.monotonic()
+        
+        if self.cache is not None:
+            cache_key = request_key(
+                model=self.cfg.model_name,
+                messages=query_message,
+                temperature=self.cfg.temperature,
+                max_tokens=self.cfg.max_tokens,
+                **({"truncation": truncation.key} if truncation is not None else {}),
+                **({"n": n} if n > 1 else {}),
+            )
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                record.status = "cached"
+                self.metrics.record(record)
+                return cached
+        
+        estimated_tokens = estimate_tokens(query_message, self.cfg.max_tokens * n)
+        retry_count = 0
+        while True:
+            waiting = time.monotonic()
+            await self.limiter.wait(estimated_tokens)
+            async with self.limiter.concurrency:
+                endpoint = await self.pool.acquire()
+                sent = time.monotonic()
+                record.queue_time += sent - waiting
+                record.endpoint = endpoint.url
                 try:
-                    response = self.client.chat.completions.create(
-                        model=self.cfg.model_name,
-                        messages=query_message,
-                        temperature=self.cfg.temperature,
-                        max_tokens=self.cfg.max_tokens
-                    )
-
+                    if self.cfg.stream and truncation is not None and n == 1:
+                        content, record.completion_tokens, record.early_stop = await self._astream_truncated(
+                            endpoint.client, query_message, truncation)
+                        record.prompt_tokens = estimated_tokens - self.cfg.max_tokens # no usage when stopped early
+                        used_tokens = record.prompt_tokens + record.completion_tokens
+                    else:
+                        response = await endpoint.client.chat.completions.create(
+                            model=self.cfg.model_name,
+                            messages=query_message,
+                            temperature=self.cfg.temperature,
+                            max_tokens=self.cfg.max_tokens,
+                            **({"n": n} if n > 1 else {}),
+                        )
+                        if n > 1:
+                            choices = sorted(response.choices, key=lambda choice: choice.index)
+                            content = [choice.message.content for choice in choices]
+                            if truncation is not None:
+                                content = [truncation.apply(sample) for sample in content]
+                        else:
+                            content = response.choices[0].message.content
+                            if truncation is not None:
+                                content = truncation.apply(content)
+                        record.prompt_tokens = getattr(response.usage, "prompt_tokens", None) or 0
+                        record.completion_tokens = getattr(response.usage, "completion_tokens", None) or 0
+                        used_tokens = getattr(response.usage, "total_tokens", None)
+                    record.latency = time.monotonic() - sent
+                    self.pool.release(endpoint)
+                    self.limiter.on_success(estimated_tokens, used_tokens)
                     break
                 
                 except Exception as e:
-                    print(e)
-                    print("retry.")
-                    retry_count += 1
-                    if retry_count >= self.cfg.max_retry:
-                        raise RuntimeError(f"Request failed after {self.cfg.max_retry} retries: {e}")
-                    time.sleep(self.cfg.retry_sleep)
+                    error = e
+                    error_kind = classify_error(error)
+                    record.latency = time.monotonic() - sent
+                    record.errors.append(error_kind)
+                    self.pool.release(endpoint, error_kind)
+                
+                except asyncio.CancelledError:
+                    self.pool.release(endpoint, "cancelled")
+                    raise
+            
+            print(f"{error_kind}: {error}")
+            retry_count += 1
+            if error_kind == "client" or retry_count >= self.cfg.max_retry:
+                record.status = "failed"
+                record.retries = retry_count - 1
+                record.total_time = time.monotonic() - submitted
+                self.metrics.record(record)
+                if error_kind == "client":
+                    raise RuntimeError(f"Request rejected ({error_kind}), not retried: {error}")
+                raise RuntimeError(f"Request failed after {self.cfg.max_retry} retries: {error}")
+            delay = self.limiter.on_error(error_kind, retry_count, retry_after(error))
+            print(f"retry in {delay:.1f}s.")
+            await asyncio.sleep(delay)
+        
+        record.retries = retry_count
+        record.total_time = time.monotonic() - submitted
+        self.metrics.record(record)
+        
+        if self.cache is not None:
+            self.cache.put(cache_key, content)
+        return content
 
-            outputs.append(response.choices[0].message.content)
+    async def _astream_truncated(self, client, query_message: list[dict[str, str]], truncation) -> tuple[str, int, bool]:
+        """
+        Stream a completion and close it as soon as `truncation` can tell where the response ends.
+        Returns the truncated response, the number of chunks received (about one token each)
+        and whether the request was stopped early.
+        """
+        
+        stream = await client.chat.completions.create(
+            model=self.cfg.model_name,
+            messages=query_message,
+            temperature=self.cfg.temperature,
+            max_tokens=self.cfg.max_tokens,
+            stream=True,
+        )
+        text, chunks = "", 0
+        try:
+            async for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                text += chunk.choices[0].delta.content
+                chunks += 1
+                position = truncation.cut(text)
+                if position is not None:
+                    return text[:position], chunks, True
+        finally:
+            await stream.close() # stops generation on the server when stopped early
+        return truncation.apply(text), chunks, False
+
+    async def ainfer_chain(
+        self,
+        queries_list: list[list[dict[str, str]]],
+        followups: Sequence[Callable[[str], list[dict[str, str]]]] = (),
+        max_concurrency: int = None,
+        on_result: Optional[Callable[[int, int, str], None]] = None,
+        tags: Optional[Sequence[dict]] = None,
+        truncations: Sequence = (),
+        samples: int = 1,
+        return_exceptions: bool = False) -> list[list[str]]:
+        
+        """
+        Asynchronous pipelined inference over several dependent stages:
+        - queries_list: the first-stage conversation of each item
+        - followups: one function per later stage, building the next conversation
+          from the previous stage's response (e.g. ERROR -> COUNT)
+        - max_concurrency: maximum number of requests in flight, shared by all stages
+        - on_result: called as `on_result(index, stage, response)` as soon as each response arrives
+        - tags: per-item fields added to the request metrics (e.g. system and segment), with the stage
+        - truncations: one truncation rule (or None) per stage, see `truncation.py`
+        - samples: completions sampled by the first-stage request of each item; each sample goes
+          through the later stages on its own, and every response is then a list of `samples` strings
+        - return_exceptions: an item whose request fails for good gets its `RuntimeError` as output,
+          and the other items go on; otherwise the error is raised and the remaining requests are cancelled
+        - Returns: for each item, the list of its responses (one per stage), in input order
+        
+        Each item moves to its next stage as soon as its previous response arrives,
+        so there is no barrier between stages.
+        """
+        
+        self.limiter.concurrency.batch_cap = max_concurrency
+        outputs = [None] * len(queries_list)
+        if samples > 1 and self.cfg.temperature == 0:
+            print(f"Warning: {samples} samples requested at temperature 0, they will likely be identical.")
+        
+        schedule = None
+        if self.cfg.prefix_grouping and len(queries_list) > 1:
+            schedule = plan_prefix_schedule(queries_list)
+            print(schedule.report())
+        
+        await self.pool.open() # clients for this event loop; ejections carry over from earlier batches
+        progress = tqdm(total=len(queries_list) * (1 + len(followups)), desc="LLM Inference")
+        
+        # set once the first request of a prefix group has been answered (prefix cached)
+        warmed = {} if schedule is None else {leader: asyncio.Event() for leader in set(schedule.leader_of)}
+        
+        async def _stages(idx: int, query_message: list[dict[str, str]]) -> list:
+            responses = []
+            for stage in range(1 + len(followups)):
+                item_tags = {**(tags[idx] if tags is not None else {}), "stage": stage}
+                truncation = truncations[stage] if stage < len(truncations) else None
+                if stage == 0:
+                    if schedule is not None and schedule.leader_of[idx] != idx:
+                        await warmed[schedule.leader_of[idx]].wait()
+                    response = await self._ainfer_one(query_message, item_tags, truncation, n=samples)
+                elif samples > 1: # one request per sample
+                    response = list(await asyncio.gather(*(
+                        self._ainfer_one(followups[stage - 1](previous), item_tags, truncation)
+                        for previous in responses[-1])))
+                else:
+                    response = await self._ainfer_one(followups[stage - 1](responses[-1]),
+                                                      item_tags, truncation)
+                responses.append(response)
+                if stage == 0 and idx in warmed:
+                    warmed[idx].set()
+                if on_result is not None:
+                    on_result(idx, stage, responses[-1])
+                progress.update(1)
+            return responses
+        
+        async def _run(idx: int, query_message: list[dict[str, str]]) -> None:
+            try:
+                outputs[idx] = await _stages(idx, query_message)
+            except RuntimeError as error:
+                if not return_exceptions:
+                    raise
+                outputs[idx] = error
+                if idx in warmed:
+                    warmed[idx].set() # let the rest of its prefix group go
+        
+        order = range(len(queries_list)) if schedule is None else schedule.order
+        tasks = [asyncio.ensure_future(_run(idx, queries_list[idx])) for idx in order]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # stop the remaining requests if one of them failed for good
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            progress.close()
+            
+        if self.cache is not None:
+            print(f"Response cache: {self.cache.stats()}")
+        if len(self.pool.endpoints) > 1:
+            print(self.pool.report())
+        self.metrics.flush()
+        print(self.metrics.report())
 
         return outputs
 
+    async def ainfer_batch(
+        self,
+        queries_list: list[list[dict[str, str]]],
+        max_concurrency: int = None,
+        on_result: Optional[Callable[[int, str], None]] = None,
+        tags: Optional[Sequence[dict]] = None,
+        truncation=None,
+        samples: int = 1,
+        return_exceptions: bool = False) -> list[str]:
+        
+        """
+        Asynchronous batch inference:
+        - queries_list: each element is a conversation (list of messages)
+        - max_concurrency: maximum number of requests in flight, defaults to `cfg.max_concurrency`
+        - on_result: called as `on_result(index, response)` as soon as each response arrives,
+          e.g. to checkpoint completed segments
+        - tags: per-conversation fields added to the request metrics
+        - truncation: rule cutting each response (see `truncation.py`)
+        - samples: completions sampled per conversation, returned as a list when greater than 1
+        - return_exceptions: return the `RuntimeError` of failed conversations instead of raising
+        - Returns: the model response (string) for each conversation, in input order
+        """
+        
+        outputs = await self.ainfer_chain(
+            queries_list,
+            max_concurrency=max_concurrency,
+            on_result=None if on_result is None else lambda idx, stage, response: on_result(idx, response),
+            tags=tags,
+            truncations=[truncation],
+            samples=samples,
+            return_exceptions=return_exceptions,
+        )
+        return [responses if isinstance(responses, Exception) else responses[0] for responses in outputs]
+
+    async def aclose(self) -> None:
+        """Close the endpoint connections, the response cache and the metrics trace."""
+        
+        await self.pool.aclose()
+        if self.cache is not None:
+            self.cache.close()
+        self.metrics.close()
+    
+    def close(self) -> None:
+        """Synchronous wrapper around `aclose`."""
+        self._run_sync(self.aclose(), "close")
+
+    async def _in_own_loop(self, coroutine):
+        """Run `coroutine` in the event loop of a synchronous call, closing the clients bound to it at the end."""
+        
+        try:
+            return await coroutine
+        finally:
+            await self.pool.aclose()
+
+    def _run_sync(self, coroutine, name: str):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self._in_own_loop(coroutine))
+        
+        coroutine.close()
+        raise RuntimeError(f"{name}() cannot be called from a running event loop; use `await a{name}()` instead.")
+
+    def infer_batch(
+        self,
+        queries_list: list[list[dict[str, str]]],
+        max_concurrency: int = None,
+        on_result: Optional[Callable[[int, str], None]] = None,
+        tags: Optional[Sequence[dict]] = None,
+        truncation=None,
+        samples: int = 1,
+        return_exceptions: bool = False) -> list[str]:
+        
+        """
+        Batch inference:
+        - queries_list: each element is a conversation (list of messages)
+        - max_concurrency: maximum number of requests in flight, defaults to `cfg.max_concurrency`
+        - on_result: called as `on_result(index, response)` as soon as each response arrives
+        - tags: per-conversation fields added to the request metrics
+        - truncation: rule cutting each response (see `truncation.py`)
+        - samples: completions sampled per conversation (the OpenAI `n` parameter),
+          returned as a list when greater than 1
+        - return_exceptions: return the `RuntimeError` of failed conversations instead of raising
+        - Returns: the model response for each conversation, in input order
+        
+        Synchronous wrapper around `ainfer_batch`, so existing callers get concurrent requests unchanged.
+        """
+        
+        return self._run_sync(
+            self.ainfer_batch(queries_list, max_concurrency=max_concurrency, on_result=on_result,
+                             tags=tags, truncation=truncation, samples=samples,
+                             return_exceptions=return_exceptions),
+            "infer_batch",
+        )
+
+    def infer_chain(
+        self,
+        queries_list: list[list[dict[str, str]]],
+        followups: Sequence[Callable[[str], list[dict[str, str]]]] = (),
+        max_concurrency: int = None,
+        on_result: Optional[Callable[[int, int, str], None]] = None,
+        tags: Optional[Sequence[dict]] = None,
+        truncations: Sequence = (),
+        samples: int = 1,
+        return_exceptions: bool = False) -> list[list[str]]:
+        
+        """Synchronous wrapper around `ainfer_chain`."""
+        
+        return self._run_sync(
+            self.ainfer_chain(queries_list, followups=followups, max_concurrency=max_concurrency,
+                              on_result=on_result, tags=tags, truncations=truncations, samples=samples,
+                              return_exceptions=return_exceptions),
+            "infer_chain",
+        )
+
 
 if __name__ == "__main__":
     
@@ -0,0 +1,315 @@
+"""
+===============================================================================
+Meta-evaluation: Pairwise Accuracy, Tie Calibration and Significance Tests
+===============================================================================
+
+This module compares metric scores against human (MQM) scores, as reported in
+the paper: pairwise accuracy at the system level, and pairwise accuracy with
+tie calibration (acc_eq) at the segment level.
+
+All functions take score matrices shaped [system × segment] (e.g.
+`ScoreMatrix.segment_scores()` from `scoring.py`); NaN entries are ignored.
+
+------------------------------------------------------------------------------
+Pairwise Accuracy
+------------------------------------------------------------------------------
+A pair of items agrees when the metric and the human scores order it the same
+way, or when both score it as a tie:
+
+    acc = (concordant pairs + pairs tied in both) / all pairs
+
+With tie calibration, metric differences of at most `epsilon` count as ties,
+and `epsilon` is chosen to maximize the accuracy.
+
+- `pairwise_counts(metric, human, epsilon)` counts the agreeing pairs of two
+  score vectors in O(n log^2 n) with a vectorized merge-sort pass instead of
+  looping over the n^2 pairs.
+- `tie_calibrated_accuracy(...)` evaluates every candidate epsilon: the
+  distinct differences between metric values, or `max_candidates` quantiles of
+  them when there are more.
+- With `grouping="item"`, pairs are only formed between systems on the same
+  segment, and accuracies are averaged over segments. All candidate epsilons
+  are then evaluated at once from the sorted pair differences.
+
+------------------------------------------------------------------------------
+Significance Tests
+------------------------------------------------------------------------------
+`paired_significance(metric_a, metric_b, human, ...)` tests whether metric A
+is better than metric B:
+    - `"bootstrap"`: segments are resampled with replacement; the p-value is
+      the share of resamples where A does not beat B.
+    - `"permutation"`: the scores of A and B are swapped on random segments;
+      the p-value is the share of permutations where the difference is at
+      least the observed one.
+Resamples are split into fixed-size chunks, each with its own seed spawned
+from `seed` (`numpy.random.SeedSequence`) and run in a process pool, so the
+result does not depend on the number of workers.
+
+------------------------------------------------------------------------------
+Human Scores
+------------------------------------------------------------------------------
+`load_human_scores(path, systems)` reads segment-level scores in the
+mt-metrics-eval format (`<system>\\t<score>` per line, segments in order,
+"None" for missing scores), e.g. `wmt22/human-scores/zh-en.mqm.seg.score`.
+
+===============================================================================
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+
+RESAMPLE_CHUNK = 25 # resamples per process pool task
+
+def _count_preceding_less(ranks: np.ndarray, queries: np.ndarray) -> int:
+    """
+    Number of position pairs i < j with ranks[i] < queries[j], in O(n log^2 n).
+    Bottom-up merge sort: at each level, every element of a right half counts the
+    smaller elements of its left half, with one `searchsorted` over all blocks.
+    """
+
+    n = len(ranks)
+    if n < 2:
+        return 0
+    base = int(max(ranks.max(), queries.max())) + 1
+    positions = np.arange(n)
+    ranks, queries = ranks.astype(np.int64), queries.astype(np.int64)
+
+    total, width = 0, 1
+    while width < n:
+        block = positions // (2 * width)
+        in_left = positions % (2 * width) < width
+        # left halves are sorted (previous level), so their keys are sorted globally
+        left_keys = block[in_left] * base + ranks[in_left]
+        right_block = block[~in_left] * base
+        total += int((np.searchsorted(left_keys, right_block + queries[~in_left], side="left")
+                      - np.searchsorted(left_keys, right_block, side="left")).sum())
+        order = np.argsort(block * base + ranks, kind="stable")
+        ranks, queries = ranks[order], queries[order]
+        width *= 2
+    return total
+
+def _drop_nan(metric: np.ndarray, human: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    metric, human = np.ravel(metric), np.ravel(human)
+    valid = ~(np.isnan(metric) | np.isnan(human))
+    return metric[valid], human[valid]
+
+def pairwise_counts(metric: np.ndarray, human: np.ndarray, epsilon: float = 0.0) -> tuple[int, int]:
+    """(agreeing pairs, all pairs) of two score vectors, metric differences <= epsilon being ties."""
+
+    metric, human = _drop_nan(metric, human)
+    n = len(metric)
+    values = np.unique(metric)
+    ranks = np.searchsorted(values, metric)
+
+    # concordant: h_i < h_j and m_j - m_i > epsilon; sorting ties in h by decreasing m
+    # keeps pairs tied in h from being counted
+    order = np.lexsort((-metric, human))
+    concordant = _count_preceding_less(ranks[order], np.searchsorted(values, metric[order] - epsilon, side="left"))
+
+    # tied in both: h_i == h_j and |m_i - m_j| <= epsilon
+    groups = np.unique(human, return_inverse=True)[1].astype(np.int64)
+    base = len(values) + 1
+    keys = groups * base + ranks
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    lower = groups[order] * base + np.searchsorted(values, metric[order] - epsilon, side="left")
+    tied = int((np.arange(n) - np.searchsorted(keys, lower, side="left")).sum())
+
+    return concordant + tied, n * (n - 1) // 2
+
+def pairwise_accuracy(metric: np.ndarray, human: np.ndarray, epsilon: float = 0.0) -> float:
+    agree, total = pairwise_counts(metric, human, epsilon)
+    return agree / total if total else float("nan")
+
+def tie_candidates(metric: np.ndarray, max_candidates: int = 200, seed: int = 0) -> np.ndarray:
+    """Candidate epsilons: distinct differences between metric values, or quantiles of them."""
+
+    values = np.unique(metric[~np.isnan(metric)])
+    if len(values) <= 2000:
+        differences = np.unique(np.abs(values[:, None] - values[None, :]))
+    else: # too many values for all differences, sample pairs
+        rng = np.random.default_rng(seed)
+        differences = np.unique(np.abs(rng.choice(values, 1_000_000) - rng.choice(values, 1_000_000)))
+    if len(differences) > max_candidates:
+        differences = np.unique(np.quantile(differences, np.linspace(0, 1, max_candidates), method="nearest"))
+    return differences
+
+def _item_grouped_accuracies(metric: np.ndarray, human: np.ndarray, epsilons: np.ndarray) -> np.ndarray:
+    """Item-grouped accuracy for every epsilon at once (epsilons sorted)."""
+
+    first, second = np.triu_indices(metric.shape[0], 1)
+    metric_diff = (metric[first] - metric[second]).ravel()
+    human_diff = (human[first] - human[second]).ravel()
+    items = np.broadcast_to(np.arange(metric.shape[1]), (len(first), metric.shape[1])).ravel()
+
+    valid = ~(np.isnan(metric_diff) | np.isnan(human_diff))
+    metric_diff, human_diff, items = metric_diff[valid], human_diff[valid], items[valid]
+    pairs_per_item = np.bincount(items, minlength=metric.shape[1])
+    num_items = np.count_nonzero(pairs_per_item)
+    if not num_items:
+        return np.full(len(epsilons), np.nan)
+    weights = 1.0 / (pairs_per_item[items] * num_items)
+
+    # a pair is a metric tie for epsilons[k] with k >= first_tie
+    first_tie = np.searchsorted(epsilons, np.abs(metric_diff), side="left")
+    human_tie = human_diff == 0
+    concordant = ~human_tie & (np.sign(metric_diff) == np.sign(human_diff))
+
+    gains = np.zeros(len(epsilons) + 1)
+    np.add.at(gains, first_tie[human_tie], weights[human_tie]) # tie in both from first_tie on
+    gains[0] += weights[concordant].sum() # concordant until first_tie
+    np.add.at(gains, first_tie[concordant], -weights[concordant])
+    return np.cumsum(gains)[:-1]
+
+def tie_calibrated_accuracy(
+    metric: np.ndarray,
+    human: np.ndarray,
+    grouping: str = "none",
+    max_candidates: int = 200) -> tuple[float, float]:
+
+    """Segment-level accuracy with the best tie threshold; returns (acc_eq, epsilon)."""
+
+    epsilons = tie_candidates(metric, max_candidates)
+    if grouping == "item":
+        accuracies = _item_grouped_accuracies(metric, human, epsilons)
+    elif grouping == "none":
+        accuracies = np.array([pairwise_accuracy(metric, human, epsilon) for epsilon in epsilons])
+    else:
+        raise ValueError(f"Unknown grouping: {grouping}")
+
+    best = int(np.nanargmax(accuracies))
+    return float(accuracies[best]), float(epsilons[best])
+
+def system_means(scores: np.ndarray) -> np.ndarray:
+    parsed = ~np.isnan(scores)
+    counts = parsed.sum(axis=1)
+    return np.divide(np.where(parsed, scores, 0.0).sum(axis=1), counts,
+                     out=np.full(scores.shape[0], np.nan), where=counts > 0)
+
+def system_accuracy(metric: np.ndarray, human: np.ndarray) -> float:
+    """Pairwise accuracy of the system-level means, over segments scored by the human annotation."""
+    metric = np.where(np.isnan(human), np.nan, metric)
+    return pairwise_accuracy(system_means(metric), system_means(human))
+
+def evaluate(
+    metric: np.ndarray,
+    human: np.ndarray,
+    level: str = "system",
+    grouping: str = "none",
+    max_candidates: int = 200) -> float:
+
+    if level == "system":
+        return system_accuracy(metric, human)
+    if level == "segment":
+        return tie_calibrated_accuracy(metric, human, grouping, max_candidates)[0]
+    raise ValueError(f"Unknown level: {level}")
+
+# arrays and settings of a significance test, set once per worker process
+_SHARED_TEST = {}
+
+def init_worker(shared_test):
+    _SHARED_TEST.update(shared_test)
+
+def _resample_deltas(task: tuple[np.random.SeedSequence, int]) -> np.ndarray:
+    """Differences A - B for one chunk of resamples."""
+
+    seed_sequence, num_resamples = task
+    rng = np.random.default_rng(seed_sequence)
+    metric_a, metric_b, human = _SHARED_TEST["metric_a"], _SHARED_TEST["metric_b"], _SHARED_TEST["human"]
+    settings = _SHARED_TEST["settings"]
+    num_segments = human.shape[1]
+
+    deltas = np.empty(num_resamples)
+    for k in range(num_resamples):
+        if _SHARED_TEST["method"] == "bootstrap":
+            columns = rng.integers(0, num_segments, num_segments)
+            resampled_a, resampled_b, resampled_human = metric_a[:, columns], metric_b[:, columns], human[:, columns]
+        else:
+            swap = rng.random(num_segments) < 0.5
+            resampled_a = np.where(swap, metric_b, metric_a)
+            resampled_b = np.where(swap, metric_a, metric_b)
+            resampled_human = human
+        deltas[k] = evaluate(resampled_a, resampled_human, **settings) - evaluate(resampled_b, resampled_human, **settings)
+    return deltas
+
+def paired_significance(
+    metric_a: np.ndarray,
+    metric_b: np.ndarray,
+    human: np.ndarray,
+    level: str = "system",
+    grouping: str = "none",
+    method: str = "bootstrap",
+    num_resamples: int = 1000,
+    seed: int = 0,
+    num_workers: Optional[int] = None,
+    max_candidates: int = 200) -> dict:
+
+    """Test whether metric A agrees better with the human scores than metric B."""
+
+    if method not in ("bootstrap", "permutation"):
+        raise ValueError(f"Unknown method: {method}")
+
+    settings = {"level": level, "grouping": grouping, "max_candidates": max_candidates}
+    accuracy_a, accuracy_b = evaluate(metric_a, human, **settings), evaluate(metric_b, human, **settings)
+    observed = accuracy_a - accuracy_b
+
+    chunk_sizes = [min(RESAMPLE_CHUNK, num_resamples - start) for start in range(0, num_resamples, RESAMPLE_CHUNK)]
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    shared_test = {"metric_a": metric_a, "metric_b": metric_b, "human": human, "method": method, "settings": settings}
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker, initargs=(shared_test,)) as executor:
+        deltas = np.concatenate(list(executor.map(_resample_deltas, zip(seed_sequences, chunk_sizes))))
+
+    if method == "bootstrap":
+        p_value = float(np.mean(deltas <= 0))
+    else:
+        p_value = float((np.sum(deltas >= observed) + 1) / (len(deltas) + 1))
+
+    return {
+        "accuracy_a": accuracy_a,
+        "accuracy_b": accuracy_b,
+        "delta": observed,
+        "p_value": p_value,
+        "delta_ci95": tuple(np.quantile(deltas, [0.025, 0.975]).tolist()) if method == "bootstrap" else None,
+    }
+
+def load_human_scores(path: str, systems: list[str]) -> np.ndarray:
+    """Human segment scores aligned with `systems`, as a [system × segment] array (NaN if missing)."""
+
+    per_system = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            system, score = line.rstrip("\n").split("\t")
+            per_system.setdefault(system, []).append(np.nan if score == "None" else float(score))
+
+    missing = [system for system in systems if system not in per_system]
+    if missing:
+        raise ValueError(f"No human scores for systems: {missing}")
+    num_segments = max(len(per_system[system]) for system in systems)
+    scores = np.full((len(systems), num_segments), np.nan)
+    for i, system in enumerate(systems):
+        scores[i, :len(per_system[system])] = per_system[system]
+    return scores
+
+
+if __name__ == "__main__":
+
+    from scoring import load_score_matrix
+
+    lang_pair = 'zhen'
+    model_name = "gpt-3.5-turbo"
+    prompt_type_a = f"ERROR_{lang_pair.upper()}_ITEMIZED_SRC"
+    prompt_type_b = f"SINGLESTEP_{lang_pair.upper()}_ITEMIZED_SRC"
+    human_path = "./mt-metrics-eval-v2/wmt22/human-scores/zh-en.mqm.seg.score"
+
+    matrix_a = load_score_matrix(lang_pair, model_name, prompt_type_a)
+    matrix_b = load_score_matrix(lang_pair, model_name, prompt_type_b)
+    if matrix_a.systems != matrix_b.systems:
+        raise ValueError("Both prompt types must cover the same systems.")
+    human = load_human_scores(human_path, matrix_a.systems)
+
+    for level, grouping in [("system", "none"), ("segment", "item")]:
+        result = paired_significance(matrix_a.segment_scores(), matrix_b.segment_scores(), human,
+                                     level=level, grouping=grouping)
+        print(f"{level} ({grouping}): {result}")
@@ -0,0 +1,195 @@
+"""
+===============================================================================
+Per-request Metrics and Tracing for the Inference Pipeline
+===============================================================================
+
+`InferenceEngine` records one `RequestRecord` per request through a
+`MetricsRecorder`, to tell whether a slow run is caused by the server, by
+throttling or by the client.
+
+------------------------------------------------------------------------------
+Recorded Fields
+------------------------------------------------------------------------------
+- `latency`: duration of the last HTTP call (the successful one, if any).
+- `queue_time`: time spent waiting for the rate limiter and a concurrency
+  slot, summed over attempts.
+- `total_time`: from submission to the final response, including retries.
+- `retries`, `errors` (error class of each failed attempt, see
+  `ratelimit.classify_error`) and `status` ("ok", "cached" or "failed").
+- `prompt_tokens` / `completion_tokens` from the `usage` field (estimated
+  for streamed requests), and `early_stop` for streams stopped by a
+  truncation rule.
+- `endpoint`, and the `tags` given by the caller, e.g. the system file,
+  segment indices and stage of the request.
+
+------------------------------------------------------------------------------
+Outputs (configured in `OpenAIConfig`)
+------------------------------------------------------------------------------
+1. **Trace** (`trace_path`): one JSON line per request, appended as requests
+   complete.
+2. **Summary**: p50/p95/p99 latency and queue time, throughput, retries,
+   errors, tokens and cost (`prompt_cost_per_1k` / `completion_cost_per_1k`),
+   printed after each batch and saved to `<trace_path>.summary.json`.
+3. **Prometheus** (`prometheus_path`): text exposition format, rewritten every
+   `PROMETHEUS_INTERVAL` seconds and after each batch (e.g. for the
+   node_exporter textfile collector).
+
+===============================================================================
+"""
+
+import json
+import os
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+import numpy as np
+
+from constants.model_configs import OpenAIConfig
+
+PROMETHEUS_INTERVAL = 10.0 # seconds
+QUANTILES = (0.5, 0.95, 0.99)
+
+@dataclass
+class RequestRecord:
+    tags: dict = field(default_factory=dict)
+    status: str = "ok"
+    endpoint: Optional[str] = None
+    submitted_at: float = 0.0 # unix time
+    queue_time: float = 0.0
+    latency: float = 0.0
+    total_time: float = 0.0
+    retries: int = 0
+    errors: list[str] = field(default_factory=list)
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    early_stop: bool = False
+
+def _quantiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {f"p{round(q * 100)}": 0.0 for q in QUANTILES}
+    return {f"p{round(q * 100)}": float(value) for q, value in zip(QUANTILES, np.quantile(values, QUANTILES))}
+
+class MetricsRecorder:
+
+    def __init__(self, cfg: OpenAIConfig) -> None:
+        self.cfg = cfg
+        self.started = time.time()
+        self.status = Counter()
+        self.errors = Counter()
+        self.latencies = [] # requests sent over the network only
+        self.queue_times = []
+        self.retries = 0
+        self.early_stops = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self._last_export = 0.0
+
+        self._trace = None
+        if cfg.trace_path is not None:
+            self._open_trace()
+
+    def _open_trace(self) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.cfg.trace_path)), exist_ok=True)
+        self._trace = open(self.cfg.trace_path, "a", encoding="utf-8")
+
+    def record(self, request: RequestRecord) -> None:
+        self.status[request.status] += 1
+        self.errors.update(request.errors)
+        self.retries += request.retries
+        self.early_stops += request.early_stop
+        if request.status != "cached":
+            self.latencies.append(request.latency)
+            self.queue_times.append(request.queue_time)
+        self.prompt_tokens += request.prompt_tokens
+        self.completion_tokens += request.completion_tokens
+
+        if self.cfg.trace_path is not None:
+            if self._trace is None: # reopened after `close()`
+                self._open_trace()
+            self._trace.write(json.dumps(asdict(request), ensure_ascii=False) + "\n")
+        if self.cfg.prometheus_path is not None and time.monotonic() - self._last_export >= PROMETHEUS_INTERVAL:
+            self.write_prometheus()
+
+    def cost(self) -> float:
+        return (self.prompt_tokens * self.cfg.prompt_cost_per_1k
+                + self.completion_tokens * self.cfg.completion_cost_per_1k) / 1000
+
+    def summary(self) -> dict:
+        elapsed = max(time.time() - self.started, 1e-9)
+        requests = sum(self.status.values())
+        return {
+            "requests": requests,
+            "status": dict(self.status),
+            "retries": self.retries,
+            "errors": dict(self.errors),
+            "early_stops": self.early_stops,
+            "latency": _quantiles(self.latencies),
+            "queue_time": _quantiles(self.queue_times),
+            "throughput": requests / elapsed, # requests per second
+            "elapsed": elapsed,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost": self.cost(),
+        }
+
+    def report(self) -> str:
+        summary = self.summary()
+        latency, queue = summary["latency"], summary["queue_time"]
+        return (f"Requests: {summary['requests']} {summary['status']}, {summary['retries']} retries {summary['errors']}, "
+                f"{summary['early_stops']} early stops, {summary['throughput']:.2f} req/s\n"
+                f"Latency p50/p95/p99: {latency['p50']:.2f}/{latency['p95']:.2f}/{latency['p99']:.2f}s, "
+                f"queue p50/p95/p99: {queue['p50']:.2f}/{queue['p95']:.2f}/{queue['p99']:.2f}s\n"
+                f"Tokens: {summary['prompt_tokens']} prompt, {summary['completion_tokens']} completion, "
+                f"cost {summary['cost']:.4f}")
+
+    def prometheus_text(self) -> str:
+        lines = [
+            "# TYPE eaprompt_requests_total counter",
+            *(f'eaprompt_requests_total{{status="{status}"}} {count}' for status, count in sorted(self.status.items())),
+            "# TYPE eaprompt_retries_total counter",
+            f"eaprompt_retries_total {self.retries}",
+            "# TYPE eaprompt_errors_total counter",
+            *(f'eaprompt_errors_total{{kind="{kind}"}} {count}' for kind, count in sorted(self.errors.items())),
+            "# TYPE eaprompt_early_stops_total counter",
+            f"eaprompt_early_stops_total {self.early_stops}",
+            "# TYPE eaprompt_tokens_total counter",
+            f'eaprompt_tokens_total{{type="prompt"}} {self.prompt_tokens}',
+            f'eaprompt_tokens_total{{type="completion"}} {self.completion_tokens}',
+            "# TYPE eaprompt_cost_total counter",
+            f"eaprompt_cost_total {self.cost()}",
+        ]
+        for name, values in [("eaprompt_request_latency_seconds", self.latencies),
+                             ("eaprompt_queue_seconds", self.queue_times)]:
+            lines.append(f"# TYPE {name} summary")
+            lines.extend(f'{name}{{quantile="{q}"}} {value}' for q, value in zip(QUANTILES, _quantiles(values).values()))
+            lines.append(f"{name}_sum {float(np.sum(values)) if values else 0.0}")
+            lines.append(f"{name}_count {len(values)}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self) -> None:
+        path = self.cfg.prometheus_path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(path + ".tmp", path) # scrapers never read a partial file
+        self._last_export = time.monotonic()
+
+    def flush(self) -> None:
+        """Save the trace, the summary and the Prometheus export (called after each batch)."""
+
+        if self._trace is not None:
+            self._trace.flush()
+            with open(self.cfg.trace_path + ".summary.json", "w", encoding="utf-8") as f:
+                json.dump(self.summary(), f, indent=4)
+        if self.cfg.prometheus_path is not None:
+            self.write_prometheus()
+
+    def close(self) -> None:
+        """Flush everything and close the trace file (called by `InferenceEngine.close`)."""
+
+        self.flush()
+        if self._trace is not None:
+            self._trace.close()
+            self._trace = None
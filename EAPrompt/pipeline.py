@@ -0,0 +1,301 @@
+"""
+===============================================================================
+Incremental End-to-end Pipeline Runner
+===============================================================================
+
+A single entry point for the queries -> responses -> counts -> scores stages,
+which only recomputes the outputs whose inputs changed since they were built.
+
+------------------------------------------------------------------------------
+Dependency Graph
+------------------------------------------------------------------------------
+For each language pair, prompt type and MT system:
+1. **queries** (`results/queries/<lang_pair>/<prompt_type>/<system>.json`):
+   depends on the src, sys (and ref, for REF prompts) data files, the prompt
+   template built from `constants.context` (`CompiledPrompt.version`), and
+   the query file format of `queries_generate.py`.
+2. **responses** (`results/responses/<lang_pair>/<model>/<prompt_type>/<system>.json`,
+   `error_response` or `singlestep_response`): depends on the queries and on
+   the `OpenAIConfig` fields and `responses_generate.py` parameters that
+   change responses (`RESPONSE_CONFIG_FIELDS`, including the endpoint URLs,
+   `GENERATION_PARAMS`, and the segment IDs selected by `segment_ids` /
+   `sample_size`, read from the JSON file if `segment_ids` is a path).
+3. **counts** (`count_response`, added to the same file; two-step prompts
+   only): depends on the responses, `INSTRUCTION_COUNT` and the config.
+   Responses are generated by `responses_generate.ResponseRun` (journal,
+   dedup, chunking, truncation), so the counts of a two-step prompt are built
+   together with its responses by the pipelined ERROR -> COUNT chain; the
+   counts stage only runs alone (COUNT requests only) when its own inputs
+   changed.
+And for each language pair and prompt type:
+4. **scores** (`results/scores/<lang_pair>/<model>/<prompt_type>.npz`, see
+   `scoring.py`): depends on the counts (or SINGLESTEP responses) of every
+   system.
+
+------------------------------------------------------------------------------
+Staleness Tracking
+------------------------------------------------------------------------------
+- The signature of an output is a hash of its inputs; inputs produced by an
+  upstream stage enter through the upstream signature, so a change
+  propagates down the graph (e.g. a new `INSTRUCTION_COUNT` reruns counts
+  and scores, but not responses; a new MT system file only adds its own
+  outputs and rebuilds the scores).
+- Signatures are stored in `<results_root>/.pipeline/manifest.json`, which is
+  saved after every output. Data file hashes are reused while the file size
+  and modification time are unchanged.
+- An output is stale if it is missing or if its signature changed; `status`
+  lists stale outputs with the inputs that changed.
+
+Usage (from the repository root):
+    python EAPrompt/pipeline.py status
+    python EAPrompt/pipeline.py run [--until responses] [--model GPT-4] [--lang-pairs zhen]
+
+===============================================================================
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from functools import lru_cache, partial
+from typing import Callable, Optional
+
+import queries_generate
+import responses_generate
+from constants.model_configs import MODEL_CONFIGS
+from eaprompt import EAPrompt, compile_prompt_type
+from inference import InferenceEngine
+from query_store import save_template
+from responses_generate import ResponseRun
+from scoring import build_score_matrix, folder_signature, list_response_files
+from segments import SegmentSelection
+from utils import readlines_txt
+
+STAGES = ["queries", "responses", "counts", "scores"]
+RESPONSE_CONFIG_FIELDS = ("base_url", "model_name", "temperature", "max_tokens") # fields of `OpenAIConfig` that change responses
+GENERATION_PARAMS = ("count_mode", "truncate", "truncate_keywords", "truncate_start",
+                     "num_samples", "aggregation") # parameters of `responses_generate.py` that change responses
+
+# Parameters (defaults of the command line; data files are located by `queries_generate.locate_data`)
+lang_pairs = ['zhen']
+prompt_types = ["ERROR_{LANG}_ITEMIZED_SRC"] # `{LANG}` is replaced by each language pair
+model_name = "/model/name/in/config"
+results_root = "./results"
+
+def digest(value) -> str:
+    serialized = json.dumps(value, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+class Manifest:
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.data = {"outputs": {}, "files": {}}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.data = json.load(f)
+
+    def file_digest(self, path: str) -> str:
+        """SHA-256 of a file's content, rehashed only when its size or modification time changed."""
+
+        stat = os.stat(path)
+        memo = self.data["files"].get(path)
+        if memo is not None and memo["size"] == stat.st_size and memo["mtime_ns"] == stat.st_mtime_ns:
+            return memo["sha256"]
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha256.update(block)
+        self.data["files"][path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256.hexdigest()}
+        return sha256.hexdigest()
+
+    def entry(self, step: "Step") -> Optional[dict]:
+        return self.data["outputs"].get(f"{step.stage}:{step.output}")
+
+    def record(self, step: "Step") -> None:
+        self.data["outputs"][f"{step.stage}:{step.output}"] = {
+            "signature": step.signature, "inputs": step.inputs, "updated_at": time.time()}
+        self.save()
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.data, f, indent=1, ensure_ascii=False)
+        os.replace(self.path + ".tmp", self.path)
+
+@dataclass
+class Step:
+    stage: str
+    output: str
+    inputs: dict # hashes of the inputs, including upstream signatures
+    run: Callable[[], None]
+    upstream: list["Step"] = field(default_factory=list)
+    prepare: Optional[Callable[[], None]] = None # called for every stale step before the first one runs
+    builds: list["Step"] = field(default_factory=list) # downstream outputs built by the same run
+    signature: str = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.signature = digest(self.inputs)
+
+    def stale_reason(self, manifest: Manifest, stale: set[int]) -> Optional[str]:
+        """
+        Why the output must be rebuilt, or None if it is up to date.
+        `stale` holds the ids of the upstream steps already found stale, which are rebuilt first
+        (e.g. recreated responses lose their `count_response`, even with unchanged signatures).
+        """
+
+        if any(id(step) in stale for step in self.upstream):
+            return "upstream rebuilt"
+        entry = manifest.entry(self)
+        if entry is None or not os.path.exists(self.output):
+            return "missing"
+        if entry["signature"] == self.signature:
+            return None
+        changed = sorted(key for key in self.inputs.keys() | entry["inputs"].keys()
+                         if self.inputs.get(key) != entry["inputs"].get(key))
+        return f"changed: {', '.join(changed)}"
+
+#### Stage implementations
+
+@lru_cache(maxsize=None)
+def load_parallel_inputs(srcs_path: str, refs_path: str) -> tuple[list[str], list[str]]:
+    srcs, refs = readlines_txt(srcs_path), readlines_txt(refs_path)
+    if len(srcs) != len(refs):
+        raise ValueError(f"Length mismatch: srcs({len(srcs)}), refs({len(refs)})")
+    return srcs, refs
+
+@lru_cache(maxsize=None)
+def get_engine(model_name: str) -> InferenceEngine:
+    return InferenceEngine(model_name=model_name) # only created when a response is stale
+
+def run_queries(lang_pair: str, prompt_type: str, srcs_path: str, refs_path: str, tgts_path: str, output_path: str) -> None:
+    srcs, refs = load_parallel_inputs(srcs_path, refs_path)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    if queries_generate.compact:
+        save_template(EAPrompt(prompt_type=prompt_type).get_template(), os.path.dirname(output_path))
+    queries_generate.init_worker({lang_pair: (None, len(srcs), srcs, refs)})
+    queries_generate.generate_system_queries(lang_pair, prompt_type, tgts_path, output_path)
+    print(f"Saved to {output_path}.")
+
+@lru_cache(maxsize=None)
+def get_response_run(model_name: str, prompt_type: str, queries_folder: str, responses_folder: str) -> ResponseRun:
+    return ResponseRun(get_engine(model_name), prompt_type, queries_folder, responses_folder) # shared dedup across systems
+
+def expect_responses(model_name: str, prompt_type: str, queries_folder: str, responses_folder: str, queries_path: str) -> None:
+    get_response_run(model_name, prompt_type, queries_folder, responses_folder).expect(queries_path)
+
+def run_responses(model_name: str, prompt_type: str, queries_folder: str, responses_folder: str,
+                  queries_path: str, output_path: str) -> None:
+    run = get_response_run(model_name, prompt_type, queries_folder, responses_folder)
+    run.generate_system(queries_path, output_path)
+
+def run_counts(model_name: str, prompt_type: str, queries_folder: str, responses_folder: str, responses_path: str) -> None:
+    run = get_response_run(model_name, prompt_type, queries_folder, responses_folder)
+    run.generate_system(responses_path, responses_path, keep_fields=["error_response"])
+
+def run_scores(responses_folder: str, output_path: str) -> None:
+    matrix = build_score_matrix(responses_folder)
+    # saved with the signature checked by `scoring.load_score_matrix`, which then reuses it
+    matrix.save(output_path, folder_signature(responses_folder, list_response_files(responses_folder)))
+    print(f"Saved to {output_path} ({len(matrix.systems)} systems, parse rate {matrix.parse_rate():.1%}).")
+
+#### Dependency graph
+
+def plan_steps(manifest: Manifest, lang_pairs: list[str], prompt_types: list[str], model_name: str) -> list[Step]:
+    """Every output of the graph, in dependency order."""
+
+    cfg = MODEL_CONFIGS[model_name]
+    config = {name: getattr(cfg, name) for name in RESPONSE_CONFIG_FIELDS}
+    config.update({name: getattr(responses_generate, name) for name in GENERATION_PARAMS})
+    # the selected segment IDs themselves, so that editing a `segment_ids` JSON file is a change
+    selection = SegmentSelection.from_params(responses_generate.segment_ids, responses_generate.sample_size,
+                                             responses_generate.sample_seed)
+    config["selection"] = asdict(selection) if selection is not None else None
+    count_instruction = digest(compile_prompt_type("COUNT").instruction)
+    steps = []
+    for lang_pair in lang_pairs:
+        srcs_path, refs_path, tgts_folder = queries_generate.locate_data(lang_pair)
+        for pattern in prompt_types:
+            prompt_type = pattern.format(LANG=lang_pair.upper())
+            queries_folder = os.path.join(results_root, "queries", lang_pair, prompt_type)
+            responses_folder = os.path.join(results_root, "responses", lang_pair, model_name, prompt_type)
+            score_inputs, score_upstream = {}, []
+            for file in sorted(os.listdir(tgts_folder)):
+                system = ".".join(file.split('.')[2:-1])
+                tgts_path = os.path.join(tgts_folder, file)
+                queries_path = os.path.join(queries_folder, f"{system}.{queries_generate.file_format}")
+                responses_path = os.path.join(responses_folder, f"{system}.{responses_generate.file_format}")
+
+                queries = Step("queries", queries_path, {
+                    "src": manifest.file_digest(srcs_path),
+                    "ref": manifest.file_digest(refs_path) if "REF" in prompt_type else None,
+                    "tgt": manifest.file_digest(tgts_path),
+                    "prompt_type": prompt_type,
+                    "template": compile_prompt_type(prompt_type).version,
+                    "format": [queries_generate.compact, queries_generate.file_format],
+                }, partial(run_queries, lang_pair, prompt_type, srcs_path, refs_path, tgts_path, queries_path))
+                response_run = (model_name, prompt_type, queries_folder, responses_folder)
+                responses = Step("responses", responses_path, {"queries": queries.signature, "config": config},
+                                 partial(run_responses, *response_run, queries_path, responses_path),
+                                 upstream=[queries], prepare=partial(expect_responses, *response_run, queries_path))
+                steps += [queries, responses]
+                if "SINGLESTEP" in prompt_type:
+                    last = responses
+                else:
+                    last = Step("counts", responses_path,
+                                {"responses": responses.signature, "instruction": count_instruction, "config": config},
+                                partial(run_counts, *response_run, responses_path), upstream=[responses])
+                    responses.builds.append(last) # ERROR -> COUNT chain
+                    steps.append(last)
+                score_inputs[system] = last.signature
+                score_upstream.append(last)
+
+            scores_path = os.path.join(results_root, "scores", lang_pair, model_name, f"{prompt_type}.npz")
+            steps.append(Step("scores", scores_path, {"systems": score_inputs},
+                              partial(run_scores, responses_folder, scores_path), upstream=score_upstream))
+    manifest.save() # keep the data file hashes
+    return sorted(steps, key=lambda step: STAGES.index(step.stage)) # stable: keeps the order within a stage
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Incremental EAPrompt pipeline.")
+    parser.add_argument("action", choices=["run", "status"])
+    parser.add_argument("--until", choices=STAGES, default="scores", help="last stage to run")
+    parser.add_argument("--lang-pairs", nargs="+", default=lang_pairs)
+    parser.add_argument("--prompt-types", nargs="+", default=prompt_types)
+    parser.add_argument("--model", default=model_name)
+    args = parser.parse_args()
+    if args.model not in MODEL_CONFIGS:
+        parser.error(f"unknown model {args.model}")
+
+    manifest = Manifest(os.path.join(results_root, ".pipeline", "manifest.json"))
+    steps = [step for step in plan_steps(manifest, args.lang_pairs, args.prompt_types, args.model)
+             if STAGES.index(step.stage) <= STAGES.index(args.until)]
+    stale, stale_ids = [], set()
+    for step in steps:
+        reason = step.stale_reason(manifest, stale_ids)
+        if reason is not None:
+            stale.append((step, reason))
+            stale_ids.add(id(step))
+    print(f"{len(stale)} of {len(steps)} outputs are stale.")
+
+    if args.action == "run":
+        for step, _ in stale:
+            if step.prepare is not None:
+                step.prepare()
+    built = set()
+    for step, reason in stale:
+        if id(step) in built:
+            print(f"[{step.stage}] {step.output}: built with its upstream step")
+            continue
+        print(f"[{step.stage}] {step.output}: {reason}")
+        if args.action == "run":
+            step.run()
+            for output in [step, *step.builds]:
+                manifest.record(output)
+                built.add(id(output))
+
+    if get_engine.cache_info().currsize: # only created when a response was stale
+        get_engine(args.model).close()
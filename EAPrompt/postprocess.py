@@ -0,0 +1,141 @@
+"""
+===============================================================================
+Post-processing of Response Trees
+===============================================================================
+
+This script cleans whole response trees
+(`results/responses/<lang_pair>/<model_name>/<prompt_type>/`) in bulk, and
+writes them to a mirrored output tree, ready for scoring.
+
+------------------------------------------------------------------------------
+Steps (per record)
+------------------------------------------------------------------------------
+1. **Truncation** (see `truncation.py`), with the same result as
+   `utils.truncate_response`:
+   - `error_response`: cut at `truncate_keywords` after `truncate_start`
+     characters, all keywords being matched in a single pass.
+   - `count_response`: cut after the "x, x" line.
+   - `singlestep_response`: cut after the trailing "x, x" line.
+2. **Normalization**: line endings are unified, and trailing spaces and
+   surrounding blank lines are removed.
+3. **Count parsing**: the (major, minor) counts used for scoring
+   (`scoring.response_counts`) are stored in a `counts` field, or None if
+   they cannot be parsed.
+
+------------------------------------------------------------------------------
+Notes
+------------------------------------------------------------------------------
+- Response files are processed in parallel by `num_workers` processes (all
+  cores by default). Each file is streamed record by record to a temporary
+  file, renamed when complete, so memory does not grow with the size of the
+  files (for `.jsonl` inputs).
+- Query templates (`_template.json`, see `query_store.py`) are copied
+  unchanged, and files keep their format.
+- A summary of the characters removed and the count parse rate is printed
+  per prompt type folder.
+
+===============================================================================
+"""
+
+import os
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Optional
+
+from tqdm import tqdm
+
+from query_store import TEMPLATE_FILE
+from scoring import list_response_files, response_counts
+from truncation import truncation_for_stage
+from utils import RecordWriter, iter_records
+
+# Parameters (edit if needed)
+src_folder = "./results/responses/"
+dst_folder = "./results/responses_clean/"
+truncate_keywords = [] # e.g. ["\n\n\n", "Note:"], for `error_response`
+truncate_start = 0 # characters kept before looking for `truncate_keywords`
+normalize = True
+num_workers = None # number of processes, all cores if None
+
+TRAILING_SPACES = re.compile(r"[ \t]+$", re.MULTILINE)
+
+def normalize_response(text: str) -> str:
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return TRAILING_SPACES.sub("", text).strip("\n")
+
+def response_rules(prompt_type: str) -> dict:
+    """Truncation rule of each response field of a prompt type (None: not truncated)."""
+    return {
+        "error_response": truncation_for_stage(prompt_type, truncate_keywords, truncate_start),
+        "count_response": truncation_for_stage("COUNT"),
+        "singlestep_response": truncation_for_stage(prompt_type),
+    }
+
+def process_file(src_path: str, dst_path: str, rules: dict, normalize: bool) -> dict:
+    """Clean one response file into `dst_path`; returns its statistics."""
+
+    stats = {"records": 0, "parsed": 0, "chars_in": 0, "chars_out": 0}
+    with RecordWriter(dst_path + ".tmp", jsonl=dst_path.endswith(".jsonl")) as writer:
+        for record in iter_records(src_path):
+            for field, rule in rules.items():
+                text = record.get(field)
+                if not isinstance(text, str):
+                    continue
+                stats["chars_in"] += len(text)
+                if rule is not None:
+                    text = rule.apply(text)
+                if normalize:
+                    text = normalize_response(text)
+                record[field] = text
+                stats["chars_out"] += len(text)
+            counts = response_counts(record)
+            record["counts"] = list(counts) if counts is not None else None
+            stats["records"] += 1
+            stats["parsed"] += counts is not None
+            writer.write(record)
+    os.replace(dst_path + ".tmp", dst_path)
+    return stats
+
+def list_response_folders(root: str) -> list[str]:
+    """Folders of `root` holding response files (the `<prompt_type>` level of the tree)."""
+    return sorted(
+        folder for folder, _, files in os.walk(root)
+        if not os.path.basename(folder).startswith(".") and list_response_files(folder)
+    )
+
+def postprocess_tree(src_root: str, dst_root: str, num_workers: Optional[int] = None) -> dict[str, dict]:
+    """Clean every response file under `src_root` into `dst_root`; returns the statistics per folder."""
+
+    tasks = []
+    for folder in list_response_folders(src_root):
+        out_folder = os.path.join(dst_root, os.path.relpath(folder, src_root))
+        os.makedirs(out_folder, exist_ok=True)
+        if os.path.exists(os.path.join(folder, TEMPLATE_FILE)):
+            shutil.copyfile(os.path.join(folder, TEMPLATE_FILE), os.path.join(out_folder, TEMPLATE_FILE))
+        rules = response_rules(os.path.basename(folder))
+        for file_name in list_response_files(folder):
+            tasks.append((folder, os.path.join(folder, file_name), os.path.join(out_folder, file_name), rules))
+
+    # largest files first, so that one big file does not finish last
+    tasks.sort(key=lambda task: -os.path.getsize(task[1]))
+    totals = {}
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(process_file, src_path, dst_path, rules, normalize): folder
+                   for folder, src_path, dst_path, rules in tasks}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Post-processing"):
+            folder_totals = totals.setdefault(futures[future], {})
+            for key, value in future.result().items():
+                folder_totals[key] = folder_totals.get(key, 0) + value
+    return dict(sorted(totals.items()))
+
+
+if __name__ == "__main__":
+
+    totals = postprocess_tree(src_folder, dst_folder, num_workers=num_workers)
+    for folder, stats in totals.items():
+        removed = 1 - stats["chars_out"] / stats["chars_in"] if stats["chars_in"] else 0.0
+        parse_rate = stats["parsed"] / stats["records"] if stats["records"] else 0.0
+        print(f"{os.path.relpath(folder, src_folder)}: {stats['records']} records, "
+              f"{removed:.1%} characters removed, count parse rate {parse_rate:.1%}")
+    print(f"Saved to {dst_folder}.")
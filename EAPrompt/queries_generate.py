@@ -5,103 +5,214 @@ Batch Query Generation for Translation Evaluation (EAPrompt)
 
 This script automates the batch generation of translation evaluation queries 
 using the **EAPrompt** framework. It constructs OpenAI-style prompt messages 
-for each translation system output under a given dataset and language pair.
+for each translation system output under a given dataset, for any number of
+language pairs and prompt types in one run.
 
 ------------------------------------------------------------------------------
 Workflow Overview
 ------------------------------------------------------------------------------
 1. **Input Data**
    - Source, reference, and system translation files are loaded from the 
-     specified dataset directory (e.g., `wmt22/zhen`).
-   - File paths are constructed dynamically based on `lang_pair` and dataset name.
+     specified dataset directory (e.g., `wmt22/wmt22.zhen.src.zh`).
+   - File paths are constructed dynamically based on each entry of `lang_pairs`
+     and the dataset name.
+   - Source and reference files are read once per language pair and shared by
+     all work units; system translations are streamed.
 
 2. **Prompt Construction**
-   - An `EAPrompt` object is initialized with a specific `prompt_type`
-     (e.g., `"ERROR_ZHEN_ITEMIZED_SRC"` or `"ERROR_ZHEN_ITEMIZED_REF"`).
+   - `prompt_types` lists prompt type patterns where `{LANG}` is replaced by each
+     language pair (e.g., `"ERROR_{LANG}_ITEMIZED_SRC"`); `ALL_PROMPT_TYPES`
+     covers every {ERROR, SINGLESTEP} x {DETAILED, ITEMIZED} x {SRC, REF} variant.
    - Each input triple (`src`, `tgt`, `ref`) is formatted into evaluation prompts 
      according to the prompt context templates defined in `constants.context`.
 
 3. **Batch Processing**
-   - The script iterates through each system output file in the target folder,
-     generates evaluation queries for all segments, and stores them as JSON files.
+   - Every (language pair, prompt type, system) combination is one work unit.
+     Work units are spread over a process pool of `num_workers` processes.
+   - Each unit writes its own output file, so the output does not depend on
+     scheduling order (deterministic output).
    - Each output file includes both the original input data and the generated
-     message sequence for downstream inference.
+     message sequence (or template reference) for downstream inference.
 
 4. **Output**
    - Results are saved to `./results/queries/<lang_pair>/<prompt_type>/`
      with filenames corresponding to each translation system (e.g., `Online-A.json`).
+   - `file_format` selects the original indented `"json"` array (default, the
+     published layout) or line-delimited `"jsonl"` (one record per line,
+     readable one segment at a time).
+   - With `compact = True`, the few-shot prefix and instruction shared by all
+     queries are stored once in `_template.json`, and each record only keeps
+     `inputs` plus the template version (see `query_store.py`).
+
+5. **Segment Subsets**
+   - `segment_ids` (a list, or the path of a JSON list such as
+     `./results/gpt_random_sent_ids.json`) or `sample_size` (a random sample
+     drawn with `sample_seed`) restricts the queries to a subset of segments,
+     e.g. for pilot runs on expensive models (see `segments.py`).
+   - Only the selected lines of the src/ref/sys files are read, through a
+     byte-offset line index, and each record keeps its original
+     `segment_id`. Use a separate `output_root` for subsets.
 
 ------------------------------------------------------------------------------
 Notes
 ------------------------------------------------------------------------------
-- Ensure all source, reference, and translation files have the same length.
-- For reference-free prompts, set `prompt_type` to a `_SRC` variant.
+- Ensure all source, reference, and translation files have the same length
+  (checked while streaming; a mismatch raises ValueError).
+- Inputs are streamed line by line and records are written one at a time, so
+  peak memory does not depend on the size of the test set.
+- For reference-free prompts, use a `_SRC` prompt type variant.
 - Generated query JSON files are used directly by the inference engine
   for LLM-based translation evaluation.
 
 ===============================================================================
 """
 
+import itertools
 import os
 import os.path as osp
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
 
-from eaprompt import EAPrompt
+from eaprompt import EAPrompt, PROMPT_TYPE_CONFIGS
+from query_store import save_template
+from segments import LineIndex, SegmentSelection, read_parallel_lines
 
 from utils import (
-    save_json, 
-    readlines_txt
+    RecordWriter, 
+    readlines_txt,
+    zip_equal
 )
 
+ALL_PROMPT_TYPES = [
+    f"{_step}_{{LANG}}_{_demo}_{_is_ref}"
+    for _step in PROMPT_TYPE_CONFIGS["STEP"]
+    for _demo in PROMPT_TYPE_CONFIGS["DEMO"]
+    for _is_ref in PROMPT_TYPE_CONFIGS["IS_REF"]
+]
+
 # Parameters (edit if needed)
-data_folder = "./EAPrompt/wmt22/" # release version
-dataset, lang_pair = 'wmt22', 'zhen'
-prompt_type = f"ERROR_{lang_pair.upper()}_ITEMIZED_SRC"
-output_folder = f"./results/queries/{lang_pair}/{prompt_type}"
+data_folder = "./EAPrompt/" # release version
+dataset = 'wmt22'
+lang_pairs = ['zhen'] # e.g. ['ende', 'enru', 'zhen']
+prompt_types = ["ERROR_{LANG}_ITEMIZED_SRC"] # e.g. ALL_PROMPT_TYPES
+output_root = "./results/queries"
+file_format = "json" # "json" (published layout) or "jsonl"
+compact = False # store the shared few-shot prefix once instead of a full query per record
+num_workers = os.cpu_count()
+segment_ids = None # subset of segment IDs (list or JSON file path), e.g. "./results/gpt_random_sent_ids.json"
+sample_size = None # or a random subset of this many segments
+sample_seed = 0
 
-# locate data paths
-src_lang, tgt_lang = lang_pair[:2], lang_pair[2:]
-srcs_path = osp.join(data_folder, f"{dataset}/{dataset}.{lang_pair}.src.{src_lang}")
-refs_path = osp.join(data_folder, f"{dataset}/{dataset}.{lang_pair}.ref.{tgt_lang}")
-tgts_folder = osp.join(data_folder, f"{dataset}/{dataset}.{lang_pair}.sys.{tgt_lang}")
+# shared source/reference lines of each language pair, set once per worker process
+_SHARED_INPUTS = {}
 
-# create EAPrompt object
-EAP = EAPrompt(prompt_type=prompt_type)
+def locate_data(lang_pair):
+    """Return the source path, reference path and system translation folder of a language pair."""
+    src_lang, tgt_lang = lang_pair[:2], lang_pair[2:]
+    srcs_path = osp.join(data_folder, f"{dataset}/{dataset}.{lang_pair}.src.{src_lang}")
+    refs_path = osp.join(data_folder, f"{dataset}/{dataset}.{lang_pair}.ref.{tgt_lang}")
+    tgts_folder = osp.join(data_folder, f"{dataset}/{dataset}.{lang_pair}.sys.{tgt_lang}")
+    return srcs_path, refs_path, tgts_folder
 
-# create output folder
-os.makedirs(output_folder, exist_ok=True)
+def init_worker(shared_inputs):
+    _SHARED_INPUTS.update(shared_inputs)
 
-# generate error queries for each system
-for file in os.listdir(tgts_folder):
+def iter_eval_inputs(lang_pair, tgts_path, use_ref):
+    """Stream eval inputs for one system file, checking its length against the shared src/ref lines."""
+    ids, num_lines, srcs, refs = _SHARED_INPUTS[lang_pair]
+    if ids is None:
+        tgts = open(tgts_path, 'r', encoding='utf-8')
+    else: # subset: only the selected lines are read
+        index = LineIndex(tgts_path)
+        if len(index) != num_lines:
+            raise ValueError(f"Length mismatch: srcs({num_lines}), {tgts_path}({len(index)})")
+        tgts = closing(index.iter_lines(ids))
+    with tgts as f:
+        for _src, _tgt, _ref in zip_equal(srcs, f, refs, names=["srcs", tgts_path, "refs"]):
+            if use_ref:
+                yield {
+                    "src": _src,
+                    "tgt": _tgt.strip(),
+                    "ref": _ref
+                }
+            else:
+                yield {
+                    "src": _src,
+                    "tgt": _tgt.strip(),
+                }
+
+def generate_system_queries(lang_pair, prompt_type, tgts_path, output_path):
+    """One work unit: write the queries of one prompt type for one system file."""
     
-    system = ".".join(file.split('.')[2:-1]) # extract system name, such as "Online-A"
+    EAP = EAPrompt(prompt_type=prompt_type)
+    eval_inputs = iter_eval_inputs(lang_pair, tgts_path, use_ref="REF" in prompt_type)
     
-    # read files
-    srcs = readlines_txt(srcs_path)
-    refs = readlines_txt(refs_path)
-    tgts = readlines_txt(osp.join(tgts_folder, file))
-    assert len(srcs) == len(refs) == len(tgts), f"Length mismatch: srcs({len(srcs)}), refs({len(refs)}), tgts({len(tgts)})"
+    if compact:
+        # refer to the shared template; messages are rebuilt when needed
+        version = EAP.get_template()["version"]
+        results = ({
+            "inputs": _eval_inputs,
+            "template": version
+        } for _eval_inputs in eval_inputs)
     
-    # transform into inputs
-    if "REF" in prompt_type:
-        eval_inputs = [{
-            "src": _src,
-            "tgt": _tgt,
-            "ref": _ref
-        } for _src, _tgt, _ref in zip(srcs, tgts, refs)]
     else:
-        eval_inputs = [{
-            "src": _src,
-            "tgt": _tgt,
-        } for _src, _tgt, _ref in zip(srcs, tgts, refs)]
+        # generate queries lazily and attach queries message with input
+        eval_inputs, query_inputs = itertools.tee(eval_inputs)
+        results = ({
+            "inputs": _eval_inputs,
+            "query": _query
+        } for _eval_inputs, _query in zip(eval_inputs, EAP.iter_queries(query_inputs)))
+    
+    ids = _SHARED_INPUTS[lang_pair][0]
+    if ids is not None:
+        # keep the original segment IDs, to merge the responses back with full runs
+        results = ({"segment_id": _id, **result} for _id, result in zip(ids, results))
     
-    # generate queries
-    queries = EAP.generate_queries_batch(eval_inputs)
+    # save (records are written one at a time; a length mismatch leaves no partial output)
+    with RecordWriter(output_path + ".tmp", jsonl=(file_format == "jsonl")) as writer:
+        for result in results:
+            writer.write(result)
+    os.replace(output_path + ".tmp", output_path)
+    return output_path
+
+def plan_work_units():
+    """Load the shared inputs once per language pair and list every (lang pair, prompt type, system) unit."""
+    
+    selection = SegmentSelection.from_params(segment_ids, sample_size, sample_seed)
+    shared_inputs, units = {}, []
+    for lang_pair in lang_pairs:
+        srcs_path, refs_path, tgts_folder = locate_data(lang_pair)
+        if selection is None:
+            ids, (srcs, refs) = None, (readlines_txt(srcs_path), readlines_txt(refs_path))
+            if len(srcs) != len(refs):
+                raise ValueError(f"Length mismatch: srcs({len(srcs)}), refs({len(refs)})")
+            num_lines = len(srcs)
+        else:
+            num_lines = len(LineIndex(srcs_path))
+            ids = selection.resolve(range(num_lines))
+            srcs, refs = read_parallel_lines([srcs_path, refs_path], ids)
+            print(f"{lang_pair}: {len(ids)} of {num_lines} segments selected.")
+        shared_inputs[lang_pair] = (ids, num_lines, srcs, refs)
+        
+        for pattern in prompt_types:
+            prompt_type = pattern.format(LANG=lang_pair.upper())
+            output_folder = osp.join(output_root, lang_pair, prompt_type)
+            os.makedirs(output_folder, exist_ok=True)
+            if compact:
+                save_template(EAPrompt(prompt_type=prompt_type).get_template(), output_folder)
+            
+            for file in sorted(os.listdir(tgts_folder)):
+                system = ".".join(file.split('.')[2:-1]) # extract system name, such as "Online-A"
+                units.append((lang_pair, prompt_type, osp.join(tgts_folder, file), osp.join(output_folder, f"{system}.{file_format}")))
+    
+    return shared_inputs, units
+
+if __name__ == "__main__":
     
-    # attach queries message with input
-    results = [{
-        "inputs": _eval_inputs,
-        "query": _query
-    } for _eval_inputs, _query in zip(eval_inputs, queries)]
+    shared_inputs, units = plan_work_units()
+    print(f"{len(units)} work units ({len(lang_pairs)} language pairs x {len(prompt_types)} prompt types x systems).")
     
-    # save
-    save_json(results, osp.join(output_folder, f"{system}.json"))
\ No newline at end of file
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker, initargs=(shared_inputs,)) as executor:
+        futures = [executor.submit(generate_system_queries, *unit) for unit in units]
+        for future in futures:
+            print(f"Saved to {future.result()}.")
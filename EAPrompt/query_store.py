@@ -0,0 +1,110 @@
+"""
+===============================================================================
+Compact Query Storage with Shared Few-shot Templates
+===============================================================================
+
+Every query of a prompt type shares the same few-shot prefix (the example
+user turn and the example assistant turn) and the same instruction; only the
+evaluated segment differs. This module stores those shared parts once per
+query folder and keeps only `inputs` in each record.
+
+------------------------------------------------------------------------------
+Storage Layout
+------------------------------------------------------------------------------
+    queries/<lang_pair>/<prompt_type>/
+        ├── _template.json          # EAPrompt.get_template() output
+        └── <system_name>.jsonl     # {"inputs": {...}, "template": "<version>"}
+
+The full message list of a record is rebuilt on the fly by `expand_query`,
+and is identical to `EAPrompt(prompt_type).generate_query(inputs)`.
+
+------------------------------------------------------------------------------
+Functions
+------------------------------------------------------------------------------
+- `save_template` / `load_template`: write and read `_template.json`.
+- `compact_record` / `expand_record`: convert between full and compact records,
+  checking that the round trip is exact.
+- `get_query`: message list of a full or compact record, built only when needed.
+- `iter_query_records`: stream the records of a query file with `query` always
+  present, whichever format the file uses.
+- `compact_query_tree`: convert an existing full query tree to the compact form.
+
+===============================================================================
+"""
+
+import os
+
+from utils import iter_records, read_json, save_json, save_records
+
+TEMPLATE_FILE = "_template.json"
+
+def save_template(template: dict, folder: str) -> None:
+    save_json(template, os.path.join(folder, TEMPLATE_FILE))
+
+def load_template(folder: str):
+    """Return the template stored in `folder`, or None for folders holding full queries."""
+    path = os.path.join(folder, TEMPLATE_FILE)
+    return read_json(path) if os.path.exists(path) else None
+
+def expand_query(template: dict, inputs: dict[str, str]) -> list[dict[str, str]]:
+    """Rebuild the full message list of one segment from the shared template."""
+    user_part1 = template["input_template"].format(**inputs).strip()
+    return [
+        *template["prefix"],
+        {"role": "user", "content": user_part1 + "\n" + template["instruction"]},
+    ]
+
+def compact_record(record: dict, template: dict) -> dict:
+    """Replace the `query` of a full record with a reference to the template."""
+
+    if expand_query(template, record["inputs"]) != record["query"]:
+        raise ValueError(f"Query does not match template {template['prompt_type']} ({template['version']}): {record['inputs']}")
+    compacted = {}
+    for key, value in record.items(): # keep the field order of the record
+        if key == "query":
+            compacted["template"] = template["version"]
+        else:
+            compacted[key] = value
+    return compacted
+
+def expand_record(record: dict, template: dict) -> dict:
+    """Return a full record (with `query`) from a compact one; full records are returned unchanged."""
+
+    if "query" in record:
+        return record
+    if record["template"] != template["version"]:
+        raise ValueError(f"Record refers to template {record['template']}, but {template['version']} is loaded.")
+
+    expanded = {}
+    for key, value in record.items():
+        if key == "template":
+            expanded["query"] = expand_query(template, record["inputs"])
+        else:
+            expanded[key] = value
+    return expanded
+
+def get_query(record: dict, template: dict) -> list[dict[str, str]]:
+    """Message list of a record, full or compact."""
+    return record["query"] if "query" in record else expand_query(template, record["inputs"])
+
+def iter_query_records(folder: str, file_name: str, template: dict = None):
+    """Stream the records of one query file, with `query` rebuilt for compact records."""
+
+    if template is None:
+        template = load_template(folder)
+    for record in iter_records(os.path.join(folder, file_name)):
+        yield expand_record(record, template) if template is not None else record
+
+def compact_query_tree(src_folder: str, dst_folder: str, template: dict) -> None:
+    """Convert the full query files of one prompt type into the compact form, verifying every record."""
+
+    os.makedirs(dst_folder, exist_ok=True)
+    save_template(template, dst_folder)
+    for file_name in sorted(os.listdir(src_folder)):
+        if file_name == TEMPLATE_FILE:
+            continue
+        stem = os.path.splitext(file_name)[0]
+        save_records(
+            (compact_record(record, template) for record in iter_records(os.path.join(src_folder, file_name))),
+            os.path.join(dst_folder, f"{stem}.jsonl"),
+        )
@@ -0,0 +1,144 @@
+"""
+===============================================================================
+Distributed Response Generation with a Work Queue
+===============================================================================
+
+This script is the scale-out counterpart of `responses_generate.py`: the
+segments of a prompt type are put in a durable task queue (see
+`workqueue.py`), and any number of worker processes, on one or several
+machines sharing the queue file, lease and infer them.
+
+------------------------------------------------------------------------------
+Workflow Overview
+------------------------------------------------------------------------------
+1. **Fill** the queue with the first stage (ERROR or SINGLESTEP) of every
+   segment of `queries_folder` (restricted to `segment_ids` / `sample_size`
+   if given, see `segments.py`):
+       python EAPrompt/queue_generate.py init
+
+2. **Work**, as many times as needed, on any machine:
+       python EAPrompt/queue_generate.py work --processes 4
+   Each worker process leases `lease_size` tasks at a time and sends them
+   through its own `InferenceEngine`. When an ERROR response arrives, the
+   COUNT task of the segment is queued. Workers exit when the queue is empty.
+   A task whose request fails (e.g. rejected by the server) is released on
+   its own, without affecting the other tasks of the lease. Leases are
+   renewed from a timer while the batch runs, and tasks of crashed workers
+   are handed out again once their lease expires.
+
+3. **Merge** the results into the standard response files, in
+   `responses_folder` and `file_format`, for every finished system:
+       python EAPrompt/queue_generate.py merge
+
+`status` prints the number of tasks per stage and status, and `retry` puts
+the tasks that failed `max_attempts` times back in the queue.
+
+===============================================================================
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import time
+
+from constants.model_configs import MODEL_CONFIGS
+from eaprompt import EAPrompt
+from inference import InferenceEngine
+from query_store import get_query, load_template
+from segments import SegmentSelection
+from workqueue import CompletionWriter, LeaseRenewer, Task, WorkQueue, fill_queue, merge_results
+
+#### Parameters
+
+lang_pair = 'ende'
+prompt_type = f"ERROR_{lang_pair.upper()}_ITEMIZED_REF"
+model_name = "/model/name/in/config"
+file_format = "json" # output format, "json" (published layout) or "jsonl"
+queries_folder = f"./results/queries/{lang_pair}/{prompt_type}/" # release version
+responses_folder = f"./results/responses/{lang_pair}/{model_name}/{prompt_type}"
+queue_path = os.path.join(responses_folder, ".queue", "tasks.db") # on a shared filesystem for several machines
+lease_size = 64 # tasks leased by a worker at once
+lease_seconds = 600 # leases not completed or renewed in time are handed out again
+max_attempts = 3
+poll_interval = 5 # seconds between lease attempts while other workers hold the remaining tasks
+segment_ids = None # subset of segment IDs (list or JSON file path)
+sample_size = None # or a random subset of this many segments
+sample_seed = 0
+
+#### Worker
+
+def run_worker() -> None:
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    queue = WorkQueue(queue_path, lease_seconds=lease_seconds, max_attempts=max_attempts)
+    engine = InferenceEngine(model_name=model_name)
+    template = load_template(queries_folder)
+    count_prompt = EAPrompt(prompt_type="COUNT")
+
+    while True:
+        tasks = queue.lease(worker, lease_size)
+        if not tasks:
+            if queue.unfinished() == 0:
+                break
+            time.sleep(poll_interval) # leased tasks may still fail, or queue COUNT tasks
+            continue
+        print(f"[{worker}] leased {len(tasks)} tasks.")
+        process_lease(queue, engine, worker, tasks, template, count_prompt)
+
+    engine.close()
+    queue.close()
+    print(f"[{worker}] queue empty, exiting.")
+
+def process_lease(queue: WorkQueue, engine, worker: str, tasks: list[Task], template, count_prompt) -> int:
+    """
+    Infer the leased `tasks`, completing each as its response arrives (committed from a `CompletionWriter`
+    thread, not in the event loop); failed tasks are released one by one.
+    """
+
+    writer = CompletionWriter(queue, worker)
+
+    def _record(i, response):
+        task = tasks[i]
+        followups = [("count", {"query": count_prompt.generate_query(response)})] if task.stage == "error" else []
+        writer.complete(task, response, followups)
+
+    with LeaseRenewer(queue, worker, lambda: [task for task in tasks if task.id not in writer.committed]), writer:
+        results = engine.infer_batch([get_query(task.payload, template) for task in tasks], on_result=_record,
+                                     tags=[{"system": task.system, "segments": [task.segment], "worker": worker}
+                                           for task in tasks],
+                                     return_exceptions=True)
+
+    failed = 0
+    for task, result in zip(tasks, results):
+        if isinstance(result, Exception):
+            queue.release(worker, task, str(result))
+            failed += 1
+    if failed:
+        print(f"[{worker}] {failed}/{len(tasks)} tasks failed and were released.")
+    return failed
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", choices=["init", "work", "status", "merge", "retry"])
+    parser.add_argument("--processes", type=int, default=1, help="local worker processes (work)")
+    args = parser.parse_args()
+
+    if args.action == "work":
+        if model_name not in MODEL_CONFIGS:
+            parser.error(f"unknown model {model_name}")
+        processes = [multiprocessing.Process(target=run_worker) for _ in range(args.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        args.action = "status"
+
+    queue = WorkQueue(queue_path, lease_seconds=lease_seconds, max_attempts=max_attempts)
+    if args.action == "init":
+        fill_queue(queue, queries_folder, prompt_type, SegmentSelection.from_params(segment_ids, sample_size, sample_seed))
+    elif args.action == "merge":
+        merge_results(queue, queries_folder, responses_folder, file_format)
+    elif args.action == "retry":
+        print(f"{queue.retry_failed()} failed tasks queued again.")
+    print(f"Tasks: {queue.counts()}")
@@ -0,0 +1,221 @@
+"""
+===============================================================================
+Adaptive Rate Limiting for LLM Requests
+===============================================================================
+
+This module implements the rate-limit subsystem used by `InferenceEngine`.
+All limits are configured per model through the `OpenAIConfig` entries in
+`constants.model_configs.MODEL_CONFIGS`.
+
+------------------------------------------------------------------------------
+Components
+------------------------------------------------------------------------------
+1. **TokenBucket**
+   - Smooths requests to a per-minute budget. Two buckets are used: one for
+     requests/min (`requests_per_minute`) and one for tokens/min
+     (`tokens_per_minute`, estimated from the prompt length and `max_tokens`).
+
+2. **AdaptiveConcurrency**
+   - Replaces a fixed semaphore. The in-flight limit is halved when the
+     provider throttles us (multiplicative decrease) and grows by about one
+     slot per window of successful requests (additive increase), bounded by
+     `max_concurrency`.
+   - A batch may set its own bound instead (`batch_cap`, from the
+     `max_concurrency` argument of the engine); it is kept apart from the
+     adaptive window, so a small batch does not lower the next batches.
+
+3. **Error Handling**
+   - `classify_error(e)` separates rate limits (429), timeouts, connection
+     errors, server errors (5xx) and client errors (4xx). Client errors are
+     not retried.
+   - `retry_after(e)` reads the `Retry-After` / `retry-after-ms` headers.
+   - `backoff_delay(...)` computes jittered exponential backoff.
+
+4. **RateLimiter**
+   - Combines the above. A `Retry-After` received on any request pauses all
+     requests until the given time.
+   - One limiter is kept per `InferenceEngine`, so that the concurrency
+     window, the token budgets and `Retry-After` pauses carry over from one
+     batch to the next (e.g. the chunks of `responses_generate.py`).
+
+===============================================================================
+"""
+
+import asyncio
+import email.utils
+import random
+import time
+from typing import Optional
+
+import openai
+
+from constants.model_configs import OpenAIConfig
+
+RETRYABLE_STATUS = {408, 409, 429}
+THROTTLE_COOLDOWN = 1.0 # seconds between two multiplicative decreases
+
+class TokenBucket:
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None) -> None:
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity if capacity is not None else rate_per_minute / 6 # 10 seconds of budget
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1) -> None:
+        amount = min(amount, self.capacity) # a single oversized request must still go through
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def adjust(self, delta: float) -> None:
+        """Correct an estimate after the fact (positive delta consumes more budget)."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - delta)
+
+class AdaptiveConcurrency:
+
+    def __init__(self, max_limit: int, min_limit: int = 1, adaptive: bool = True) -> None:
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.adaptive = adaptive
+        self.limit = float(max_limit)
+        self.batch_cap: Optional[int] = None # concurrency cap of the current batch, None for no cap
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = None
+        self._loop = None
+
+    def _condition(self) -> asyncio.Condition:
+        """Condition of the running event loop (the synchronous engine API runs each batch in a new loop)."""
+
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._cond, self._loop = asyncio.Condition(), loop
+        return self._cond
+
+    async def __aenter__(self) -> None:
+        cond = self._condition()
+        async with cond:
+            await cond.wait_for(lambda: self.in_flight < self.current_limit())
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc_info) -> None:
+        cond = self._condition()
+        async with cond:
+            self.in_flight -= 1
+            cond.notify_all()
+
+    def _ceiling(self) -> float:
+        return float(self.batch_cap or self.max_limit)
+
+    def current_limit(self) -> int:
+        """Requests allowed in flight: the adaptive window, capped for the current batch."""
+        return max(1, int(min(self.limit, self._ceiling())))
+
+    def on_success(self) -> None:
+        if self.adaptive and self.limit < self._ceiling(): # the window only grows while it is what limits us
+            self.limit = min(self._ceiling(), self.limit + 1 / self.limit)
+
+    def on_throttle(self) -> None:
+        now = time.monotonic()
+        if self.adaptive and now - self._last_decrease >= THROTTLE_COOLDOWN:
+            self.limit = max(self.min_limit, min(self.limit, self._ceiling()) / 2)
+            self._last_decrease = now
+
+def classify_error(e: Exception) -> str:
+    """Return one of "rate_limit", "timeout", "connection", "server" or "client"."""
+
+    if isinstance(e, openai.RateLimitError):
+        return "rate_limit"
+    if isinstance(e, (openai.APITimeoutError, asyncio.TimeoutError)):
+        return "timeout"
+    if isinstance(e, openai.APIConnectionError):
+        return "connection"
+
+    status = getattr(e, "status_code", None)
+    if status == 429:
+        return "rate_limit"
+    if status is None or status >= 500 or status in RETRYABLE_STATUS:
+        return "server" # unknown failures are retried like server errors
+    return "client"
+
+def retry_after(e: Exception) -> Optional[float]:
+    """Seconds to wait as requested by the server, if any."""
+
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        date = email.utils.parsedate_to_datetime(value) # HTTP-date form
+        return max(0.0, date.timestamp() - time.time()) if date is not None else None
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Exponential backoff with full jitter, `attempt` starting from 1."""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+def estimate_tokens(messages: list[dict[str, str]], max_tokens: int) -> int:
+    """Rough token estimate of one request (about 4 characters per token) used for the tokens/min bucket."""
+    return sum(len(message["content"]) for message in messages) // 4 + max_tokens
+
+class RateLimiter:
+
+    def __init__(self, cfg: OpenAIConfig, max_concurrency: Optional[int] = None) -> None:
+        self.cfg = cfg
+        self.concurrency = AdaptiveConcurrency(
+            max_concurrency or cfg.max_concurrency,
+            adaptive=cfg.adaptive_concurrency,
+        )
+        self.request_bucket = TokenBucket(cfg.requests_per_minute) if cfg.requests_per_minute else None
+        self.token_bucket = TokenBucket(cfg.tokens_per_minute) if cfg.tokens_per_minute else None
+        self.paused_until = 0.0
+
+    async def wait(self, estimated_tokens: int) -> None:
+        """Block until the request budgets allow one more request."""
+
+        delay = self.paused_until - time.monotonic()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.paused_until - time.monotonic()
+
+        if self.request_bucket is not None:
+            await self.request_bucket.acquire(1)
+        if self.token_bucket is not None:
+            await self.token_bucket.acquire(estimated_tokens)
+
+    def on_success(self, estimated_tokens: int, used_tokens: Optional[int] = None) -> None:
+        self.concurrency.on_success()
+        if self.token_bucket is not None and used_tokens is not None:
+            self.token_bucket.adjust(used_tokens - estimated_tokens)
+
+    def on_error(self, kind: str, attempt: int, server_delay: Optional[float]) -> float:
+        """Update the limiter after a failed attempt and return how long to sleep before retrying."""
+
+        if kind == "rate_limit":
+            self.concurrency.on_throttle()
+        if server_delay is not None:
+            self.paused_until = max(self.paused_until, time.monotonic() + server_delay)
+            return server_delay
+        return backoff_delay(attempt, self.cfg.retry_sleep, self.cfg.backoff_max)
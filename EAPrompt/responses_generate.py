@@ -16,16 +16,20 @@ Workflow Overview
 1. **Input Setup**
    - `lang_pair` defines the translation language pair (e.g., "ende", "zhen").
    - `prompt_type` specifies the evaluation configuration 
-     (e.g., "ERROR_ZHEN_ITEMIZED_REF" or "ERROR_ZHEN_SINGLESTEP_REF").
+     (e.g., "ERROR_ZHEN_ITEMIZED_REF" or "SINGLESTEP_ZHEN_ITEMIZED_REF").
    - `model_name` must match one of the model identifiers defined in 
      `constants.model_configs`.
-   - Input queries are read from `./results/queries/<lang_pair>/<prompt_type>/`.
+   - Input queries are read from `./results/queries/<lang_pair>/<prompt_type>/`,
+     either `.json` or line-delimited `.jsonl` files, with full or compact
+     (template-based, see `query_store.py`) records.
 
 2. **Inference**
    - Initializes an `InferenceEngine` for the selected model.
    - If using a two-step evaluation (error + count), a separate 
      `EAPrompt(prompt_type="COUNT")` is used to construct count queries.
-   - For each system file, runs inference on all queries via `infer_batch()`.
+   - For each system file, runs inference on all queries via `infer_batch()`
+     (SINGLESTEP) or `infer_chain()` (two-step), which submits each segment's
+     COUNT query as soon as its ERROR response arrives.
 
 3. **Response Generation**
    - For SINGLESTEP mode:
@@ -33,11 +37,77 @@ Workflow Overview
    - For two-step mode:
        → Generates count queries from the error responses and stores both
          `"error_response"` and `"count_response"` fields.
+   - `count_mode` selects how the COUNT step is done in two-step mode:
+       → `"llm"`: send `INSTRUCTION_COUNT` to the model (default).
+       → `"regex"`: count the itemized errors locally (see `counting.py`) and
+         only query the model for responses that cannot be parsed confidently.
+         The parse coverage rate is reported for each system.
 
 4. **Output**
    - Saves all annotated responses to  
      `./results/responses/<lang_pair>/<model_name>/<prompt_type>/`
-     using the same filenames as the input query JSONs.
+     using the same system names as the input query files, in `file_format`.
+     Compact records stay compact; the query template is copied alongside.
+   - Query files are streamed in chunks of `chunk_size` segments, and each chunk
+     is written out before the next one is read, so memory does not grow with
+     the size of the file (for `.jsonl` inputs).
+
+5. **Cross-system Deduplication**
+   - With `dedup = True`, every query of the prompt type is hashed first, and
+     identical queries across system files (e.g. identical short translations)
+     are sent once; the responses are copied to every record that needs them
+     (see `dedup.py`). The dedup ratio is reported.
+   - Deduplication only applies at temperature 0 in the model configuration.
+     At a higher temperature (e.g. with `num_samples > 1`), duplicates would
+     share one sampled response instead of drawing their own, which correlates
+     their samples and changes the scores, so every query is sent.
+
+6. **Checkpoint and Resume**
+   - Every completed segment is appended to a journal
+     (`<responses_folder>/.journal/<system>.journal.jsonl`) as soon as its
+     response arrives (see `checkpoint.py`).
+   - On restart, systems whose output file already exists are skipped, and
+     segments that already have their response fields in the journal are not
+     sent again. The final JSON is rebuilt from the journal.
+
+7. **Metrics**
+   - Requests are tagged with their system and segment indices in the
+     engine's request metrics; set `trace_path` in the model configuration to
+     keep a per-request trace (see `metrics.py`).
+
+8. **Truncation**
+   - With `truncate = True`, responses are cut where the answer ends (see
+     `truncation.py`): ERROR responses at the first of `truncate_keywords`
+     after `truncate_start` characters, COUNT responses after the "x, x" line
+     and SINGLESTEP responses after their trailing "x, x" line.
+   - With `stream = True` in the model configuration, the requests are
+     stopped as soon as the answer is complete, instead of generating up to
+     `max_tokens`; the saved responses are the same.
+
+9. **Segment Subsets**
+   - `segment_ids` (a list, or the path of a JSON list such as
+     `./results/gpt_random_sent_ids.json`) or `sample_size` (a random sample
+     drawn with `sample_seed`) restricts inference to a subset of segments
+     (see `segments.py`); the other records are not sent nor written.
+   - Segments are identified by the `segment_id` field of the query records
+     (as written by `queries_generate.py` for subsets), or by their position
+     in the file. Output records keep their `segment_id`, so that they can be
+     merged back with full runs. Use a separate `responses_folder` for subsets.
+
+10. **Self-consistency**
+   - With `num_samples > 1` (and a temperature > 0 in the model
+     configuration), each ERROR (or SINGLESTEP) request asks for `num_samples`
+     completions at once, and each sampled ERROR response gets its own COUNT
+     step (see `consistency.py`). The few-shot prefix is still sent once per
+     segment. With `count_mode = "regex"`, unparsed samples are left out
+     instead of being sent to the LLM. Samples whose ERROR step is already
+     done (journaled before a restart, or kept by a counts-only rerun of
+     `pipeline.py`) only get their COUNT requests.
+   - The samples are parsed into counts and aggregated with `aggregation`
+     ("mean", "median" or "vote"). Records keep the first sample in the usual
+     fields, all samples in `<field>_samples`, and the aggregated `counts`
+     with their `count_variance` and `score_variance`, used by `scoring.py`.
+     Use a separate `responses_folder` for sampled runs.
 
 ------------------------------------------------------------------------------
 Notes
@@ -46,6 +116,8 @@ Notes
   correctly defines API key, base URL, and model path.
 - Ensure query files are generated beforehand using the batch query script.
 - This script supports both single-step and two-step evaluation modes.
+- The steps above are run by `ResponseRun`, which `pipeline.py` also uses for
+  its responses and counts stages.
 
 ===============================================================================
 """
@@ -53,42 +125,283 @@ Notes
 import os
 from inference import InferenceEngine
 from eaprompt import EAPrompt
-from utils import read_json, save_json
+from checkpoint import SegmentJournal
+from consistency import AGGREGATIONS, sample_fields
+from counting import extract_count
+from dedup import QueryDeduplicator, query_key
+from query_store import TEMPLATE_FILE, get_query, load_template, save_template
+from segments import SegmentSelection, iter_segment_records
+from truncation import truncation_for_stage
+from utils import RecordWriter
 
 #### Parameters
 
 lang_pair = 'ende'
 prompt_type = f"ERROR_{lang_pair.upper()}_ITEMIZED_REF"
 model_name = "/model/name/in/config"
+count_mode = "llm" # "llm" or "regex" (local counting with LLM fallback, for ITEMIZED prompts)
+file_format = "json" # output format, "json" (published layout) or "jsonl"
+chunk_size = 2000 # number of segments held in memory at once
+dedup = True # send identical queries across system files only once (at temperature 0 only)
+truncate = False # cut the rambling tail of responses (early stop when the model config has `stream`)
+truncate_keywords = [] # e.g. ["\n\n\n", "Note:"], ERROR step only
+truncate_start = 0 # characters kept before looking for `truncate_keywords`
+segment_ids = None # subset of segment IDs (list or JSON file path), e.g. "./results/gpt_random_sent_ids.json"
+sample_size = None # or a random subset of this many segments
+sample_seed = 0
+num_samples = 1 # completions sampled per segment (self-consistency, needs a temperature > 0)
+aggregation = "mean" # "mean", "median" or "vote", to aggregate the counts of the samples
 queries_folder = f"./results/queries/{lang_pair}/{prompt_type}/" # release version
 responses_folder = f"./results/responses/{lang_pair}/{model_name}/{prompt_type}"
-os.makedirs(responses_folder, exist_ok=True)
 
 #### Response Generation Pipeline
 
-generator = InferenceEngine(model_name=model_name)
+class ResponseRun:
+    """
+    Response generation for the system files of one prompt type, with the parameters above.
+    `pipeline.py` runs its responses and counts stages through it, one system at a time.
+    """
 
-EAP = EAPrompt(prompt_type="COUNT") # use when two-step querying
+    def __init__(self, generator, prompt_type, queries_folder, responses_folder):
+        if aggregation not in AGGREGATIONS:
+            raise ValueError(f"Unknown aggregation {aggregation!r}, expected one of {AGGREGATIONS}.")
+        self.generator = generator
+        self.prompt_type = prompt_type
+        self.queries_folder = queries_folder
+        self.responses_folder = responses_folder
+        self.journal_folder = os.path.join(responses_folder, ".journal")
+        self.EAP = EAPrompt(prompt_type="COUNT") # use when two-step querying
+        self.error_truncation = truncation_for_stage(prompt_type, truncate_keywords, truncate_start) if truncate else None
+        self.count_truncation = truncation_for_stage("COUNT") if truncate else None
+        self.selection = SegmentSelection.from_params(segment_ids, sample_size, sample_seed)
+        self.template = None # loaded with the first system, None for full query files
+        self.dedup = dedup and generator.cfg.temperature == 0
+        if dedup and not self.dedup:
+            print(f"Deduplication disabled at temperature {generator.cfg.temperature}: every query is sampled on its own.")
+        self.deduplicator = QueryDeduplicator()
+        self.unscanned = [] # query files to hash into the deduplicator before the next system
+        self.system_name = None # tags the request metrics
 
-for file_name in os.listdir(queries_folder):
-    
-    print(f"MT system name: {file_name}")
-    
-    queries_file = read_json(os.path.join(queries_folder, file_name))
-    queries = [_query_dict["query"] for _query_dict in queries_file]
-    responses = generator.infer_batch(queries)
-    
-    if "SINGLESTEP" in prompt_type: # single step querying
-        for _query_dict, _response in zip(queries_file, responses):
-            _query_dict["singlestep_response"] = _response
-            
-    else:
-        count_queries = EAP.generate_queries_batch(responses)
-        print("Generating Count Responses:")
-        count_responses = generator.infer_batch(count_queries)
+    def list_pending_files(self):
+        """Query files whose responses have not been saved yet."""
+        pending_files = []
+        for file_name in sorted(os.listdir(self.queries_folder)):
+            if file_name == TEMPLATE_FILE:
+                continue
+            output_path = os.path.join(self.responses_folder, f"{os.path.splitext(file_name)[0]}.{file_format}")
+            if os.path.exists(output_path):
+                print(f"{output_path} already exists, skipped.")
+                continue
+            pending_files.append((os.path.join(self.queries_folder, file_name), output_path))
+        return pending_files
+
+    def expect(self, query_path):
+        """Announce a query file that will be run, so that its queries are deduplicated with the other files."""
+        if self.dedup:
+            self.unscanned.append(query_path)
+
+    def infer_pending(self, journal, done, pending, queries, fields, followups=(), truncations=(), samples=1):
+        """
+        Run (possibly multi-stage) inference for the `pending` segment indices,
+        journaling each stage's response under `fields[stage]` as soon as it arrives.
+        `truncations` gives the truncation rule of each stage; with `samples > 1`, responses are lists of samples.
+        With deduplication, one request is sent per unique query and its responses are
+        copied to all duplicates (in this chunk or in other system files).
+        """
+        if not pending:
+            return
+        deduplicator = self.deduplicator
+        
+        def _assign(idx, new_fields):
+            journal.append(idx, new_fields)
+            done.setdefault(idx, {}).update(new_fields)
+        
+        groups = {} # key -> (query, segment indices sharing it)
+        for idx, query in zip(pending, queries):
+            key = query_key(query) if self.dedup else idx
+            if key in groups:
+                groups[key][1].append(idx)
+                continue
+            answered = deduplicator.lookup(key, fields) if self.dedup else None
+            if answered is not None:
+                _assign(idx, answered)
+                deduplicator.consume(key, shared=True)
+                continue
+            groups[key] = (query, [idx])
+        
+        keys = list(groups)
+        print(f"{fields}: {len(pending)} segments to infer, {len(keys)} requests.")
+        
+        def _record(j, stage, response):
+            key, (_, members) = keys[j], groups[keys[j]]
+            for idx in members:
+                _assign(idx, {fields[stage]: response})
+            if self.dedup:
+                deduplicator.store(key, {fields[stage]: response})
+                if stage == len(fields) - 1:
+                    for i in range(len(members)):
+                        deduplicator.consume(key, shared=i > 0)
+        
+        self.generator.infer_chain([groups[key][0] for key in keys], followups=followups, on_result=_record,
+                                   tags=[{"system": self.system_name, "segments": groups[key][1]} for key in keys],
+                                   truncations=truncations, samples=samples)
+
+    def count_locally(self, journal, done, indices):
+        """
+        Fill `count_response` from the itemized error responses; returns the indices that still need the LLM.
+        With several samples, unparsed samples are kept as None (left out of the aggregate) instead.
+        """
+        unparsed = []
+        for idx in indices:
+            if num_samples > 1:
+                count = [extract_count(sample) for sample in done[idx]["error_response"]]
+                parsed = None not in count
+            else:
+                count = extract_count(done[idx]["error_response"])
+                parsed = count is not None
+            if not parsed:
+                unparsed.append(idx)
+            if parsed or num_samples > 1:
+                journal.append(idx, {"count_response": count})
+                done[idx]["count_response"] = count
+        if indices:
+            fallback = "with unparsed samples" if num_samples > 1 else "sent to the LLM"
+            print(f"Regex count coverage: {len(indices) - len(unparsed)}/{len(indices)} "
+                  f"({(len(indices) - len(unparsed)) / len(indices):.1%}), {len(unparsed)} {fallback}.")
+        return unparsed if num_samples == 1 else []
+
+    def count_samples(self, journal, done, pending):
+        """COUNT step of segments whose sampled ERROR responses are done: one COUNT query per error sample."""
+        if not pending:
+            return
         
-        for _query_dict, _response, _count_response in zip(queries_file, responses, count_responses):
-            _query_dict["error_response"] = _response
-            _query_dict["count_response"] = _count_response
+        flat = [(idx, k) for idx in pending for k in range(len(done[idx]["error_response"]))]
+        counts = {idx: [None] * len(done[idx]["error_response"]) for idx in pending}
+        remaining = {idx: len(counts[idx]) for idx in pending}
+        print(f"['count_response']: {len(pending)} sampled segments to count, {len(flat)} requests.")
+        
+        def _record(j, response):
+            idx, k = flat[j]
+            counts[idx][k] = response
+            remaining[idx] -= 1
+            if remaining[idx] == 0:
+                journal.append(idx, {"count_response": counts[idx]})
+                done[idx]["count_response"] = counts[idx]
+        
+        self.generator.infer_batch([self.EAP.generate_query(done[idx]["error_response"][k]) for idx, k in flat],
+                                   on_result=_record, tags=[{"system": self.system_name, "segments": [idx]} for idx, _ in flat],
+                                   truncation=self.count_truncation)
+
+    def generate_chunk(self, journal, done, chunk):
+        """Run the prompt's inference steps for a chunk of {segment index: query record}."""
+        
+        indices = list(chunk)
+        template, EAP = self.template, self.EAP
+        error_truncation, count_truncation = self.error_truncation, self.count_truncation
+        
+        if "SINGLESTEP" in self.prompt_type: # single step querying
+            pending = [idx for idx in indices if "singlestep_response" not in done.get(idx, {})]
+            self.infer_pending(journal, done, pending,
+                               [get_query(chunk[idx], template) for idx in pending], ["singlestep_response"],
+                               truncations=[error_truncation], samples=num_samples)
+                
+        elif count_mode == "regex":
+            pending = [idx for idx in indices if "error_response" not in done.get(idx, {})]
+            self.infer_pending(journal, done, pending,
+                               [get_query(chunk[idx], template) for idx in pending], ["error_response"],
+                               truncations=[error_truncation], samples=num_samples)
             
-    save_json(queries_file, os.path.join(responses_folder, file_name))
\ No newline at end of file
+            # count locally, with the LLM as fallback for unparsed responses
+            pending = self.count_locally(journal, done, [idx for idx in indices if "count_response" not in done[idx]])
+            self.infer_pending(journal, done, pending,
+                               [EAP.generate_query(done[idx]["error_response"]) for idx in pending], ["count_response"],
+                               truncations=[count_truncation])
+            
+        else:
+            # segments whose ERROR step finished before a restart only need their COUNT step
+            pending = [idx for idx in indices 
+                       if "error_response" in done.get(idx, {}) and "count_response" not in done[idx]]
+            if num_samples == 1:
+                self.infer_pending(journal, done, pending,
+                                   [EAP.generate_query(done[idx]["error_response"]) for idx in pending], ["count_response"],
+                                   truncations=[count_truncation])
+            else:
+                self.count_samples(journal, done, pending)
+            
+            # ERROR -> COUNT pipeline for the rest
+            pending = [idx for idx in indices if "count_response" not in done.get(idx, {})]
+            self.infer_pending(journal, done, pending,
+                               [get_query(chunk[idx], template) for idx in pending], ["error_response", "count_response"],
+                               followups=[EAP.generate_query], truncations=[error_truncation, count_truncation],
+                               samples=num_samples)
+
+    def flush_chunk(self, journal, done, chunk, writer):
+        """Run a chunk, then write its records rebuilt from the journal and release them."""
+        self.generate_chunk(journal, done, chunk)
+        journal.sync()
+        for idx, _query_dict in chunk.items():
+            responses = done.pop(idx)
+            writer.write({**_query_dict, **(sample_fields(responses, aggregation) if num_samples > 1 else responses)})
+        chunk.clear()
+
+    def generate_system(self, input_path, output_path, keep_fields=()):
+        """
+        Generate the responses of one system file into `output_path`, journaling and chunking as above.
+        `keep_fields` are response fields of the input records taken as done (e.g. "error_response",
+        to only rerun the COUNT step over an existing responses file).
+        """
+        if self.system_name is None: # first system of the run, its query files exist by now
+            os.makedirs(self.responses_folder, exist_ok=True)
+            self.template = load_template(self.queries_folder)
+            if self.template is not None:
+                save_template(self.template, self.responses_folder)
+        
+        if self.unscanned:
+            for query_path in self.unscanned:
+                self.deduplicator.scan(get_query(_query_dict, self.template)
+                                       for _, _query_dict in iter_segment_records(query_path, self.selection))
+            self.unscanned.clear()
+            print(self.deduplicator.report())
+        
+        print(f"MT system name: {os.path.basename(input_path)}")
+        self.system_name = os.path.splitext(os.path.basename(output_path))[0]
+        
+        journal = SegmentJournal(os.path.join(self.journal_folder, f"{self.system_name}.journal.jsonl"))
+        done = journal.load()
+        print(f"{len(done)} segments restored from journal.")
+        
+        tmp_path = output_path + ".tmp"
+        try:
+            with RecordWriter(tmp_path, jsonl=(file_format == "jsonl")) as writer:
+                chunk = {}
+                # segments are keyed by their ID (their position in the file unless the records carry one)
+                for idx, _query_dict in iter_segment_records(input_path, self.selection):
+                    chunk[idx] = {"segment_id": idx, **_query_dict} if self.selection is not None else _query_dict
+                    for field in keep_fields:
+                        if field in _query_dict: # journaled responses are newer
+                            kept = _query_dict.get(f"{field}_samples", [_query_dict[field]]) if num_samples > 1 else _query_dict[field]
+                            done.setdefault(idx, {}).setdefault(field, kept)
+                    if len(chunk) == chunk_size:
+                        self.flush_chunk(journal, done, chunk, writer)
+                if chunk:
+                    self.flush_chunk(journal, done, chunk, writer)
+        finally:
+            journal.close() # syncs the responses of a failed chunk for the next run
+        
+        os.replace(tmp_path, output_path)
+        print(f"Saved to {output_path}.")
+        journal.remove()
+
+if __name__ == "__main__":
+
+    run = ResponseRun(InferenceEngine(model_name=model_name), prompt_type, queries_folder, responses_folder)
+    pending_files = run.list_pending_files()
+    for query_path, _ in pending_files:
+        run.expect(query_path)
+    
+    for query_path, output_path in pending_files:
+        run.generate_system(query_path, output_path)
+    
+    if run.dedup:
+        print(run.deduplicator.report())
+    run.generator.close()
@@ -0,0 +1,78 @@
+"""
+===============================================================================
+Prefix-cache-friendly Request Scheduling
+===============================================================================
+
+vLLM servers with automatic prefix caching only compute the KV cache of a
+prompt prefix once, and reuse it for later requests starting with the same
+tokens. All ERROR queries of a prompt type share the same long few-shot
+prefix (the example user turn and the example assistant turn), so the order
+in which requests reach the server matters:
+
+- Requests with the same prefix should be sent together, so that the cached
+  prefix is not evicted by unrelated prompts in between.
+- The first request of each prefix should complete before the others are
+  sent; otherwise all concurrent requests compute the same prefix again,
+  before any of them has populated the cache.
+
+------------------------------------------------------------------------------
+Usage
+------------------------------------------------------------------------------
+`plan_prefix_schedule(queries)` groups the queries by prefix (every message
+but the last one) and returns a `PrefixSchedule`:
+    - `order`: submission order, grouped by prefix, groups in order of first
+      appearance and queries in input order within each group.
+    - `leader_of`: for each query, the index of the first query of its group,
+      which is sent alone as a warm-up wave.
+    - `shared_prefix_ratio`: the expected share of prompt tokens served from
+      the prefix cache (estimated at about 4 characters per token).
+
+`InferenceEngine` applies the schedule when `prefix_grouping` is enabled in
+the model configuration. Responses are still returned in input order.
+
+===============================================================================
+"""
+
+from dataclasses import dataclass
+
+from dedup import query_key
+
+def prefix_key(query: list[dict[str, str]]) -> str:
+    """Hash of every message but the last one, i.e. the part shared by all segments of a prompt type."""
+    return query_key(query[:-1])
+
+def _estimate_chars(messages: list[dict[str, str]]) -> int:
+    return sum(len(message["content"]) for message in messages)
+
+@dataclass(frozen=True)
+class PrefixSchedule:
+    order: list[int]
+    leader_of: list[int]
+    groups: int
+    shared_prefix_ratio: float
+
+    def report(self) -> str:
+        return (f"Prefix schedule: {len(self.order)} requests in {self.groups} prefix groups, "
+                f"expected shared-prefix ratio {self.shared_prefix_ratio:.1%}.")
+
+def plan_prefix_schedule(queries: list[list[dict[str, str]]]) -> PrefixSchedule:
+
+    groups = {} # prefix key -> query indices, in input order
+    for idx, query in enumerate(queries):
+        groups.setdefault(prefix_key(query), []).append(idx)
+
+    order, leader_of = [], [0] * len(queries)
+    shared_chars, total_chars = 0, 0
+    for members in groups.values():
+        order.extend(members)
+        for idx in members:
+            leader_of[idx] = members[0]
+            total_chars += _estimate_chars(queries[idx])
+        shared_chars += (len(members) - 1) * _estimate_chars(queries[members[0]][:-1])
+
+    return PrefixSchedule(
+        order=order,
+        leader_of=leader_of,
+        groups=len(groups),
+        shared_prefix_ratio=shared_chars / total_chars if total_chars else 0.0,
+    )
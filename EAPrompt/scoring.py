@@ -0,0 +1,182 @@
+"""
+===============================================================================
+Score Extraction and System-level Aggregation
+===============================================================================
+
+This module turns the responses of one (language pair, model, prompt type)
+into EAPrompt scores, as the first stage of meta-evaluation.
+
+------------------------------------------------------------------------------
+Scoring
+------------------------------------------------------------------------------
+1. **Counts**
+   - Two-step prompts: the "x, x" `count_response` is parsed tolerantly with
+     `counting.parse_count`.
+   - SINGLESTEP prompts: the trailing "x, x" line of `singlestep_response` is
+     used, falling back to an "x, x" pair within that last non-empty line
+     (e.g. "Answer: 2, 5"). Numbers inside the error list (e.g. "2,000") are
+     never read as counts.
+   - Self-consistency records (several samples per segment, see
+     `consistency.py`) use their aggregated `counts`, which may be fractional.
+   - Segments whose count cannot be parsed are stored as NaN, and ignored by
+     the system-level means. The parse rate is reported.
+
+2. **Weighting**
+   - As in the paper, major errors weigh `MAJOR_WEIGHT` (5) and minor errors
+     `MINOR_WEIGHT` (1): score = -(5 * major + 1 * minor).
+
+------------------------------------------------------------------------------
+Score Matrices
+------------------------------------------------------------------------------
+- `ScoreMatrix` holds the major and minor counts as float arrays shaped
+  [system × segment], with systems sorted by name. Systems with fewer
+  segments are padded with NaN.
+- `segment_scores()` and `system_scores()` are computed with vectorized NumPy
+  operations.
+- `load_score_matrix(...)` reads the response files in parallel processes and
+  caches the counts as `<cache_folder>/<lang_pair>/<model_name>/<prompt_type>.npz`.
+  The cache is rebuilt whenever a response file is added, removed or modified
+  (size and modification time).
+
+===============================================================================
+"""
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+from counting import parse_count, parse_singlestep_response
+from query_store import TEMPLATE_FILE
+from utils import iter_records
+
+MAJOR_WEIGHT = 5
+MINOR_WEIGHT = 1
+
+def response_counts(record: dict) -> Optional[tuple[float, float]]:
+    """(major, minor) of one response record, or None if it cannot be parsed."""
+
+    if "sample_counts" in record: # aggregated over several samples
+        return tuple(record["counts"]) if record["counts"] is not None else None
+    if "singlestep_response" in record:
+        text = record["singlestep_response"]
+        lines = [line for line in (text or "").splitlines() if line.strip()]
+        return parse_singlestep_response(text) or (parse_count(lines[-1]) if lines else None)
+    return parse_count(record.get("count_response"))
+
+def read_system_counts(path: str) -> np.ndarray:
+    """Counts of one response file as a float array shaped [segment × 2], NaN where unparsed."""
+
+    counts = [response_counts(record) or (np.nan, np.nan) for record in iter_records(path)]
+    return np.array(counts, dtype=np.float64).reshape(-1, 2)
+
+@dataclass
+class ScoreMatrix:
+    systems: list[str]
+    major: np.ndarray # [system × segment]
+    minor: np.ndarray # [system × segment]
+
+    @property
+    def parsed(self) -> np.ndarray:
+        return ~np.isnan(self.major)
+
+    def parse_rate(self) -> float:
+        return float(self.parsed.mean()) if self.major.size else 0.0
+
+    def segment_scores(self, major_weight: float = MAJOR_WEIGHT, minor_weight: float = MINOR_WEIGHT) -> np.ndarray:
+        return -(major_weight * self.major + minor_weight * self.minor)
+
+    def system_scores(self, major_weight: float = MAJOR_WEIGHT, minor_weight: float = MINOR_WEIGHT) -> np.ndarray:
+        """Mean segment score of each system, ignoring unparsed segments."""
+        scores = self.segment_scores(major_weight, minor_weight)
+        parsed = self.parsed
+        totals = np.where(parsed, scores, 0.0).sum(axis=1)
+        counts = parsed.sum(axis=1)
+        return np.divide(totals, counts, out=np.full(len(self.systems), np.nan), where=counts > 0)
+
+    def save(self, path: str, signature: str = "") -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        np.savez_compressed(tmp_path, systems=np.array(self.systems), major=self.major,
+                            minor=self.minor, signature=np.array(signature))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> tuple["ScoreMatrix", str]:
+        with np.load(path) as data:
+            matrix = cls(systems=data["systems"].tolist(), major=data["major"], minor=data["minor"])
+            return matrix, str(data["signature"])
+
+def list_response_files(responses_folder: str) -> list[str]:
+    return [
+        file_name for file_name in sorted(os.listdir(responses_folder))
+        if file_name != TEMPLATE_FILE and os.path.splitext(file_name)[1] in (".json", ".jsonl")
+    ]
+
+def folder_signature(responses_folder: str, file_names: list[str]) -> str:
+    """Identifies the state of the response files, to invalidate cached matrices."""
+
+    stats = []
+    for file_name in file_names:
+        stat = os.stat(os.path.join(responses_folder, file_name))
+        stats.append([file_name, stat.st_size, stat.st_mtime_ns])
+    return json.dumps(stats)
+
+def build_score_matrix(responses_folder: str, num_workers: Optional[int] = None) -> ScoreMatrix:
+
+    file_names = list_response_files(responses_folder)
+    paths = [os.path.join(responses_folder, file_name) for file_name in file_names]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        per_system = list(executor.map(read_system_counts, paths))
+
+    num_segments = max((len(counts) for counts in per_system), default=0)
+    counts = np.full((len(per_system), num_segments, 2), np.nan)
+    for i, system_counts in enumerate(per_system):
+        counts[i, :len(system_counts)] = system_counts
+
+    return ScoreMatrix(
+        systems=[os.path.splitext(file_name)[0] for file_name in file_names],
+        major=counts[:, :, 0],
+        minor=counts[:, :, 1],
+    )
+
+def load_score_matrix(
+    lang_pair: str,
+    model_name: str,
+    prompt_type: str,
+    responses_root: str = "./results/responses",
+    cache_folder: Optional[str] = "./results/scores",
+    num_workers: Optional[int] = None) -> ScoreMatrix:
+
+    """Score matrix of one (language pair, model, prompt type), from the cache when it is up to date."""
+
+    responses_folder = os.path.join(responses_root, lang_pair, model_name, prompt_type)
+    signature = folder_signature(responses_folder, list_response_files(responses_folder))
+
+    cache_path = None
+    if cache_folder is not None:
+        cache_path = os.path.join(cache_folder, lang_pair, model_name, f"{prompt_type}.npz")
+        if os.path.exists(cache_path):
+            matrix, cached_signature = ScoreMatrix.load(cache_path)
+            if cached_signature == signature:
+                return matrix
+
+    matrix = build_score_matrix(responses_folder, num_workers=num_workers)
+    if cache_path is not None:
+        matrix.save(cache_path, signature)
+    return matrix
+
+
+if __name__ == "__main__":
+
+    lang_pair = 'zhen'
+    model_name = "gpt-3.5-turbo"
+    prompt_type = f"ERROR_{lang_pair.upper()}_ITEMIZED_SRC"
+
+    matrix = load_score_matrix(lang_pair, model_name, prompt_type)
+    print(f"{len(matrix.systems)} systems, {matrix.major.shape[1]} segments, parse rate {matrix.parse_rate():.1%}")
+    for system, score in sorted(zip(matrix.systems, matrix.system_scores()), key=lambda item: -item[1]):
+        print(f"{system}\t{score:.4f}")
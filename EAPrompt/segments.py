@@ -0,0 +1,145 @@
+"""
+===============================================================================
+Segment Subsets and Indexed Line Access
+===============================================================================
+
+Pilot runs on expensive models only evaluate a subset of the test set (e.g.
+the 30 zh-en segments of `results/gpt_random_sent_ids.json` used for GPT-4).
+This module selects such subsets and reads only the selected lines.
+
+------------------------------------------------------------------------------
+Components
+------------------------------------------------------------------------------
+1. **SegmentSelection**: an explicit list of segment IDs (or the path of a
+   JSON file holding one), or a seeded random sample of `sample_size`
+   segments. Segment IDs are 0-based line numbers of the WMT text files;
+   selected IDs are always returned in increasing order.
+
+2. **LineIndex**: byte offsets of the lines of a text file (or `.jsonl` file),
+   so that selected lines are read with one seek each, without decoding the
+   rest of the file. `read_parallel_lines(paths, ids)` reads the same lines
+   from parallel src/ref/sys files, checking that their lengths match.
+
+3. **iter_segment_records(path, selection)**: (segment ID, record) pairs of a
+   query file. Records without a `segment_id` field get their position in
+   the file; `.jsonl` files of such records are read through a `LineIndex`.
+
+Records generated from a subset keep their original `segment_id`, so that
+their responses can be merged back with full runs.
+
+===============================================================================
+"""
+
+import json
+import mmap
+import os
+import random
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional, Sequence, Union
+
+import numpy as np
+
+from utils import iter_records, read_json
+
+@dataclass(frozen=True)
+class SegmentSelection:
+    segment_ids: Optional[tuple[int, ...]] = None
+    sample_size: Optional[int] = None
+    seed: int = 0
+
+    @classmethod
+    def from_params(
+        cls,
+        segment_ids: Union[None, str, Sequence[int]] = None,
+        sample_size: Optional[int] = None,
+        seed: int = 0) -> Optional["SegmentSelection"]:
+
+        """Selection from script parameters (`segment_ids` may be a JSON file path); None selects everything."""
+
+        if segment_ids is not None and sample_size is not None:
+            raise ValueError("Give either segment_ids or sample_size, not both.")
+        if isinstance(segment_ids, str):
+            segment_ids = read_json(segment_ids)
+        if segment_ids is None and sample_size is None:
+            return None
+        return cls(segment_ids=tuple(segment_ids) if segment_ids is not None else None,
+                   sample_size=sample_size, seed=seed)
+
+    def resolve(self, candidates: Sequence[int]) -> list[int]:
+        """Selected IDs among `candidates` (all available segment IDs), in increasing order."""
+
+        if self.segment_ids is not None:
+            available = set(candidates)
+            missing = [segment_id for segment_id in self.segment_ids if segment_id not in available]
+            if missing:
+                raise ValueError(f"{len(missing)} selected segment IDs are not available, e.g. {missing[:5]}")
+            return sorted(set(self.segment_ids))
+        if self.sample_size > len(candidates):
+            raise ValueError(f"Cannot sample {self.sample_size} segments out of {len(candidates)}.")
+        return sorted(random.Random(self.seed).sample(candidates, self.sample_size))
+
+class LineIndex:
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                self.offsets = np.zeros(0, dtype=np.int64)
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                data = np.frombuffer(mm, dtype=np.uint8)
+                newlines = np.flatnonzero(data == ord("\n"))
+                del data # release the buffer before the map is closed
+        starts = np.concatenate(([0], newlines + 1)).astype(np.int64)
+        self.offsets = starts[:-1] if starts[-1] == size else starts # no empty line after a final newline
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def iter_lines(self, ids: Iterable[int], strip: bool = True) -> Iterator[str]:
+        """Lines `ids` of the file, one seek each, stripped as in `utils.readlines_txt`."""
+
+        with open(self.path, "rb") as f:
+            for i in ids:
+                f.seek(int(self.offsets[i]))
+                line = f.readline().decode("utf-8")
+                yield line.strip() if strip else line
+
+    def read(self, ids: Iterable[int], strip: bool = True) -> list[str]:
+        return list(self.iter_lines(ids, strip=strip))
+
+def read_parallel_lines(paths: Sequence[str], ids: Sequence[int]) -> list[list[str]]:
+    """Lines `ids` of each of the parallel text files `paths`; raises ValueError if their lengths differ."""
+
+    indexes = [LineIndex(path) for path in paths]
+    lengths = {path: len(index) for path, index in zip(paths, indexes)}
+    if len(set(lengths.values())) > 1:
+        raise ValueError(f"Length mismatch: {', '.join(f'{path}({length})' for path, length in lengths.items())}")
+    if ids and (min(ids) < 0 or max(ids) >= len(indexes[0])):
+        raise ValueError(f"Segment IDs out of range for {len(indexes[0])} lines.")
+    return [index.read(ids) for index in indexes]
+
+def iter_segment_records(path: str, selection: Optional[SegmentSelection] = None) -> Iterator[tuple[int, dict]]:
+    """(segment ID, record) of the records of a query/response file, restricted to `selection`."""
+
+    if selection is None:
+        for position, record in enumerate(iter_records(path)):
+            yield record.get("segment_id", position), record
+        return
+
+    if path.endswith(".jsonl"):
+        index = LineIndex(path)
+        if len(index) == 0 or "segment_id" not in json.loads(index.read([0])[0]):
+            selected = selection.resolve(range(len(index))) # segment ID = line number
+            for segment_id, line in zip(selected, index.iter_lines(selected)):
+                yield segment_id, json.loads(line)
+            return
+
+    # records carrying their own segment IDs (e.g. generated from a subset)
+    present = [record.get("segment_id", position) for position, record in enumerate(iter_records(path))]
+    selected = set(selection.resolve(present))
+    for position, record in enumerate(iter_records(path)):
+        segment_id = record.get("segment_id", position)
+        if segment_id in selected:
+            yield segment_id, record
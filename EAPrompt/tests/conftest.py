@@ -0,0 +1,23 @@
+import os
+import socket
+import sys
+
+# the EAPrompt modules import each other by flat name, as when the scripts are run
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import mock_server
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_mock(port: int) -> mock_server.MockHTTPServer:
+    args = mock_server.parse_args(["--ports", str(port), "--latency", "fixed", "--latency-median", "0.02"])
+    return mock_server.start_servers(args)[0]
+
+def stop_mock(server: mock_server.MockHTTPServer) -> None:
+    server.shutdown()
+    server.server_close()
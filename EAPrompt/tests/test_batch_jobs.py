@@ -0,0 +1,82 @@
+import json
+import os
+
+import pytest
+
+from conftest import FIXTURES
+
+from batch_jobs import export_requests, ingest_results, iter_batch_results, make_custom_id, parse_custom_id
+from constants.model_configs import OpenAIConfig
+from eaprompt import EAPrompt
+from truncation import truncation_for_stage
+from utils import iter_jsonl, iter_records
+
+QUERIES = os.path.join(FIXTURES, "batch", "queries")
+ERROR_RESULTS = os.path.join(FIXTURES, "batch", "error_results.jsonl")
+CFG = OpenAIConfig(base_url="http://localhost/v1", api_key="x", model_name="m")
+
+def test_custom_id_round_trip():
+    for system, idx, stage in [("sysA", 0, "error"), ("Online-W", 1999, "count"), ("a|b", 7, "singlestep")]:
+        custom_id = make_custom_id(system, idx, stage)
+        assert parse_custom_id(custom_id) == (system, idx, stage)
+
+def test_export_writes_one_request_per_segment(tmp_path):
+    request_path = tmp_path / "error_requests.jsonl"
+    assert export_requests(QUERIES, str(tmp_path / "responses"), str(request_path), CFG, "error") == 5
+
+    requests = list(iter_jsonl(str(request_path)))
+    assert [request["custom_id"] for request in requests] == [
+        "sysA|0|error", "sysA|1|error", "sysA|2|error", "sysB|0|error", "sysB|1|error"]
+    first_query = next(iter_records(os.path.join(QUERIES, "sysA.jsonl")))["query"]
+    assert requests[0]["body"]["messages"] == first_query
+    assert requests[0]["body"]["model"] == "m"
+
+def test_ingest_places_results_and_skips_failures(tmp_path):
+    responses = str(tmp_path / "responses")
+    stats = ingest_results(QUERIES, responses, ERROR_RESULTS, "error")
+    assert stats == {"ingested": 4, "failed": 1, "missing": 1}
+
+    sys_a = list(iter_records(os.path.join(responses, "sysA.jsonl")))
+    sys_b = list(iter_records(os.path.join(responses, "sysB.jsonl")))
+    assert sys_a[0]["error_response"].startswith("Major errors:\n(1) “Hallo”")
+    assert "error_response" not in sys_a[1] # errored line
+    assert sys_a[2]["error_response"] == "Major errors:\nNone\nMinor errors:\nNone"
+    assert "geht's" in sys_b[0]["error_response"] # results arrive out of order
+    assert sys_b[1]["error_response"] == "Major errors:\nNone\nMinor errors:\nNone"
+    assert [record["query"] for record in sys_b] == [record["query"] for record in iter_records(os.path.join(QUERIES, "sysB.jsonl"))]
+
+    # only the failed request is exported again, and COUNT requests only for ingested ERROR responses
+    assert export_requests(QUERIES, responses, str(tmp_path / "retry.jsonl"), CFG, "error") == 1
+    assert next(iter_jsonl(str(tmp_path / "retry.jsonl")))["custom_id"] == "sysA|1|error"
+    assert export_requests(QUERIES, responses, str(tmp_path / "count.jsonl"), CFG, "count") == 4
+    count_requests = list(iter_jsonl(str(tmp_path / "count.jsonl")))
+    assert [request["custom_id"] for request in count_requests] == [
+        "sysA|0|count", "sysA|2|count", "sysB|0|count", "sysB|1|count"]
+    assert sys_a[0]["error_response"] in count_requests[0]["body"]["messages"][-1]["content"]
+
+def write_results(path, results):
+    with open(path, "w", encoding="utf-8") as f:
+        for custom_id, content in results:
+            body = {"choices": [{"index": 0, "message": {"role": "assistant", "content": content}}]}
+            f.write(json.dumps({"custom_id": custom_id, "response": {"status_code": 200, "body": body}, "error": None}) + "\n")
+
+@pytest.mark.parametrize("bad_id", ["sysC|0|error", "sysB|2|error", "sysA|-1|error"])
+def test_bad_results_leave_the_responses_untouched(tmp_path, bad_id):
+    result_path = tmp_path / "results.jsonl"
+    write_results(result_path, [("sysA|0|error", "Major errors:\nNone\nMinor errors:\nNone"), (bad_id, "None")])
+    responses = tmp_path / "responses"
+    with pytest.raises(ValueError):
+        ingest_results(QUERIES, str(responses), str(result_path), "error")
+    assert not responses.exists()
+
+def test_ingest_truncates_like_the_online_path(tmp_path):
+    responses = str(tmp_path / "responses")
+    truncation = truncation_for_stage("ERROR_DEEN_ITEMIZED_REF", ["\nMinor errors:"])
+    ingest_results(QUERIES, responses, ERROR_RESULTS, "error", truncation=truncation)
+
+    raw = {custom_id: content for custom_id, content, _ in iter_batch_results(ERROR_RESULTS)}
+    sys_a = list(iter_records(os.path.join(responses, "sysA.jsonl")))
+    assert sys_a[0]["error_response"] == truncation.apply(raw["sysA|0|error"]) == "Major errors:\n(1) “Hallo” – Mistranslation"
+    export_requests(QUERIES, responses, str(tmp_path / "count.jsonl"), CFG, "count")
+    first_count = next(iter_jsonl(str(tmp_path / "count.jsonl")))
+    assert first_count["body"]["messages"] == EAPrompt(prompt_type="COUNT").generate_query(sys_a[0]["error_response"])
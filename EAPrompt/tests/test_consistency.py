@@ -0,0 +1,51 @@
+import pytest
+
+from conftest import free_port, start_mock, stop_mock
+
+from consistency import sample_fields
+from constants.model_configs import MODEL_CONFIGS, OpenAIConfig
+from eaprompt import EAPrompt
+from inference import InferenceEngine
+
+QUERIES = [[{"role": "user", "content": f"Source: Satz {i}\nTranslation: Sentence number {i}"}] for i in range(20)]
+FIELDS = ["error_response", "count_response"]
+
+@pytest.fixture
+def sampled_engine(monkeypatch):
+    port = free_port()
+    server = start_mock(port)
+    monkeypatch.setitem(MODEL_CONFIGS, "mock-sampled", OpenAIConfig(
+        base_url=f"http://127.0.0.1:{port}/v1",
+        api_key="x",
+        model_name="mock",
+        temperature=0.7,
+        request_timeout=5,
+        retry_sleep=0,
+    ))
+    engine = InferenceEngine(model_name="mock-sampled")
+    yield engine
+    engine.close()
+    stop_mock(server)
+
+def test_sampled_counts_are_aggregated(sampled_engine):
+    responses = {}
+
+    def _record(i, stage, response):
+        responses.setdefault(i, {})[FIELDS[stage]] = response
+
+    sampled_engine.infer_chain(QUERIES, followups=[EAPrompt(prompt_type="COUNT").generate_query],
+                               on_result=_record, samples=4)
+    assert all(len(responses[i]["count_response"]) == 4 for i in range(len(QUERIES)))
+
+    # the first choice is the response of an unsampled request
+    assert sampled_engine.infer_batch(QUERIES[:1]) == [responses[0]["error_response"][0]]
+
+    records = {method: [sample_fields(responses[i], method) for i in range(len(QUERIES))]
+               for method in ("mean", "median", "vote")}
+    assert all(None not in record["sample_counts"] for record in records["mean"])
+    assert any(record["score_variance"] > 0 for record in records["mean"])
+    for i, record in enumerate(records["mean"]):
+        assert record["counts"] == [sum(count[k] for count in record["sample_counts"]) / 4 for k in range(2)]
+        assert records["vote"][i]["counts"] in [list(count) for count in record["sample_counts"]]
+    assert any(records["mean"][i]["counts"] != records["median"][i]["counts"] for i in range(len(QUERIES)))
+    assert any(records["mean"][i]["counts"] != records["vote"][i]["counts"] for i in range(len(QUERIES)))
@@ -0,0 +1,59 @@
+import time
+
+import pytest
+
+from conftest import free_port, start_mock, stop_mock
+
+from constants.model_configs import MODEL_CONFIGS, OpenAIConfig
+from inference import InferenceEngine
+
+QUERIES = [[{"role": "user", "content": f"Source: Satz {i}\nTranslation: Sentence {i}"}] for i in range(40)]
+
+@pytest.fixture
+def two_endpoints(monkeypatch):
+    ports = [free_port(), free_port()]
+    servers = [start_mock(port) for port in ports]
+    monkeypatch.setitem(MODEL_CONFIGS, "mock-pair", OpenAIConfig(
+        base_url=[f"http://127.0.0.1:{port}/v1" for port in ports],
+        api_key="x",
+        model_name="mock",
+        request_timeout=5,
+        retry_sleep=0,
+        max_concurrency=8,
+        eject_after=1,
+        eject_cooldown=0.5,
+    ))
+    engine = InferenceEngine(model_name="mock-pair")
+    yield engine, servers, ports
+    engine.close()
+    for server in servers:
+        if server is not None:
+            stop_mock(server)
+
+def test_ejection_and_readmission(two_endpoints):
+    engine, servers, ports = two_endpoints
+    healthy, downed = engine.pool.endpoints
+
+    assert len(engine.infer_batch(QUERIES)) == len(QUERIES)
+    assert healthy.completed > 0 and downed.completed > 0
+
+    # requests move to the healthy endpoint while the other one is down
+    stop_mock(servers[1])
+    servers[1] = None
+    before = downed.completed
+    assert all(engine.infer_batch(QUERIES))
+    assert downed.completed == before
+    assert downed.ejected_until is not None
+    assert healthy.outstanding == downed.outstanding == 0
+
+    # the next batch does not hit the ejected endpoint again
+    failed = downed.failed
+    assert all(engine.infer_batch(QUERIES[:8]))
+    assert downed.failed == failed
+
+    # after the cooldown, the recovered endpoint is probed and readmitted
+    servers[1] = start_mock(ports[1])
+    time.sleep(engine.cfg.eject_cooldown)
+    assert all(engine.infer_batch(QUERIES))
+    assert downed.ejected_until is None
+    assert downed.completed > before
@@ -0,0 +1,52 @@
+import itertools
+
+import numpy as np
+
+from metaeval import _item_grouped_accuracies, pairwise_counts, tie_candidates
+
+def agrees(m_i, m_j, h_i, h_j, epsilon):
+    metric_tie, human_tie = abs(m_i - m_j) <= epsilon, h_i == h_j
+    if metric_tie or human_tie:
+        return metric_tie and human_tie
+    return (m_i < m_j) == (h_i < h_j)
+
+def brute_force_counts(metric, human, epsilon):
+    valid = [(m, h) for m, h in zip(metric, human) if not (np.isnan(m) or np.isnan(h))]
+    pairs = list(itertools.combinations(valid, 2))
+    return sum(agrees(m_i, m_j, h_i, h_j, epsilon) for (m_i, h_i), (m_j, h_j) in pairs), len(pairs)
+
+def brute_force_grouped(metric, human, epsilon):
+    accuracies = []
+    for item in range(metric.shape[1]):
+        pairs = [(first, second) for first, second in itertools.combinations(range(metric.shape[0]), 2)
+                 if not np.isnan([metric[first, item], metric[second, item], human[first, item], human[second, item]]).any()]
+        if pairs:
+            accuracies.append(np.mean([agrees(metric[first, item], metric[second, item],
+                                              human[first, item], human[second, item], epsilon)
+                                       for first, second in pairs]))
+    return np.mean(accuracies) if accuracies else np.nan
+
+def random_scores(rng, shape, nan_rate=0.1):
+    # few distinct values, so that ties occur in both score vectors
+    scores = rng.integers(-6, 1, size=shape).astype(np.float64) * rng.choice([1.0, 0.5])
+    scores[rng.random(shape) < nan_rate] = np.nan
+    return scores
+
+def test_pairwise_counts_match_brute_force():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        n = int(rng.integers(0, 30))
+        metric, human = random_scores(rng, n), random_scores(rng, n)
+        for epsilon in [0.0, 0.5, 1.0, 2.5]:
+            assert pairwise_counts(metric, human, epsilon) == brute_force_counts(metric, human, epsilon)
+
+def test_item_grouped_accuracies_match_brute_force():
+    rng = np.random.default_rng(1)
+    for _ in range(100):
+        shape = (int(rng.integers(2, 6)), int(rng.integers(1, 8)))
+        metric, human = random_scores(rng, shape, nan_rate=0.2), random_scores(rng, shape, nan_rate=0.2)
+        epsilons = tie_candidates(metric)
+        if not len(epsilons):
+            continue
+        expected = [brute_force_grouped(metric, human, epsilon) for epsilon in epsilons]
+        np.testing.assert_allclose(_item_grouped_accuracies(metric, human, epsilons), expected, atol=1e-12, equal_nan=True)
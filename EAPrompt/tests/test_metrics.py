@@ -0,0 +1,26 @@
+import json
+
+from constants.model_configs import MODEL_CONFIGS, OpenAIConfig
+from inference import InferenceEngine
+from metrics import RequestRecord
+
+def test_engine_close_releases_the_trace(tmp_path, monkeypatch):
+    trace_path = str(tmp_path / "trace" / "requests.jsonl")
+    monkeypatch.setitem(MODEL_CONFIGS, "traced", OpenAIConfig(
+        base_url="http://127.0.0.1:9/v1", api_key="x", model_name="m", trace_path=trace_path))
+    engine = InferenceEngine(model_name="traced")
+    engine.metrics.record(RequestRecord(tags={"system": "sysA", "segments": [0]}, latency=0.5))
+    trace = engine.metrics._trace
+
+    engine.close()
+    assert trace.closed
+    with open(trace_path, encoding="utf-8") as f:
+        assert [json.loads(line)["tags"] for line in f] == [{"system": "sysA", "segments": [0]}]
+    with open(trace_path + ".summary.json", encoding="utf-8") as f:
+        assert json.load(f)["requests"] == 1
+
+    # an engine used again after close() appends to the same trace
+    engine.metrics.record(RequestRecord(status="cached"))
+    engine.close()
+    with open(trace_path, encoding="utf-8") as f:
+        assert len(f.readlines()) == 2
@@ -0,0 +1,27 @@
+from ratelimit import AdaptiveConcurrency
+
+def test_batch_cap_does_not_lower_later_batches():
+    concurrency = AdaptiveConcurrency(16, min_limit=4)
+    concurrency.batch_cap = 2
+    assert concurrency.current_limit() == 2
+    concurrency.on_success()
+    assert concurrency.limit == 16 # the window is not squeezed by the cap
+
+    concurrency.batch_cap = None
+    assert concurrency.current_limit() == 16
+    assert concurrency.min_limit == 4
+
+def test_throttle_halves_the_capped_window():
+    concurrency = AdaptiveConcurrency(16)
+    concurrency.batch_cap = 8
+    concurrency.on_throttle()
+    assert concurrency.current_limit() == 4
+    for _ in range(200):
+        concurrency.on_success()
+    assert concurrency.limit == 8 # grows back up to the cap only
+
+    concurrency.batch_cap = None
+    assert concurrency.current_limit() == 8
+    for _ in range(400):
+        concurrency.on_success()
+    assert concurrency.current_limit() == 16
@@ -0,0 +1,119 @@
+import json
+import os
+
+import pytest
+
+import responses_generate
+from checkpoint import SegmentJournal
+from consistency import sample_fields
+from constants.context import INSTRUCTION_COUNT
+from constants.model_configs import OpenAIConfig
+from responses_generate import ResponseRun
+from utils import iter_records, save_records
+
+TEXTS = ["a", "b", "c", "d"]
+
+class FakeEngine:
+    """Answers every stage at once, recording the ERROR and COUNT queries sent."""
+
+    cfg = OpenAIConfig(base_url="http://localhost/v1", api_key="x", model_name="fake")
+
+    def __init__(self):
+        self.sent = {"error": [], "count": []}
+
+    def _answer(self, query, samples):
+        text = query[-1]["content"]
+        stage = "count" if INSTRUCTION_COUNT.strip() in text else "error"
+        self.sent[stage].append(text)
+        response = "0, 1" if stage == "count" else f"errors of {text}"
+        return [response if stage == "count" else f"{response} #{k}" for k in range(samples)] if samples > 1 else response
+
+    def infer_batch(self, queries, on_result=None, tags=None, truncation=None, samples=1):
+        responses = [self._answer(query, samples) for query in queries]
+        for i, response in enumerate(responses):
+            on_result(i, response)
+        return responses
+
+    def infer_chain(self, queries, followups=(), on_result=None, tags=None, truncations=(), samples=1):
+        for j, query in enumerate(queries):
+            response = self._answer(query, samples)
+            on_result(j, 0, response)
+            if followups:
+                counts = [self._answer(followups[0](sample), 1) for sample in response] if samples > 1 \
+                    else self._answer(followups[0](response), 1)
+                on_result(j, 1, counts)
+
+@pytest.fixture
+def folders(tmp_path):
+    queries_folder, responses_folder = tmp_path / "queries", tmp_path / "responses"
+    queries_folder.mkdir()
+    save_records([{"query": [{"role": "user", "content": text}]} for text in TEXTS], str(queries_folder / "sysA.jsonl"))
+    return str(queries_folder), str(responses_folder)
+
+def test_resume_skips_journaled_segments(folders):
+    queries_folder, responses_folder = folders
+    journal = SegmentJournal(os.path.join(responses_folder, ".journal", "sysA.journal.jsonl"))
+    journal.append(0, {"error_response": "journaled a", "count_response": "1, 0"})
+    journal.append(1, {"error_response": "journaled b"}) # crashed before its COUNT step
+    journal.close()
+    with open(journal.path, "a", encoding="utf-8") as f:
+        f.write('{"idx": 2, "fields": {"error_resp') # torn write
+
+    engine = FakeEngine()
+    run = ResponseRun(engine, "ERROR_ZHEN_ITEMIZED_REF", queries_folder, responses_folder)
+    ((query_path, output_path),) = run.list_pending_files()
+    run.generate_system(query_path, output_path)
+
+    assert engine.sent["error"] == ["c", "d"]
+    assert len(engine.sent["count"]) == 3 and "journaled b" in engine.sent["count"][0]
+    records = list(iter_records(output_path))
+    assert [record["error_response"] for record in records] == ["journaled a", "journaled b", "errors of c", "errors of d"]
+    assert records[0]["count_response"] == "1, 0" and records[1]["count_response"] == "0, 1"
+    assert not os.path.exists(journal.path)
+
+def test_journal_is_readable_after_sync(tmp_path):
+    journal = SegmentJournal(str(tmp_path / "sys.journal.jsonl"), sync_interval=3600)
+    journal.append(0, {"error_response": "x"})
+    journal.append(0, {"count_response": "0, 0"})
+    journal.sync()
+    assert SegmentJournal(journal.path).load() == {0: {"error_response": "x", "count_response": "0, 0"}}
+    with open(journal.path, encoding="utf-8") as f:
+        assert [json.loads(line)["idx"] for line in f] == [0, 0]
+    journal.remove()
+
+@pytest.mark.parametrize("temperature, sent", [(0, ["a", "b", "c", "d"]), (0.7, ["a", "b", "c", "d", "a", "b", "c", "d"])])
+def test_dedup_only_at_temperature_zero(folders, temperature, sent):
+    queries_folder, responses_folder = folders
+    save_records([{"query": [{"role": "user", "content": text}]} for text in TEXTS], os.path.join(queries_folder, "sysB.jsonl"))
+    engine = FakeEngine()
+    engine.cfg = OpenAIConfig(base_url="http://localhost/v1", api_key="x", model_name="fake", temperature=temperature)
+
+    run = ResponseRun(engine, "SINGLESTEP_ZHEN_ITEMIZED_REF", queries_folder, responses_folder)
+    pending_files = run.list_pending_files()
+    for query_path, _ in pending_files:
+        run.expect(query_path)
+    for query_path, output_path in pending_files:
+        run.generate_system(query_path, output_path)
+
+    assert engine.sent["error"] == sent
+    assert [record["singlestep_response"] for record in iter_records(pending_files[1][1])] == [f"errors of {text}" for text in TEXTS]
+
+def test_sampled_counts_rerun_sends_no_error_requests(folders, monkeypatch):
+    monkeypatch.setattr(responses_generate, "num_samples", 3)
+    queries_folder, responses_folder = folders
+    path = os.path.join(responses_folder, f"sysA.{responses_generate.file_format}")
+    errors = {text: [f"sample {k} of {text}" for k in range(3)] for text in TEXTS}
+    os.makedirs(responses_folder)
+    save_records([{"query": [{"role": "user", "content": text}],
+                   **sample_fields({"error_response": errors[text], "count_response": ["9, 9"] * 3})} for text in TEXTS], path)
+
+    engine = FakeEngine()
+    ResponseRun(engine, "ERROR_ZHEN_ITEMIZED_REF", queries_folder, responses_folder).generate_system(
+        path, path, keep_fields=["error_response"])
+
+    assert engine.sent["error"] == []
+    assert len(engine.sent["count"]) == 3 * len(TEXTS)
+    for text, record in zip(TEXTS, iter_records(path)):
+        assert record["error_response_samples"] == errors[text]
+        assert record["count_response_samples"] == ["0, 1"] * 3
+        assert record["counts"] == [0, 1]
@@ -0,0 +1,106 @@
+import time
+
+import pytest
+
+from eaprompt import EAPrompt
+from queue_generate import process_lease
+from workqueue import CompletionWriter, LeaseRenewer, WorkQueue
+
+def query(text: str) -> dict:
+    return {"query": [{"role": "user", "content": text}]}
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = WorkQueue(str(tmp_path / "tasks.db"), lease_seconds=0.2, max_attempts=2)
+    yield queue
+    queue.close()
+
+def test_expired_lease_is_handed_out_again(queue):
+    queue.add_tasks([("sysA", 0, "error", query("a"))])
+    (task,) = queue.lease("w1", 10)
+    assert queue.lease("w2", 10) == [] # still leased by w1
+
+    time.sleep(0.3)
+    (again,) = queue.lease("w2", 10)
+    assert again.id == task.id and again.attempts == 2
+    assert not queue.complete("w1", task, "late response") # w1 lost the lease
+    assert queue.complete("w2", again, "response")
+    assert queue.results("sysA") == {0: {"error_response": "response"}}
+
+def test_task_fails_after_max_attempts(queue):
+    queue.add_tasks([("sysA", 0, "error", query("a"))])
+    for worker in ("w1", "w2"):
+        assert len(queue.lease(worker, 10)) == 1
+        time.sleep(0.3) # the worker crashes, its lease expires
+    assert queue.lease("w3", 10) == []
+    assert queue.counts() == {"error": {"failed": 1}}
+    assert queue.unfinished() == 0
+
+    assert queue.retry_failed() == 1
+    assert [task.attempts for task in queue.lease("w3", 10)] == [1]
+
+def test_complete_queues_the_count_followup(queue):
+    queue.add_tasks([("sysA", 0, "error", query("a")), ("sysA", 1, "error", query("b"))])
+    first, second = queue.lease("w1", 1) + queue.lease("w1", 1)
+    assert queue.complete("w1", first, "errors of a", [("count", query("count a"))])
+    assert queue.counts() == {"count": {"pending": 1}, "error": {"done": 1, "leased": 1}}
+
+    (count,) = queue.lease("w2", 10) # COUNT tasks are leased first
+    assert (count.system, count.segment, count.stage, count.payload) == ("sysA", 0, "count", query("count a"))
+    assert queue.complete("w2", count, "1, 0")
+    assert queue.results("sysA") == {0: {"error_response": "errors of a", "count_response": "1, 0"}}
+
+def test_renewer_keeps_unfinished_leases(queue):
+    queue.add_tasks([("sysA", 0, "error", query("a"))])
+    tasks = queue.lease("w1", 10)
+    with LeaseRenewer(queue, "w1", lambda: tasks):
+        time.sleep(0.5) # more than two leases
+        assert queue.lease("w2", 10) == []
+    assert queue.complete("w1", tasks[0], "response")
+
+def test_completions_do_not_wait_for_the_write_lock(queue):
+    queue.add_tasks([("sysA", segment, "error", query(text)) for segment, text in enumerate("ab")])
+    tasks = queue.lease("w1", 10)
+    other = WorkQueue(queue.path)
+    other.conn.execute("BEGIN IMMEDIATE") # another worker holds the write lock
+
+    with CompletionWriter(queue, "w1") as writer:
+        started = time.monotonic()
+        for task in tasks:
+            writer.complete(task, f"errors of {task.segment}", [("count", query("count"))])
+        assert time.monotonic() - started < 0.1 and not writer.committed
+        time.sleep(0.2)
+        other.conn.execute("COMMIT")
+    other.close()
+
+    assert writer.committed == {task.id for task in tasks}
+    assert queue.counts() == {"count": {"pending": 2}, "error": {"done": 2}}
+
+class PoisonEngine:
+    """Answers every query at once, except those containing "poison", which fail for good."""
+
+    def infer_batch(self, queries, on_result=None, tags=None, return_exceptions=False):
+        results = []
+        for i, messages in enumerate(queries):
+            text = messages[-1]["content"]
+            if "poison" in text:
+                error = RuntimeError("Request rejected (client), not retried: 400")
+                if not return_exceptions:
+                    raise error
+                results.append(error)
+                continue
+            response = f"Major errors:\nNone\nMinor errors:\n(1) “{text}” – Grammar"
+            on_result(i, response)
+            results.append(response)
+        return results
+
+def test_failing_task_does_not_fail_its_lease(queue):
+    queue.add_tasks([("sysA", segment, "error", query(text)) for segment, text in enumerate(["a", "poison", "c"])])
+    tasks = queue.lease("w1", 10)
+    assert process_lease(queue, PoisonEngine(), "w1", tasks, None, EAPrompt(prompt_type="COUNT")) == 1
+
+    counts = queue.counts()
+    assert counts["error"] == {"done": 2, "pending": 1}
+    assert counts["count"] == {"pending": 2}
+    (poison,) = [task for task in queue.lease("w2", 10) if task.stage == "error"]
+    assert poison.segment == 1 and poison.attempts == 2
@@ -0,0 +1,149 @@
+"""
+===============================================================================
+Response Truncation Rules
+===============================================================================
+
+Models often keep generating after the answer is complete (comments after the
+itemized error list, explanations after the "x, x" line). A truncation rule
+decides where a response ends, and is used in two ways:
+
+- post-hoc, on a complete response: `rule.apply(text)`;
+- while streaming (`stream = True` in `OpenAIConfig`): `rule.cut(text)` is
+  called on the text received so far, and the request is stopped as soon as
+  it returns a position.
+
+`cut(text, final=False)` only returns a position once no further text can
+change it, so a stopped stream gives exactly `rule.apply(full_response)`.
+
+------------------------------------------------------------------------------
+Rules
+------------------------------------------------------------------------------
+1. **KeywordTruncation** (ERROR step): the semantics of
+   `utils.truncate_response(response, truncate_list, start_truncation_len)`;
+   for each keyword in order, the text after `start_truncation_len` is cut at
+   the first occurrence of the keyword. All keywords are compiled into one
+   regular expression, so that their first occurrences are found in a single
+   pass over the text instead of one split per keyword.
+2. **CountLineTruncation** (COUNT step): ends with the line holding the first
+   "x, x" count.
+3. **TrailingCountTruncation** (SINGLESTEP): ends with the first line made of
+   an "x, x" count only, after the error list.
+
+`truncation_for_stage(...)` returns the rule for a prompt type's step.
+Each rule has a `key`, added to the response cache key.
+
+===============================================================================
+"""
+
+import re
+from functools import lru_cache
+from typing import Optional, Sequence
+
+from counting import COUNT_PATTERN, TRAILING_COUNT_PATTERN
+
+class KeywordTruncation:
+
+    def __init__(self, keywords: Sequence[str], start_len: int = 0) -> None:
+        if any(not keyword for keyword in keywords):
+            raise ValueError("Truncation keywords must not be empty.")
+        self.keywords = list(keywords)
+        self.start_len = start_len
+        self.key = f"keywords:{start_len}:{self.keywords!r}"
+        self._unique = tuple(dict.fromkeys(self.keywords))
+        self._patterns = {}
+
+    def _pattern(self, keywords: tuple[str, ...]) -> re.Pattern:
+        """Alternation of `keywords`; overlapping occurrences are found by searching again from the next position."""
+        if keywords not in self._patterns:
+            self._patterns[keywords] = re.compile("|".join(map(re.escape, keywords)))
+        return self._patterns[keywords]
+
+    def cut(self, text: str, final: bool = False) -> Optional[int]:
+        """
+        Truncated length of `text`, or None if the rest of the response may change it.
+        Keywords are applied in order: a keyword only cuts if it fits entirely
+        before the previous cut, as with successive `split(keyword)[0]`.
+
+        The first occurrences are found in a single scan with one pattern for
+        all keywords. Keywords are dropped from the pattern once found, and the
+        scan stops as soon as no further occurrence can change the result.
+        """
+
+        tail = text[self.start_len:]
+        end = len(tail) if final else None # None: the end of the response is unknown
+        found, remaining, position = {}, self._unique, 0
+        while True:
+            # apply the keywords found so far, up to the first one that may still cut
+            limit, bound, undetermined = end, None, False
+            for keyword in self.keywords:
+                if keyword in found:
+                    if limit is None or found[keyword] + len(keyword) <= limit:
+                        limit = found[keyword]
+                elif keyword in remaining and (limit is None or position + len(keyword) <= limit):
+                    bound, undetermined = limit, True # only occurrences ending before `limit` matter
+                    break
+            if not undetermined:
+                return None if limit is None else min(len(text), self.start_len + limit)
+
+            match = self._pattern(remaining).search(tail, position, len(tail) if bound is None else bound)
+            if match is None:
+                if bound is None and not final:
+                    return None # a later occurrence could still cut
+                remaining = ()
+                continue
+            position = match.start()
+            for keyword in remaining:
+                if tail.startswith(keyword, position):
+                    found[keyword] = position
+            remaining = tuple(keyword for keyword in remaining if keyword not in found)
+            position += 1
+
+    def apply(self, text: str) -> str:
+        return text[:self.cut(text, final=True)]
+
+class CountLineTruncation:
+
+    key = "count_line"
+
+    def cut(self, text: str, final: bool = False) -> Optional[int]:
+        match = COUNT_PATTERN.search(text)
+        if match is None:
+            return len(text) if final else None
+        end_of_line = text.find("\n", match.end())
+        if end_of_line == -1:
+            return len(text) if final else None
+        return end_of_line
+
+    def apply(self, text: str) -> str:
+        return text[:self.cut(text, final=True)]
+
+class TrailingCountTruncation:
+
+    key = "trailing_count"
+
+    def cut(self, text: str, final: bool = False) -> Optional[int]:
+        start = 0
+        for line in text.splitlines(keepends=True):
+            end = start + len(line.rstrip("\r\n"))
+            complete = line.endswith("\n") or final
+            if start > 0 and complete and TRAILING_COUNT_PATTERN.match(line.rstrip("\r\n")):
+                return end
+            start += len(line)
+        return len(text) if final else None
+
+    def apply(self, text: str) -> str:
+        return text[:self.cut(text, final=True)]
+
+@lru_cache(maxsize=64)
+def keyword_truncation(keywords: tuple[str, ...], start_len: int = 0) -> KeywordTruncation:
+    """Shared `KeywordTruncation`, so that repeated calls do not recompile the keywords."""
+    return KeywordTruncation(keywords, start_len)
+
+def truncation_for_stage(prompt_type: str, keywords: Sequence[str] = (), start_len: int = 0):
+    """Truncation rule of a prompt type's step ("COUNT" for the count step), or None for no truncation."""
+
+    if prompt_type == "COUNT":
+        return CountLineTruncation()
+    if prompt_type.startswith("SINGLESTEP"):
+        return TrailingCountTruncation()
+    return KeywordTruncation(keywords, start_len) if keywords else None
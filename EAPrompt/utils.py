@@ -5,13 +5,22 @@ Utility functions for file I/O, text handling, and prompt type parsing.
 
 Includes:
 - JSON and text read/write helpers (`read_json`, `save_json`, `readlines_txt`, etc.)
-- Response truncation via keyword-based cutoff (`truncate_response`)
+- Lockstep iteration over parallel sequences of equal length (`zip_equal`)
+- Streaming record I/O for query/response files in `.json` or line-delimited
+  `.jsonl` format (`iter_records`, `RecordWriter`, `save_records`), and a
+  converter for existing `.json` trees (`convert_json_tree`)
+- Response truncation via keyword-based cutoff (`truncate_response`, see `truncation.py`)
 - Prompt type parsing for EAPrompt configuration (`parse_type`)
 
 Designed for lightweight, reusable data processing in EAPrompt pipelines.
 """
 
+import itertools
 import json
+import os
+import shutil
+
+from truncation import keyword_truncation
 
 def truncate_response(response: str, truncate_list: list[str], start_truncation_len: int) -> str:
     """
@@ -21,12 +30,9 @@ def truncate_response(response: str, truncate_list: list[str], start_truncation_
     
     return: response after truncation.
     """
-    for keyword in truncate_list:
-        if len(response) <= start_truncation_len:
-            response = response
-        else:
-            response = response[:start_truncation_len] + response[start_truncation_len:].split(keyword)[0]
-    return response
+    # each keyword in order cuts at its first occurrence after `start_truncation_len`, if it fits before
+    # the previous cut; all keywords are matched in a single pass (see `truncation.KeywordTruncation`)
+    return keyword_truncation(tuple(truncate_list), start_truncation_len).apply(response)
 
 def read_json(path):
     with open(path, 'r', encoding='utf-8') as f:
@@ -38,12 +44,95 @@ def save_json(data, path):
     print(f'Saved to {path}.')
     return
 
+def iter_jsonl(path):
+    """Yield the records of a line-delimited JSON file one at a time."""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def iter_records(path):
+    """Yield the records of a query/response file; only `.jsonl` files are read with constant memory."""
+    if path.endswith('.jsonl'):
+        yield from iter_jsonl(path)
+    else:
+        yield from read_json(path)
+
+class RecordWriter:
+    """
+    Streaming writer for query/response records.
+    `.jsonl` files get one record per line; `.json` files get the same indented array layout as `save_json`.
+    """
+    
+    def __init__(self, path, jsonl: bool = None):
+        self.path = path
+        self.jsonl = path.endswith('.jsonl') if jsonl is None else jsonl
+        self.count = 0
+        self._file = open(path, 'w', encoding='utf-8')
+        
+    def write(self, record):
+        if self.jsonl:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        else:
+            text = json.dumps(record, indent=4, ensure_ascii=False).replace("\n", "\n    ")
+            self._file.write(("[\n    " if self.count == 0 else ",\n    ") + text)
+        self.count += 1
+        
+    def close(self):
+        if not self.jsonl:
+            self._file.write("\n]" if self.count else "[]")
+        self._file.close()
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+def save_records(data, path, jsonl: bool = None):
+    """Stream an iterable of records to `path` (format chosen from the extension unless `jsonl` is given)."""
+    with RecordWriter(path, jsonl=jsonl) as writer:
+        for record in data:
+            writer.write(record)
+    print(f'Saved to {path}.')
+    return writer.count
+
+def convert_json_tree(src_folder, dst_folder):
+    """
+    Convert every `.json` record file under `src_folder` into `.jsonl`, keeping the folder structure.
+    Files starting with "_" hold shared metadata (e.g. query templates) and are copied unchanged.
+    """
+    for root, _, files in os.walk(src_folder):
+        for file in sorted(files):
+            if not file.endswith('.json'):
+                continue
+            out_folder = os.path.join(dst_folder, os.path.relpath(root, src_folder))
+            os.makedirs(out_folder, exist_ok=True)
+            if file.startswith('_'):
+                shutil.copyfile(os.path.join(root, file), os.path.join(out_folder, file))
+                continue
+            save_records(read_json(os.path.join(root, file)), os.path.join(out_folder, file[:-len('.json')] + '.jsonl'))
+
 def readlines_txt(path):
     with open(path, 'r', encoding='utf-8') as f:
         lines = f.readlines()
         lines = [line.strip() for line in lines]
     return lines
 
+_MISSING = object()
+
+def zip_equal(*iterables, names=None):
+    """
+    Like zip(), but raises ValueError as soon as one iterable ends before the others.
+    `names` (e.g. file paths) are used in the error message.
+    """
+    names = names or [f"#{i}" for i in range(len(iterables))]
+    for line_no, items in enumerate(itertools.zip_longest(*iterables, fillvalue=_MISSING), start=1):
+        if any(item is _MISSING for item in items):
+            lengths = ", ".join(f"{name}({'ended' if item is _MISSING else f'>= {line_no}'})" for name, item in zip(names, items))
+            raise ValueError(f"Length mismatch at line {line_no}: {lengths}")
+        yield items
+
 def read_txt(path):
     with open(path, 'r', encoding='utf-8') as f:
         file = f.read()
@@ -0,0 +1,380 @@
+"""
+===============================================================================
+Durable Work Queue for Distributed Response Generation
+===============================================================================
+
+`responses_generate.py` runs in a single process. This module lets any number
+of worker processes, on one or several machines, share the inference of a
+prompt type through a task queue stored in one SQLite file (see
+`queue_generate.py` for the command line).
+
+------------------------------------------------------------------------------
+Tasks
+------------------------------------------------------------------------------
+- One task per (system, segment, stage), with the stages of
+  `batch_jobs.STAGE_FIELDS`. `payload` holds the query record (compact or
+  full, see `query_store.get_query`), or `{"query": [...]}` for COUNT tasks.
+- `fill_queue(...)` adds the first-stage task of every segment of a query
+  folder (optionally a `SegmentSelection`); adding them again is a no-op.
+- When an ERROR task completes, its COUNT task is added in the same
+  transaction.
+
+------------------------------------------------------------------------------
+Leases
+------------------------------------------------------------------------------
+1. `lease(worker, limit)` atomically hands out pending tasks (COUNT tasks
+   first, so started segments finish early) for `lease_seconds`.
+2. `complete(...)` stores the response, only if the worker still holds the
+   lease; `release(...)` gives a failed task back. `CompletionWriter`
+   commits completions in batches from a background thread, so that the
+   inference event loop never waits for the SQLite write lock.
+3. Leases of crashed or stuck workers expire and their tasks are handed out
+   again. Tasks are marked failed after `max_attempts` leases;
+   `retry_failed()` puts them back.
+4. `renew(...)` extends the leases of a worker still busy with its tasks;
+   `LeaseRenewer` calls it from a background thread every third of
+   `lease_seconds`, so that long batches keep their leases even when no
+   response arrives for a while.
+
+------------------------------------------------------------------------------
+Merge
+------------------------------------------------------------------------------
+`merge_results(...)` writes the standard response files (same folder and
+format as `responses_generate.py`) for every system whose tasks are all done.
+
+------------------------------------------------------------------------------
+Notes
+------------------------------------------------------------------------------
+- Workers on several machines need the queue file on a shared filesystem
+  with working POSIX locks, and roughly synchronized clocks (leases use the
+  wall clock).
+- SQLite serializes writes; each transaction is short (one lease of
+  `limit` tasks, or the completions received since the previous one), which
+  keeps contention low.
+
+===============================================================================
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from queue import Empty, SimpleQueue
+from dataclasses import dataclass
+from typing import Callable, Iterable, Optional
+
+from batch_jobs import STAGE_FIELDS, list_systems
+from query_store import load_template, save_template
+from segments import SegmentSelection, iter_segment_records
+from utils import RecordWriter
+
+STAGE_PRIORITY = {"count": 0, "error": 1, "singlestep": 1} # lower is leased first
+
+@dataclass
+class Task:
+    id: int
+    system: str
+    segment: int
+    stage: str
+    payload: dict
+    attempts: int
+
+class WorkQueue:
+
+    def __init__(self, path: str, lease_seconds: float = 600.0, max_attempts: int = 3) -> None:
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # autocommit mode: transactions are opened explicitly with BEGIN IMMEDIATE
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "id INTEGER PRIMARY KEY, "
+            "system TEXT NOT NULL, "
+            "segment INTEGER NOT NULL, "
+            "stage TEXT NOT NULL, "
+            "priority INTEGER NOT NULL, "
+            "payload TEXT NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'pending', " # pending, leased, done or failed
+            "worker TEXT, "
+            "lease_until REAL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "result TEXT, "
+            "error TEXT, "
+            "UNIQUE (system, segment, stage))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_status ON tasks (status, priority, id)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    @contextmanager
+    def _transaction(self):
+        self.conn.execute("BEGIN IMMEDIATE") # take the write lock up front, so that leases never overlap
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def set_meta(self, key: str, value) -> None:
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def get_meta(self, key: str, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def add_tasks(self, tasks: Iterable[tuple[str, int, str, dict]]) -> int:
+        """Add (system, segment, stage, payload) tasks; existing ones are kept. Returns the number added."""
+
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO tasks (system, segment, stage, priority, payload) VALUES (?, ?, ?, ?, ?)",
+                ((system, segment, stage, STAGE_PRIORITY[stage], json.dumps(payload, ensure_ascii=False))
+                 for system, segment, stage, payload in tasks),
+            )
+            return conn.total_changes - before
+
+    def lease(self, worker: str, limit: int) -> list[Task]:
+        """Hand out up to `limit` pending (or abandoned) tasks to `worker`."""
+
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE tasks SET status = 'failed', worker = NULL, error = 'lease expired' "
+                "WHERE status = 'leased' AND lease_until < ? AND attempts >= ?",
+                (now, self.max_attempts),
+            )
+            rows = conn.execute(
+                "SELECT id, system, segment, stage, payload, attempts FROM tasks "
+                "WHERE status = 'pending' OR (status = 'leased' AND lease_until < ?) "
+                "ORDER BY priority, id LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE tasks SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                ((worker, now + self.lease_seconds, row[0]) for row in rows),
+            )
+        return [Task(id=row[0], system=row[1], segment=row[2], stage=row[3],
+                     payload=json.loads(row[4]), attempts=row[5] + 1) for row in rows]
+
+    def renew(self, worker: str, tasks: Iterable[Task]) -> None:
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE tasks SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                ((time.time() + self.lease_seconds, task.id, worker) for task in tasks),
+            )
+
+    def complete(self, worker: str, task: Task, result: str,
+                 followups: Iterable[tuple[str, dict]] = ()) -> bool:
+
+        """
+        Store the response of a task still leased by `worker`, and add its (stage, payload) follow-up tasks.
+        Returns False if the lease was lost (the task was handed to another worker).
+        """
+        return self.complete_many(worker, [(task, result, followups)])[0]
+
+    def complete_many(self, worker: str, completions: Iterable[tuple[Task, str, Iterable[tuple[str, dict]]]]) -> list[bool]:
+        """`complete(...)` for several (task, result, followups) in one transaction."""
+
+        completed = []
+        with self._transaction() as conn:
+            for task, result, followups in completions:
+                updated = conn.execute(
+                    "UPDATE tasks SET status = 'done', result = ?, worker = NULL, lease_until = NULL, error = NULL "
+                    "WHERE id = ? AND worker = ? AND status = 'leased'",
+                    (json.dumps(result, ensure_ascii=False), task.id, worker),
+                ).rowcount
+                if updated:
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO tasks (system, segment, stage, priority, payload) VALUES (?, ?, ?, ?, ?)",
+                        ((task.system, task.segment, stage, STAGE_PRIORITY[stage], json.dumps(payload, ensure_ascii=False))
+                         for stage, payload in followups),
+                    )
+                completed.append(bool(updated))
+        return completed
+
+    def release(self, worker: str, task: Task, error: str) -> None:
+        """Give back a task that failed; it is marked failed once it has used `max_attempts` leases."""
+
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "worker = NULL, lease_until = NULL, error = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                (self.max_attempts, error, task.id, worker),
+            )
+
+    def retry_failed(self) -> int:
+        with self._transaction() as conn:
+            return conn.execute("UPDATE tasks SET status = 'pending', attempts = 0 WHERE status = 'failed'").rowcount
+
+    def counts(self) -> dict[str, dict[str, int]]:
+        """Number of tasks per stage and status."""
+
+        counts = {}
+        for stage, status, count in self.conn.execute(
+                "SELECT stage, status, COUNT(*) FROM tasks GROUP BY stage, status ORDER BY stage, status"):
+            counts.setdefault(stage, {})[status] = count
+        return counts
+
+    def unfinished(self) -> int:
+        """Number of pending or leased tasks."""
+        return self.conn.execute("SELECT COUNT(*) FROM tasks WHERE status IN ('pending', 'leased')").fetchone()[0]
+
+    def results(self, system: str) -> dict[int, dict[str, str]]:
+        """{segment: {response field: response}} of the done tasks of a system."""
+
+        results = {}
+        for segment, stage, result in self.conn.execute(
+                "SELECT segment, stage, result FROM tasks WHERE system = ? AND status = 'done'", (system,)):
+            results.setdefault(segment, {})[STAGE_FIELDS[stage]] = json.loads(result)
+        return results
+
+    def close(self) -> None:
+        self.conn.close()
+
+class LeaseRenewer:
+
+    """
+    Context manager renewing the leases of `worker` on `unfinished()` tasks every third of the lease,
+    from a background thread with its own connection (SQLite connections are not shared across threads).
+    """
+
+    def __init__(self, queue: WorkQueue, worker: str, unfinished: Callable[[], list[Task]]) -> None:
+        self.queue = queue
+        self.worker = worker
+        self.unfinished = unfinished
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        queue = WorkQueue(self.queue.path, lease_seconds=self.queue.lease_seconds, max_attempts=self.queue.max_attempts)
+        try:
+            while not self._stop.wait(self.queue.lease_seconds / 3):
+                tasks = self.unfinished()
+                if tasks:
+                    queue.renew(self.worker, tasks)
+        finally:
+            queue.close()
+
+    def __enter__(self) -> "LeaseRenewer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        self._thread.join()
+
+class CompletionWriter:
+
+    """
+    Context manager committing `complete(task, result, followups)` calls of `worker` from a background
+    thread with its own connection, in one transaction per batch of completions received meanwhile.
+    `committed` holds the ids of the tasks written so far; all are written when the context exits.
+    """
+
+    def __init__(self, queue: WorkQueue, worker: str) -> None:
+        self.queue = queue
+        self.worker = worker
+        self.committed = set()
+        self._pending = SimpleQueue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def complete(self, task: Task, result: str, followups: Iterable[tuple[str, dict]] = ()) -> None:
+        """Queue a completion; returns at once."""
+        self._pending.put((task, result, list(followups)))
+
+    def _run(self) -> None:
+        queue = WorkQueue(self.queue.path, lease_seconds=self.queue.lease_seconds, max_attempts=self.queue.max_attempts)
+        try:
+            stop = False
+            while not stop:
+                batch = [self._pending.get()]
+                while True:
+                    try:
+                        batch.append(self._pending.get_nowait())
+                    except Empty:
+                        break
+                stop = None in batch # sent by `__exit__` after the last completion
+                batch = [completion for completion in batch if completion is not None]
+                for (task, _, _), completed in zip(batch, queue.complete_many(self.worker, batch)):
+                    if not completed:
+                        print(f"[{self.worker}] lease of {task.system}/{task.segment}/{task.stage} was lost, response dropped.")
+                    self.committed.add(task.id)
+        except Exception as e:
+            self._error = e
+        finally:
+            queue.close()
+
+    def __enter__(self) -> "CompletionWriter":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._pending.put(None)
+        self._thread.join()
+        if self._error is not None and exc_info[0] is None:
+            raise self._error
+
+def first_stage(prompt_type: str) -> str:
+    return "singlestep" if "SINGLESTEP" in prompt_type else "error"
+
+def fill_queue(queue: WorkQueue, queries_folder: str, prompt_type: str,
+               selection: Optional[SegmentSelection] = None) -> int:
+
+    """Add the first-stage task of every (selected) segment of a query folder. Returns the number added."""
+
+    stage = first_stage(prompt_type)
+    added = 0
+    for system, file_name in list_systems(queries_folder):
+        records = iter_segment_records(os.path.join(queries_folder, file_name), selection)
+        added += queue.add_tasks((system, segment_id, stage, record) for segment_id, record in records)
+    queue.set_meta("prompt_type", prompt_type)
+    queue.set_meta("selection", None if selection is None else [selection.segment_ids, selection.sample_size, selection.seed])
+    print(f"Queued {added} {stage} tasks from {queries_folder}.")
+    return added
+
+def merge_results(queue: WorkQueue, queries_folder: str, responses_folder: str, file_format: str = "jsonl") -> dict[str, int]:
+    """
+    Write the response file of every system whose tasks are all done; other systems are reported and skipped.
+    Returns {system: number of records written}.
+    """
+
+    prompt_type = queue.get_meta("prompt_type")
+    fields = ["singlestep_response"] if first_stage(prompt_type) == "singlestep" else ["error_response", "count_response"]
+    params = queue.get_meta("selection")
+    selection = None if params is None else SegmentSelection(tuple(params[0]) if params[0] is not None else None,
+                                                             params[1], params[2])
+
+    os.makedirs(responses_folder, exist_ok=True)
+    template = load_template(queries_folder)
+    if template is not None:
+        save_template(template, responses_folder)
+
+    written = {}
+    for system, file_name in list_systems(queries_folder):
+        query_path = os.path.join(queries_folder, file_name)
+        results = queue.results(system)
+        segment_ids = [segment_id for segment_id, _ in iter_segment_records(query_path, selection)]
+        incomplete = sum(any(field not in results.get(segment_id, {}) for field in fields) for segment_id in segment_ids)
+        if incomplete:
+            print(f"{system}: {incomplete}/{len(segment_ids)} segments not done yet, skipped.")
+            continue
+
+        output_path = os.path.join(responses_folder, f"{system}.{file_format}")
+        with RecordWriter(output_path + ".tmp", jsonl=(file_format == "jsonl")) as writer:
+            for segment_id, record in iter_segment_records(query_path, selection):
+                if selection is not None:
+                    record = {"segment_id": segment_id, **record}
+                writer.write({**record, **{field: results[segment_id][field] for field in fields}})
+        os.replace(output_path + ".tmp", output_path)
+        written[system] = writer.count
+        print(f"Saved to {output_path}.")
+    return written